@@ -0,0 +1,3 @@
+ALTER TABLE layer_field_vector_layer ADD COLUMN indexed boolean;
+UPDATE layer_field_vector_layer SET indexed = false;
+ALTER TABLE layer_field_vector_layer ALTER COLUMN indexed SET NOT NULL;
@@ -0,0 +1 @@
+ALTER TABLE vector_layer ADD COLUMN feature_count integer;
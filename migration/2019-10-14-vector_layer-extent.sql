@@ -0,0 +1,20 @@
+ALTER TABLE vector_layer ADD COLUMN extent_minlon double precision;
+ALTER TABLE vector_layer ADD COLUMN extent_minlat double precision;
+ALTER TABLE vector_layer ADD COLUMN extent_maxlon double precision;
+ALTER TABLE vector_layer ADD COLUMN extent_maxlat double precision;
+
+DO $$
+DECLARE
+    r record;
+    b box2d;
+BEGIN
+    FOR r IN SELECT id, tbl_uuid FROM vector_layer LOOP
+        EXECUTE format(
+            'SELECT ST_Extent(ST_Transform(geom, 4326)) FROM vector_layer.%I',
+            'layer_' || r.tbl_uuid) INTO b;
+        UPDATE vector_layer SET
+            extent_minlon = ST_XMin(b), extent_minlat = ST_YMin(b),
+            extent_maxlon = ST_XMax(b), extent_maxlat = ST_YMax(b)
+        WHERE id = r.id;
+    END LOOP;
+END $$;
@@ -0,0 +1 @@
+ALTER TABLE vector_layer ADD COLUMN generalized boolean NOT NULL DEFAULT false;
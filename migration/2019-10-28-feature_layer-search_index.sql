@@ -0,0 +1,4 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE vector_layer ADD COLUMN search_index boolean NOT NULL DEFAULT false;
+ALTER TABLE postgis_layer ADD COLUMN search_index boolean NOT NULL DEFAULT false;
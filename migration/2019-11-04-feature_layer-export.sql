@@ -0,0 +1,27 @@
+ALTER TABLE vector_layer ADD COLUMN data_version integer NOT NULL DEFAULT 0;
+
+CREATE TABLE feature_layer_export
+(
+    id serial NOT NULL,
+    resource_id integer NOT NULL,
+    format character varying NOT NULL,
+    srs_id integer NOT NULL,
+    encoding character varying,
+    fid character varying,
+    zipped boolean NOT NULL,
+    revision character varying,
+    status character varying(7) NOT NULL,
+    created timestamp without time zone NOT NULL,
+    finished timestamp without time zone,
+    error character varying,
+    filename character varying,
+    content_type character varying,
+    fileobj_id integer,
+    CONSTRAINT feature_layer_export_pkey PRIMARY KEY (id),
+    CONSTRAINT feature_layer_export_resource_id_fkey FOREIGN KEY (resource_id)
+        REFERENCES resource (id) ON DELETE CASCADE,
+    CONSTRAINT feature_layer_export_fileobj_id_fkey FOREIGN KEY (fileobj_id)
+        REFERENCES fileobj (id),
+    CONSTRAINT feature_layer_export_status_check CHECK (status IN (
+        'pending', 'running', 'done', 'failed'))
+);
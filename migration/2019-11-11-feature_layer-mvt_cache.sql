@@ -0,0 +1,14 @@
+CREATE TABLE feature_layer_mvt_cache
+(
+    key character varying NOT NULL,
+    z smallint NOT NULL,
+    x integer NOT NULL,
+    y integer NOT NULL,
+    resources integer[] NOT NULL,
+    empty boolean NOT NULL,
+    tstamp integer NOT NULL,
+    CONSTRAINT feature_layer_mvt_cache_pkey PRIMARY KEY (key, z, x, y)
+);
+
+CREATE INDEX feature_layer_mvt_cache_resources_idx
+    ON feature_layer_mvt_cache USING gin (resources);
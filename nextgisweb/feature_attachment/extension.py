@@ -21,6 +21,22 @@ class FeatureAttachmentExtension(FeatureExtension):
         result = map(lambda itm: itm.serialize(), query)
         return result if len(result) > 0 else None
 
+    def serialize_many(self, features):
+        ids = [feature.id for feature in features]
+        if len(ids) == 0:
+            return []
+
+        query = FeatureAttachment.filter(
+            FeatureAttachment.resource_id == self.layer.id,
+            FeatureAttachment.feature_id.in_(ids)
+        ).order_by(FeatureAttachment.id)
+
+        data = dict()
+        for itm in query:
+            data.setdefault(itm.feature_id, []).append(itm.serialize())
+
+        return [data.get(fid) for fid in ids]
+
     def deserialize(self, feature, data):
         if data is None:
             data = []
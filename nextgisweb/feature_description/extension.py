@@ -25,6 +25,20 @@ class FeatureDescriptionExtension(FeatureExtension):
         else:
             return obj.value
 
+    def serialize_many(self, features):
+        ids = [feature.id for feature in features]
+        if len(ids) == 0:
+            return []
+
+        query = DBSession.query(
+            FeatureDescription.feature_id, FeatureDescription.value
+        ).filter(
+            FeatureDescription.resource_id == self.layer.id,
+            FeatureDescription.feature_id.in_(ids))
+
+        data = dict(query)
+        return [data.get(fid) for fid in ids]
+
     def deserialize(self, feature, data):
         obj = FeatureDescription.filter_by(
             resource_id=self.layer.id,
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import os
+import os.path
+import threading
+
 from ..component import Component, require
 
 from .feature import Feature, FeatureSet
@@ -11,19 +15,27 @@ from .interface import (
     GEOM_TYPE_OGR,
     FIELD_TYPE,
     FIELD_TYPE_OGR,
+    COUNT_MODE,
     IFeatureLayer,
     IWritableFeatureLayer,
+    IFeatureLayerRevision,
     IFeatureQuery,
     IFeatureQueryFilter,
     IFeatureQueryFilterBy,
     IFeatureQueryOrderBy,
+    IFeatureQueryKeyset,
     IFeatureQueryLike,
     IFeatureQueryIntersects,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
+    IFeatureQueryMVT,
+    IFeatureQueryTotalCount,
+    IFeatureQueryTiles,
 )
 from .event import on_data_change
 from .extension import FeatureExtension
+from . import command  # NOQA
+from . import mvt  # NOQA
 
 
 class FeatureLayerComponent(Component):
@@ -37,6 +49,39 @@ class FeatureLayerComponent(Component):
         self.settings['search.nominatim'] = \
             self.settings.get('search.nominatim', 'true').lower() == 'true'
 
+        self.settings['count.estimate_threshold'] = int(
+            self.settings.get('count.estimate_threshold', 100000))
+
+        self.settings['export.workers'] = int(
+            self.settings.get('export.workers', 2))
+
+        # Results of jobs which can't be reused are kept for a day and
+        # unfinished jobs are considered lost after an hour.
+        self.settings['export.ttl'] = int(
+            self.settings.get('export.ttl', 86400))
+        self.settings['export.timeout'] = int(
+            self.settings.get('export.timeout', 3600))
+
+        # Limits the number of concurrent asynchronous export jobs
+        self.export_semaphore = threading.BoundedSemaphore(
+            self.settings['export.workers'])
+
+        self.settings['query.workers'] = int(
+            self.settings.get('query.workers', 4))
+
+        self.settings['mvt_cache.enabled'] = \
+            self.settings.get('mvt_cache.enabled', 'false').lower() == 'true'
+
+        ttl = self.settings.get('mvt_cache.ttl')
+        self.settings['mvt_cache.ttl'] = int(ttl) if ttl is not None else None
+
+        self.mvt_cache_path = os.path.join(
+            self.env.core.gtsdir(self), 'mvt_cache')
+        if self.settings['mvt_cache.enabled'] and not os.path.isdir(
+            self.mvt_cache_path
+        ):
+            os.makedirs(self.mvt_cache_path)
+
         self.FeatureExtension = FeatureExtension
 
     @require('resource')
@@ -47,5 +92,12 @@ class FeatureLayerComponent(Component):
 
     settings_info = (
         dict(key='identify.attributes', desc=u"Show attributes in identification"),
-        dict(key='search.nominatim', desc=u"Use Nominatim while searching")
+        dict(key='search.nominatim', desc=u"Use Nominatim while searching"),
+        dict(key='count.estimate_threshold', desc=u"Feature count above which planner estimate is used"),
+        dict(key='export.workers', desc=u"Number of concurrent asynchronous export jobs"),
+        dict(key='export.ttl', desc=u"Lifetime in seconds of export job results which can't be reused"),
+        dict(key='export.timeout', desc=u"Time in seconds after which unfinished export job is failed"),
+        dict(key='query.workers', desc=u"Number of threads for concurrent per-resource queries in MVT and identify, each uses a database connection and they are limited by connection pool size"),
+        dict(key='mvt_cache.enabled', desc=u"Cache MVT tiles on the server side"),
+        dict(key='mvt_cache.ttl', desc=u"MVT cache tile lifetime in seconds"),
     )
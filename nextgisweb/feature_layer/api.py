@@ -1,38 +1,48 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import base64
 import json
 import os
 import re
 import urllib
-import uuid
-import zipfile
-import itertools
 
-import backports.tempfile
+import transaction
 from collections import OrderedDict
 from datetime import datetime, date, time
-from io import BytesIO
 
-from osgeo import ogr, gdal
 from shapely import wkt
+from shapely.errors import WKTReadingError
 from shapely.geometry import mapping
-from pyramid.response import Response
-from pyramid.httpexceptions import HTTPNoContent
+from pyramid.response import Response, FileResponse
+from pyramid.httpexceptions import HTTPNoContent, HTTPNotFound
 
-from ..geometry import geom_from_wkt, box
+from ..geometry import box, geom_from_wkt
 from ..resource import DataScope, ValidationError, Resource, resource_factory
 from ..spatial_ref_sys import SRS
+from ..env import env
+from ..models import DBSession
 from .. import geojson
 
 from .interface import (
     IFeatureLayer,
     IWritableFeatureLayer,
-    IFeatureQueryClipByBox,
-    IFeatureQuerySimplify,
-    FIELD_TYPE)
+    IFeatureQueryKeyset,
+    IFeatureQueryTotalCount,
+    FIELD_TYPE,
+    COUNT_MODE)
 from .feature import Feature
 from .extension import FeatureExtension
+from .model import FeatureLayerExport
 from .ogrdriver import EXPORT_FORMAT_OGR
+from .stream import STREAM_WRITERS
+from .mvt import MVTCache, mvt_tile
+from .export import (
+    apply_geom_options,
+    export_body,
+    export_job_active,
+    export_job_cached,
+    export_job_schedule,
+    export_job_stale)
 from .util import _
 
 
@@ -40,28 +50,6 @@ PERM_READ = DataScope.read
 PERM_WRITE = DataScope.write
 
 
-def _ogr_memory_ds():
-    return gdal.GetDriverByName(b'Memory').Create(
-        b'', 0, 0, 0, gdal.GDT_Unknown)
-
-
-def _ogr_ds(driver, options):
-    return ogr.GetDriverByName(driver).CreateDataSource(
-        "/vsimem/%s" % uuid.uuid4(), options=options
-    )
-
-
-def _ogr_layer_from_features(layer, features, name=b'', ds=None, fid=None):
-    ogr_layer = layer.to_ogr(ds, name=name, fid=fid)
-    layer_defn = ogr_layer.GetLayerDefn()
-
-    for f in features:
-        ogr_layer.CreateFeature(
-            f.to_ogr(layer_defn, fid=fid))
-
-    return ogr_layer
-
-
 def view_geojson(request):
     request.GET["format"] = EXPORT_FORMAT_OGR["GEOJSON"].extension
     request.GET["zipped"] = "false"
@@ -69,18 +57,16 @@ def view_geojson(request):
     return export(request)
 
 
-def export(request):
-    request.resource_permission(PERM_READ)
-
+def _export_params(request, params):
     srs = int(
-        request.GET.get("srs", request.context.srs.id)
+        params.get("srs", request.context.srs.id)
     )
     srs = SRS.filter_by(id=srs).one()
-    fid = request.GET.get("fid")
-    format = request.GET.get("format")
-    encoding = request.GET.get("encoding")
-    zipped = request.GET.get("zipped", "true")
-    zipped = zipped.lower() == "true"
+    fid = params.get("fid")
+    format = params.get("format")
+    encoding = params.get("encoding")
+    zipped = params.get("zipped", "true")
+    zipped = unicode(zipped).lower() == "true"
 
     if format is None:
         raise ValidationError(
@@ -94,76 +80,146 @@ def export(request):
             _("Format '%s' is not supported.") % (format,)
         )
 
-    driver = EXPORT_FORMAT_OGR[format]
+    return format, srs, fid, encoding, zipped
 
-    # layer creation options
-    lco = list(driver.options or [])
 
-    if encoding is not None:
-        lco.append("ENCODING=%s" % encoding)
+def _geom_params(request, srs):
+    """ Geometry options from ``geom``, ``precision``, ``simplify`` and
+    ``clip`` request parameters as a tuple ``(geom, precision, simplify,
+    clip)``, where simplify tolerance and clip box are in the output SRS """
 
-    query = request.context.feature_query()
-    query.geom()
+    geom = request.GET.get('geom', 'yes').lower() not in ('no', 'false')
+
+    try:
+        precision = request.GET.get('precision')
+        if precision is not None:
+            precision = int(precision)
+            if precision < 0:
+                raise ValueError()
+    except ValueError:
+        raise ValidationError(_("Invalid precision value."))
 
-    ogr_ds = _ogr_memory_ds()
-    ogr_layer = _ogr_layer_from_features(
-        request.context, query(), ds=ogr_ds, fid=fid)
+    try:
+        simplify = request.GET.get('simplify')
+        if simplify is not None:
+            simplify = float(simplify)
+            if simplify < 0:
+                raise ValueError()
+    except ValueError:
+        raise ValidationError(_("Invalid simplify value."))
 
-    buf = BytesIO()
+    try:
+        clip = request.GET.get('clip')
+        if clip is not None:
+            minx, miny, maxx, maxy = map(float, clip.split(','))
+            if minx > maxx or miny > maxy:
+                raise ValueError()
+            clip = box(minx, miny, maxx, maxy, srid=srs.id)
+    except ValueError:
+        raise ValidationError(_("Invalid clip value."))
 
-    with backports.tempfile.TemporaryDirectory() as temp_dir:
-        filename = "%d.%s" % (
-            request.context.id,
-            driver.extension,
-        )
+    return geom, precision, simplify, clip
 
-        vtopts = [
-            '-f', driver.name,
-            '-t_srs', srs.wkt,
-        ] + list(itertools.chain(*[('-lco', o) for o in lco]))
 
-        if driver.fid_support and fid is None:
-            vtopts.append('-preserve_fid')
+def _transaction_iter(body):
+    """ Streamed response body is generated after the request transaction
+    is finished, so features are read in a separate transaction """
 
-        gdal.VectorTranslate(
-            os.path.join(temp_dir, filename), ogr_ds,
-            options=gdal.VectorTranslateOptions(options=vtopts)
-        )
+    with transaction.manager:
+        for chunk in body:
+            yield chunk
+
+
+def export(request):
+    request.resource_permission(PERM_READ)
 
-        if zipped or not driver.single_file:
-            with zipfile.ZipFile(
-                buf, "w", zipfile.ZIP_DEFLATED
-            ) as zipf:
-                for root, dirs, files in os.walk(temp_dir):
-                    for file in files:
-                        path = os.path.join(root, file)
-                        zipf.write(
-                            path, os.path.basename(path)
-                        )
+    format, srs, fid, encoding, zipped = _export_params(request, request.GET)
+    geom, precision, simplify, clip = _geom_params(request, srs)
 
-            content_type = "application/zip"
-            filename = "%s.zip" % (filename,)
+    filename, content_type, body = export_body(
+        request.context, format, srs, fid=fid, encoding=encoding,
+        zipped=zipped, geom=geom, precision=precision, simplify=simplify,
+        clip=clip)
 
-        else:
-            content_type = (
-                driver.mime or "application/octet-stream"
-            )
-            with open(
-                os.path.join(temp_dir, filename)
-            ) as f:
-                buf.write(f.read())
+    if format in STREAM_WRITERS:
+        body = _transaction_iter(body)
 
     content_disposition = (
         b"attachment; filename=%s" % filename
     )
 
     return Response(
-        buf.getvalue(),
+        app_iter=body,
         content_type=b"%s" % str(content_type),
         content_disposition=content_disposition,
     )
 
 
+def export_job_create(request):
+    request.resource_permission(PERM_READ)
+
+    params = request.json_body if request.body else request.GET
+    format, srs, fid, encoding, zipped = _export_params(request, params)
+
+    job = export_job_cached(
+        request.context, format, srs, fid, encoding, zipped)
+
+    if job is not None and not os.path.isfile(env.file_storage.filename(
+            job.fileobj)):
+        job = None
+
+    # Identical job may be already started by other request
+    if job is None:
+        job = export_job_active(
+            request.context, format, srs, fid, encoding, zipped)
+
+    if job is None:
+        job = FeatureLayerExport(
+            resource_id=request.context.id, format=format, srs_id=srs.id,
+            fid=fid, encoding=encoding, zipped=zipped, status='pending',
+        ).persist()
+        DBSession.flush()
+
+        export_job_schedule(job.id)
+
+    return Response(
+        json.dumps(job.to_dict()),
+        content_type=b'application/json')
+
+
+def _export_job(request):
+    request.resource_permission(PERM_READ)
+
+    job = FeatureLayerExport.filter_by(
+        id=int(request.matchdict['job_id']),
+        resource_id=request.context.id).first()
+    if job is None:
+        raise HTTPNotFound()
+
+    export_job_stale(job)
+    return job
+
+
+def export_job_get(request):
+    job = _export_job(request)
+    return Response(
+        json.dumps(job.to_dict()),
+        content_type=b'application/json')
+
+
+def export_job_download(request):
+    job = _export_job(request)
+    if job.status != 'done':
+        raise ValidationError(_("Export job isn't finished yet."))
+
+    response = FileResponse(
+        env.file_storage.filename(job.fileobj),
+        content_type=str(job.content_type),
+        request=request)
+    response.content_disposition = b"attachment; filename=%s" % job.filename
+    return response
+
+
 def mvt(request):
     z = int(request.GET["z"])
     x = int(request.GET["x"])
@@ -172,91 +228,59 @@ def mvt(request):
     extent = int(request.GET.get('extent', 4096))
     simplification = float(request.GET.get("simplification", extent / 512))
 
-    resids = map(
-        int,
-        filter(None, request.GET["resource"].split(",")),
-    )
-
-    # web mercator
-    merc = SRS.filter_by(id=3857).one()
-    minx, miny, maxx, maxy = merc.tile_extent((z, x, y))
-
     # 5% padding by default
     padding = float(request.GET.get("padding", 0.05))
 
-    bbox = (
-        minx - (maxx - minx) * padding,
-        miny - (maxy - miny) * padding,
-        maxx + (maxx - minx) * padding,
-        maxy + (maxy - miny) * padding,
+    resids = map(
+        int,
+        filter(None, request.GET["resource"].split(",")),
     )
-    bbox = box(*bbox, srid=merc.id)
-
-    options = [
-        "FORMAT=DIRECTORY",
-        "TILE_EXTENSION=pbf",
-        "MINZOOM=%d" % z,
-        "MAXZOOM=%d" % z,
-        "EXTENT=%d" % extent,
-        "COMPRESS=NO",
-    ]
-
-    ds = _ogr_ds(b"MVT", options)
-
-    vsibuf = ds.GetName()
 
     for resid in resids:
         obj = Resource.filter_by(id=resid).one()
         request.resource_permission(PERM_READ, obj)
 
-        query = obj.feature_query()
-        query.intersects(bbox)
-        query.geom()
+    cache = None
+    content = None
+    if env.feature_layer.settings['mvt_cache.enabled']:
+        cache = MVTCache(resids, extent, simplification, padding)
+        content = cache.get_tile((z, x, y))
+
+    if content is None:
+        content = mvt_tile(
+            resids, (z, x, y), extent, simplification, padding)
+        if cache is not None:
+            cache.put_tile((z, x, y), content)
 
-        if IFeatureQueryClipByBox.providedBy(query):
-            query.clip_by_box(bbox)
+    if len(content) == 0:
+        return HTTPNoContent()
 
-        if IFeatureQuerySimplify.providedBy(query):
-            tolerance = ((obj.srs.maxx - obj.srs.minx) / (1 << z)) / extent
-            query.simplify(tolerance * simplification)
+    return Response(
+        content,
+        content_type=b"application/vnd.mapbox-vector-tile",
+    )
 
-        _ogr_layer_from_features(
-            obj, query(), name=b"ngw:%d" % obj.id, ds=ds)
 
-    # flush changes
-    ds = None
+def _cursor_encode(fid):
+    return base64.urlsafe_b64encode(json.dumps(dict(id=fid)))
 
-    filepath = os.path.join(
-        "%s" % vsibuf, "%d" % z, "%d" % x, "%d.pbf" % y
-    )
 
+def _cursor_decode(value):
     try:
-        f = gdal.VSIFOpenL(b"%s" % (filepath,), b"rb")
-
-        if f is not None:
-            # SEEK_END = 2
-            gdal.VSIFSeekL(f, 0, 2)
-            size = gdal.VSIFTellL(f)
-
-            # SEEK_SET = 0
-            gdal.VSIFSeekL(f, 0, 0)
-            content = gdal.VSIFReadL(1, size, f)
-            gdal.VSIFCloseL(f)
-
-            return Response(
-                content,
-                content_type=b"application/vnd.mapbox-vector-tile",
-            )
-        else:
-            return HTTPNoContent()
-
-    finally:
-        gdal.Unlink(b"%s" % (vsibuf,))
+        return int(json.loads(base64.urlsafe_b64decode(str(value)))['id'])
+    except (TypeError, ValueError, KeyError):
+        raise ValidationError(_("Invalid cursor."))
 
 
 def deserialize(feat, data):
     if 'geom' in data:
-        feat.geom = data['geom']
+        geom = data['geom']
+        if geom is not None:
+            try:
+                geom = geom_from_wkt(geom, srid=feat.layer.srs_id)
+            except WKTReadingError:
+                raise ValidationError(_("Invalid geometry."))
+        feat.geom = geom
 
     if 'fields' in data:
         fdata = data['fields']
@@ -302,15 +326,53 @@ def deserialize(feat, data):
                 ext.deserialize(feat, data['extensions'][cls.identity])
 
 
-def serialize(feat, keys=None, geom_format=None):
+def _extensions_param(request):
+    """ Extension classes selected with ``extensions`` request parameter,
+    all of them if it isn't set and none if it's empty """
+
+    value = request.GET.get('extensions')
+    if value is None:
+        return list(FeatureExtension.registry)
+
+    identities = value.split(',')
+    return [
+        cls for cls in FeatureExtension.registry
+        if cls.identity in identities]
+
+
+def serialize_extensions(layer, features, extensions=None):
+    """ Serialize extension data of features with one ``serialize_many``
+    call per extension, returns a list of dicts in the same order as
+    features """
+
+    if extensions is None:
+        extensions = list(FeatureExtension.registry)
+
+    result = [OrderedDict() for feature in features]
+    for cls in extensions:
+        ext = cls(layer)
+        for data, value in zip(result, ext.serialize_many(features)):
+            data[cls.identity] = value
+
+    return result
+
+
+def serialize(
+    feat, keys=None, geom_format=None, extensions=None, geom=True,
+    precision=None,
+):
     result = OrderedDict(id=feat.id)
 
-    if geom_format is not None and geom_format.lower() == "geojson":
-        geom = mapping(feat.geom)
+    if not geom:
+        pass
+    elif feat.geom is None:
+        result['geom'] = None
+    elif geom_format is not None and geom_format.lower() == "geojson":
+        result['geom'] = mapping(feat.geom) if precision is None \
+            else geojson.round_geometry(mapping(feat.geom), precision)
     else:
-        geom = wkt.dumps(feat.geom)
-
-    result['geom'] = geom
+        result['geom'] = wkt.dumps(feat.geom) if precision is None \
+            else wkt.dumps(feat.geom, rounding_precision=precision, trim=True)
 
     result['fields'] = OrderedDict()
     for fld in feat.layer.fields:
@@ -348,10 +410,9 @@ def serialize(feat, keys=None, geom_format=None):
 
         result['fields'][fld.keyname] = fval
 
-    result['extensions'] = OrderedDict()
-    for cls in FeatureExtension.registry:
-        ext = cls(feat.layer)
-        result['extensions'][cls.identity] = ext.serialize(feat)
+    if extensions is None:
+        extensions = serialize_extensions(feat.layer, [feat, ])[0]
+    result['extensions'] = extensions
 
     return result
 
@@ -361,12 +422,15 @@ def iget(resource, request):
 
     geom_format = request.GET.get("geom_format")
     srs = request.GET.get("srs")
+    srs = SRS.filter_by(id=int(srs)).one() if srs is not None \
+        else resource.srs
+    geom, precision, simplify, clip = _geom_params(request, srs)
 
     query = resource.feature_query()
-    query.geom()
-
-    if srs is not None:
-        query.srs(SRS.filter_by(id=int(srs)).one())
+    if geom:
+        query.geom()
+        query.srs(srs)
+        apply_geom_options(query, simplify=simplify, clip=clip)
 
     query.filter_by(id=request.matchdict['fid'])
     query.limit(1)
@@ -375,8 +439,14 @@ def iget(resource, request):
     for f in query():
         result = f
 
+    extensions = serialize_extensions(
+        resource, [result, ], _extensions_param(request))[0]
+
     return Response(
-        json.dumps(serialize(result, geom_format=geom_format), cls=geojson.Encoder),
+        json.dumps(serialize(
+            result, geom_format=geom_format, extensions=extensions,
+            geom=geom, precision=precision
+        ), cls=geojson.Encoder),
         content_type=b'application/json')
 
 
@@ -416,15 +486,22 @@ def cget(resource, request):
 
     geom_format = request.GET.get("geom_format")
     srs = request.GET.get("srs")
+    srs = SRS.filter_by(id=int(srs)).one() if srs is not None \
+        else resource.srs
+    geom, precision, simplify, clip = _geom_params(request, srs)
 
     query = resource.feature_query()
-
-    if srs is not None:
-        query.srs(SRS.filter_by(id=int(srs)).one())
+    query.srs(srs)
 
     # Paging
     limit = request.GET.get('limit')
     offset = request.GET.get('offset', 0)
+    cursor = request.GET.get('cursor')
+    if cursor is not None:
+        if not IFeatureQueryKeyset.providedBy(query):
+            raise ValidationError(_("Cursor paging is not supported."))
+        query.after(_cursor_decode(cursor))
+        offset = 0
     if limit is not None:
         query.limit(int(limit), int(offset))
 
@@ -446,8 +523,8 @@ def cget(resource, request):
     # Filtering by extent
     wkt = request.GET.get('intersects')
     if wkt is not None:
-        geom = geom_from_wkt(wkt, srid=resource.srs.id)
-        query.intersects(geom)
+        intersects_geom = geom_from_wkt(wkt, srid=resource.srs.id)
+        query.intersects(intersects_geom)
 
     # Selected fields
     fields = request.GET.get('fields')
@@ -458,16 +535,50 @@ def cget(resource, request):
     if fields:
         query.fields(*fields)
 
-    query.geom()
+    # Geometry is simplified and clipped in the database
+    if geom:
+        query.geom()
+        apply_geom_options(query, simplify=simplify, clip=clip)
+
+    # Total count of features matching filters
+    count_mode = request.GET.get('count')
+    if count_mode is not None:
+        count_mode = _count_mode(request, 'count')
+        if (
+            count_mode == COUNT_MODE.EXACT
+            and IFeatureQueryTotalCount.providedBy(query)  # NOQA: W503
+        ):
+            query.with_total_count()
+
+    feature_set = query()
+    features = list(feature_set)
+    extensions = serialize_extensions(
+        resource, features, _extensions_param(request))
 
     result = [
-        serialize(feature, fields, geom_format=geom_format)
-        for feature in query()
+        serialize(
+            feature, fields, geom_format=geom_format, extensions=ext,
+            geom=geom, precision=precision)
+        for feature, ext in zip(features, extensions)
     ]
 
+    headers = dict()
+    headers[str('Content-Type')] = str('application/json')
+
+    # Cursor for the next page, if the page is full there might be more
+    if (
+        limit is not None and len(result) == int(limit) > 0
+        and IFeatureQueryKeyset.providedBy(query)  # NOQA: W503
+    ):
+        headers[str('X-Feature-Cursor')] = str(
+            _cursor_encode(result[-1]['id']))
+
+    if count_mode is not None:
+        headers[str('X-Feature-Count')] = str(feature_set.count(count_mode))
+
     return Response(
         json.dumps(result, cls=geojson.Encoder),
-        content_type=b'application/json')
+        headers=headers)
 
 
 def cpost(resource, request):
@@ -484,29 +595,40 @@ def cpost(resource, request):
 
 def cpatch(resource, request):
     request.resource_permission(PERM_WRITE)
-    result = list()
 
+    create, update = list(), list()
     for fdata in request.json_body:
         if 'id' not in fdata:
             # Create new feature
             feature = Feature(layer=resource)
             deserialize(feature, fdata)
-            fid = resource.feature_create(feature)
+            create.append(feature)
         else:
-            # Update existing feature
-            fid = fdata['id']
-            query = resource.feature_query()
-            query.geom()
-            query.filter_by(id=fid)
-            query.limit(1)
+            # Update existing feature, only fields present in the request
+            # are updated, so there is no need to query the feature first
+            feature = Feature(layer=resource, id=fdata['id'])
+            deserialize(feature, fdata)
+            update.append(feature)
 
-            feature = None
-            for f in query():
-                feature = f
+    if len(update) > 0:
+        # Features are updated without querying them, so check that all of
+        # them exist before any changes.
+        query = resource.feature_query()
+        query.filter(('id', 'in', [f.id for f in update]))
+        found = set(f.id for f in query())
 
-            deserialize(feature, fdata)
-            resource.feature_put(feature)
+        missing = [f.id for f in update if f.id not in found]
+        if len(missing) > 0:
+            raise ValidationError(_("Feature not found: %s.") % ', '.join(
+                map(str, missing)))
+
+    created = iter(resource.feature_create_many(create))
+    resource.feature_put_many(update)
 
+    # Keep the order of features in request
+    result = list()
+    for fdata in request.json_body:
+        fid = fdata['id'] if 'id' in fdata else next(created)
         result.append(dict(id=fid))
 
     return Response(json.dumps(result), content_type=b'application/json')
@@ -516,12 +638,8 @@ def cdelete(resource, request):
     request.resource_permission(PERM_WRITE)
 
     if request.body and request.json_body:
-        result = []
-        for fdata in request.json_body:
-            if 'id' in fdata:
-                fid = fdata['id']
-                resource.feature_delete(fid)
-                result.append(fid)
+        result = [fdata['id'] for fdata in request.json_body if 'id' in fdata]
+        resource.feature_delete_many(result)
     else:
         resource.feature_delete_all()
         result = True
@@ -529,11 +647,18 @@ def cdelete(resource, request):
     return Response(json.dumps(result), content_type=b'application/json')
 
 
+def _count_mode(request, key):
+    mode = request.GET.get(key, COUNT_MODE.EXACT)
+    if mode not in COUNT_MODE.enum:
+        raise ValidationError(_("Invalid count mode: '%s'.") % mode)
+    return mode
+
+
 def count(resource, request):
     request.resource_permission(PERM_READ)
 
     query = resource.feature_query()
-    total_count = query().total_count
+    total_count = query().count(_count_mode(request, 'mode'))
 
     return Response(
         json.dumps(dict(total_count=total_count)),
@@ -567,6 +692,14 @@ def store_collection(layer, request):
     if like != '':
         query.like(like)
 
+    # Exact count is selected with the page, other modes are cheaper
+    count_mode = _count_mode(request, 'count')
+    if (
+        http_range and count_mode == COUNT_MODE.EXACT
+        and IFeatureQueryTotalCount.providedBy(query)  # NOQA: W503
+    ):
+        query.with_total_count()
+
     sort_re = re.compile(r'sort\(([+-])%s(\w+)\)' % (field_prefix, ))
     sort = sort_re.search(urllib.unquote(request.query_string))
     if sort:
@@ -590,7 +723,7 @@ def store_collection(layer, request):
     headers[str('Content-Type')] = str('application/json')
 
     if http_range:
-        total = features.total_count
+        total = features.count(count_mode)
         last = min(total - 1, last)
         headers[str('Content-Range')] = str('items %d-%s/%d' % (first, last, total))
 
@@ -608,6 +741,26 @@ def setup_pyramid(comp, config):
         factory=resource_factory) \
         .add_view(export, context=IFeatureLayer, request_method='GET')
 
+    config.add_route(
+        'feature_layer.export.job', '/api/resource/{id}/export/job/',
+        factory=resource_factory) \
+        .add_view(export_job_create, context=IFeatureLayer,
+                  request_method='POST')
+
+    config.add_route(
+        'feature_layer.export.job.item',
+        r'/api/resource/{id}/export/job/{job_id:\d+}',
+        factory=resource_factory) \
+        .add_view(export_job_get, context=IFeatureLayer,
+                  request_method='GET')
+
+    config.add_route(
+        'feature_layer.export.job.download',
+        r'/api/resource/{id}/export/job/{job_id:\d+}/download',
+        factory=resource_factory) \
+        .add_view(export_job_download, context=IFeatureLayer,
+                  request_method='GET')
+
     config.add_route(
         'feature_layer.mvt', '/api/component/feature_layer/mvt') \
         .add_view(mvt, request_method='GET')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+from itertools import product
+
+import transaction
+from pyproj import Transformer
+
+from ..command import Command
+from ..layer import IBboxLayer
+from ..resource import Resource
+from ..spatial_ref_sys import SRS
+
+from .mvt import MVTCache, mvt_tile
+
+
+_logger = logging.getLogger(__name__)
+
+SEED_STEP = 64
+
+
+@Command.registry.register
+class MVTCacheSeedCommand():
+    identity = 'feature_layer.mvt_cache_seed'
+
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        parser.add_argument(
+            '--resource', required=True,
+            help="Comma separated resource IDs, same as in MVT requests")
+        parser.add_argument('--zoom', type=int, required=True,
+                            help="Maximum zoom level")
+        parser.add_argument('--min-zoom', type=int, default=0)
+        parser.add_argument('--extent', type=int, default=4096)
+        parser.add_argument('--simplification', type=float, default=None)
+        parser.add_argument('--padding', type=float, default=0.05)
+
+    @classmethod
+    def execute(cls, args, env):
+        if not env.feature_layer.settings['mvt_cache.enabled']:
+            _logger.warning("MVT cache is disabled, nothing to seed")
+            return
+
+        resids = map(int, filter(None, args.resource.split(',')))
+        # Same as in MVT requests, it's a part of the cache key
+        simplification = float(args.simplification) \
+            if args.simplification is not None else float(args.extent / 512)
+
+        merc = SRS.filter_by(id=3857).one()
+        size = merc.maxx - merc.minx
+
+        # Union of resource extents in EPSG:3857, whole world if any of
+        # resources doesn't provide its extent
+        srs_tr = Transformer.from_crs(4326, 3857, always_xy=True)
+        bounds = None
+        for resid in resids:
+            resource = Resource.filter_by(id=resid).one()
+            if not IBboxLayer.providedBy(resource):
+                bounds = (merc.minx, merc.miny, merc.maxx, merc.maxy)
+                break
+
+            extent = resource.extent
+            if extent['minLon'] is None:
+                continue
+
+            rbounds = srs_tr.transform(
+                extent['minLon'], max(extent['minLat'], -85.0511)
+            ) + srs_tr.transform(
+                extent['maxLon'], min(extent['maxLat'], 85.0511))
+
+            bounds = rbounds if bounds is None else (
+                min(bounds[0], rbounds[0]), min(bounds[1], rbounds[1]),
+                max(bounds[2], rbounds[2]), max(bounds[3], rbounds[3]))
+
+        if bounds is None:
+            _logger.info("Resources have no features, nothing to seed")
+            return
+
+        cache = MVTCache(
+            resids, args.extent, simplification, args.padding)
+
+        progress = 0
+        rendered = 0
+
+        for z in range(args.min_zoom, args.zoom + 1):
+            tmax = (1 << z) - 1
+
+            def tidx(value):
+                return min(max(int(value / size * (1 << z)), 0), tmax)
+
+            rx = (tidx(bounds[0] - merc.minx), tidx(bounds[2] - merc.minx))
+            ry = (tidx(merc.maxy - bounds[3]), tidx(merc.maxy - bounds[1]))
+
+            _logger.info(
+                "Seeding MVT cache for zoom level %d with %d tiles", z,
+                (rx[1] - rx[0] + 1) * (ry[1] - ry[0] + 1))
+
+            for x, y in product(
+                range(rx[0], rx[1] + 1), range(ry[0], ry[1] + 1)
+            ):
+                if cache.get_tile((z, x, y)) is None:
+                    content = mvt_tile(
+                        resids, (z, x, y), args.extent,
+                        simplification, args.padding)
+                    cache.put_tile((z, x, y), content)
+                    rendered += 1
+
+                progress += 1
+                if progress % SEED_STEP == 0:
+                    transaction.commit()
+
+            transaction.commit()
+
+        _logger.info(
+            "Completed seeding MVT cache (%d tiles processed, %d rendered)",
+            progress, rendered)
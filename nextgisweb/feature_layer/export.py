@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import zipfile
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import backports.tempfile
+import transaction
+from osgeo import gdal
+
+from .. import db
+from ..env import env
+from ..models import DBSession
+from ..resource import ValidationError
+from ..spatial_ref_sys import SRS
+
+from .interface import (
+    IFeatureLayerRevision,
+    IFeatureQueryClipByBox,
+    IFeatureQueryIntersects,
+    IFeatureQuerySimplify)
+from .model import FeatureLayerExport
+from .ogrdriver import EXPORT_FORMAT_OGR
+from .stream import STREAM_WRITERS, zip_stream
+from .util import _
+
+_logger = logging.getLogger(__name__)
+
+
+def _ogr_memory_ds():
+    return gdal.GetDriverByName(b'Memory').Create(
+        b'', 0, 0, 0, gdal.GDT_Unknown)
+
+
+def _ogr_layer_from_features(layer, features, name=b'', ds=None, fid=None):
+    ogr_layer = layer.to_ogr(ds, name=name, fid=fid)
+    layer_defn = ogr_layer.GetLayerDefn()
+
+    for f in features:
+        ogr_layer.CreateFeature(
+            f.to_ogr(layer_defn, fid=fid))
+
+    return ogr_layer
+
+
+def apply_geom_options(query, simplify=None, clip=None):
+    """ Push geometry simplification and clipping down to the query, they
+    are applied to geometries in the query SRS.
+
+    :param simplify: Simplification tolerance in units of the query SRS.
+    :param clip: Clipping box geometry, see :py:func:`..geometry.box`.
+        Features outside the box are skipped. """
+
+    if simplify is not None:
+        if not IFeatureQuerySimplify.providedBy(query):
+            raise ValidationError(_("Geometry simplification is not supported."))
+        query.simplify(simplify)
+
+    if clip is not None:
+        if not (
+            IFeatureQueryClipByBox.providedBy(query)
+            and IFeatureQueryIntersects.providedBy(query)
+        ):
+            raise ValidationError(_("Geometry clipping is not supported."))
+        query.intersects(clip)
+        query.clip_by_box(clip)
+
+
+def export_body(
+    resource, format, srs, fid=None, encoding=None, zipped=True,
+    geom=True, precision=None, simplify=None, clip=None,
+):
+    """ Export features of the resource to one of EXPORT_FORMAT_OGR formats.
+
+    Geometry options are supported only for formats from STREAM_WRITERS:
+    geometry can be omitted with ``geom=False`` and rounded to ``precision``
+    decimal digits, for ``simplify`` and ``clip`` see
+    :py:func:`apply_geom_options`.
+
+    :return: Tuple ``(filename, content_type, body)``, where body is an
+        iterable of byte strings. For formats from STREAM_WRITERS the body is
+        a generator, which reads features while it's iterated. """
+
+    driver = EXPORT_FORMAT_OGR[format]
+    name = '%d' % resource.id
+
+    if format in STREAM_WRITERS:
+        query = resource.feature_query()
+        if geom:
+            query.geom()
+        query.srs(srs)
+        apply_geom_options(query, simplify=simplify, clip=clip)
+
+        writer = STREAM_WRITERS[format](
+            resource, srs, fid=fid, encoding=encoding, precision=precision)
+        files = writer.files(query(), name)
+
+        if zipped:
+            return (
+                '%s.%s.zip' % (name, driver.extension),
+                'application/zip', zip_stream(files))
+        else:
+            # Only the main file is sent without zip compression
+            filename, body = files[0]
+            return (
+                filename, driver.mime or 'application/octet-stream', body)
+
+    # layer creation options
+    lco = list(driver.options or [])
+
+    if encoding is not None:
+        lco.append("ENCODING=%s" % encoding)
+
+    if not geom or (precision, simplify, clip) != (None, None, None):
+        raise ValidationError(_(
+            "Geometry options are not supported for format '%s'.") % format)
+
+    query = resource.feature_query()
+    query.geom()
+
+    ogr_ds = _ogr_memory_ds()
+    _ogr_layer_from_features(resource, query(), ds=ogr_ds, fid=fid)
+
+    buf = BytesIO()
+
+    with backports.tempfile.TemporaryDirectory() as temp_dir:
+        filename = "%s.%s" % (name, driver.extension)
+
+        vtopts = [
+            '-f', driver.name,
+            '-t_srs', srs.wkt,
+        ] + list(itertools.chain(*[('-lco', o) for o in lco]))
+
+        if driver.fid_support and fid is None:
+            vtopts.append('-preserve_fid')
+
+        gdal.VectorTranslate(
+            os.path.join(temp_dir, filename), ogr_ds,
+            options=gdal.VectorTranslateOptions(options=vtopts)
+        )
+
+        if zipped or not driver.single_file:
+            with zipfile.ZipFile(
+                buf, "w", zipfile.ZIP_DEFLATED
+            ) as zipf:
+                for root, dirs, files in os.walk(temp_dir):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        zipf.write(
+                            path, os.path.basename(path)
+                        )
+
+            content_type = "application/zip"
+            filename = "%s.zip" % (filename,)
+
+        else:
+            content_type = (
+                driver.mime or "application/octet-stream"
+            )
+            with open(
+                os.path.join(temp_dir, filename)
+            ) as f:
+                buf.write(f.read())
+
+    return filename, content_type, [buf.getvalue(), ]
+
+
+def export_revision(resource):
+    """ Data revision used as a cache key or None if the resource doesn't
+    provide it and results can't be reused. Field definitions are included
+    as they aren't covered by data revision, but change exported columns. """
+
+    if IFeatureLayerRevision.providedBy(resource):
+        fields = ','.join(
+            '%s:%s' % (f.keyname, f.datatype) for f in resource.fields)
+        return '%s.%s' % (
+            resource.data_revision,
+            hashlib.md5(fields.encode('utf-8')).hexdigest())
+    return None
+
+
+def _export_job_params(resource, format, srs, fid, encoding, zipped):
+    return (
+        FeatureLayerExport.resource_id == resource.id,
+        FeatureLayerExport.format == format,
+        FeatureLayerExport.srs_id == srs.id,
+        FeatureLayerExport.fid == fid,
+        FeatureLayerExport.encoding == encoding,
+        FeatureLayerExport.zipped == zipped)
+
+
+def export_job_cached(resource, format, srs, fid, encoding, zipped):
+    """ Finished export job with the same parameters and the current data
+    revision of the resource or None """
+
+    revision = export_revision(resource)
+    if revision is None:
+        return None
+
+    return FeatureLayerExport.filter(
+        FeatureLayerExport.revision == revision,
+        FeatureLayerExport.status == 'done',
+        *_export_job_params(resource, format, srs, fid, encoding, zipped)
+    ).order_by(FeatureLayerExport.id.desc()).first()
+
+
+def export_job_active(resource, format, srs, fid, encoding, zipped):
+    """ Pending or running export job with the same parameters, which result
+    will be the same as of a new job, or None. Running job is suitable only if
+    it was started with the current data revision. """
+
+    revision = export_revision(resource)
+
+    jobs = FeatureLayerExport.filter(
+        FeatureLayerExport.status.in_(('pending', 'running')),
+        *_export_job_params(resource, format, srs, fid, encoding, zipped)
+    ).order_by(FeatureLayerExport.id.desc())
+
+    for job in jobs:
+        if export_job_stale(job):
+            continue
+        if job.status == 'pending' or job.revision == revision:
+            return job
+
+    return None
+
+
+def export_job_stale(job):
+    """ Mark the pending or running job as failed if it isn't finished within
+    ``export.timeout`` seconds. Jobs are executed inside web server
+    processes, so the job is lost if its process is restarted.
+
+    :return: True if the job was marked as failed. """
+
+    if job.status not in ('pending', 'running'):
+        return False
+
+    timeout = timedelta(seconds=env.feature_layer.settings['export.timeout'])
+    if job.created + timeout > datetime.utcnow():
+        return False
+
+    job.status = 'failed'
+    job.error = "Export job timed out."
+    job.finished = datetime.utcnow()
+    return True
+
+
+def export_job_run(job_id):
+    """ Produce export job result file, executed in a separate thread """
+
+    with transaction.manager:
+        job = FeatureLayerExport.filter_by(id=job_id).one()
+        job.status = 'running'
+        job.revision = export_revision(job.resource)
+
+    try:
+        with transaction.manager:
+            job = FeatureLayerExport.filter_by(id=job_id).one()
+            resource = job.resource
+            srs = SRS.filter_by(id=job.srs_id).one()
+
+            revision = export_revision(resource)
+            filename, content_type, body = export_body(
+                resource, job.format, srs, fid=job.fid,
+                encoding=job.encoding, zipped=job.zipped)
+
+            fileobj = env.file_storage.fileobj(component='feature_layer')
+            with open(env.file_storage.filename(
+                fileobj, makedirs=True), 'wb') as fd:
+                for chunk in body:
+                    fd.write(chunk)
+
+            job.fileobj = fileobj
+            job.filename = filename
+            job.content_type = content_type
+            job.revision = revision
+            job.status = 'done'
+            job.finished = datetime.utcnow()
+
+            _export_job_evict(job)
+
+    except Exception as exc:
+        _logger.exception("Export job %d failed", job_id)
+        with transaction.manager:
+            job = FeatureLayerExport.filter_by(id=job_id).one()
+            job.status = 'failed'
+            job.error = unicode(exc)
+            job.finished = datetime.utcnow()
+
+
+def _export_job_evict(job):
+    """ Remove results of jobs which will never be reused: jobs with the same
+    parameters and other data revision, and jobs of resources without data
+    revision or failed jobs, which were finished more than ``export.ttl``
+    seconds ago """
+
+    query = FeatureLayerExport.filter(FeatureLayerExport.id != job.id)
+
+    stale = []
+    if job.revision is not None:
+        stale.extend(query.filter(
+            FeatureLayerExport.resource_id == job.resource_id,
+            FeatureLayerExport.format == job.format,
+            FeatureLayerExport.srs_id == job.srs_id,
+            FeatureLayerExport.fid == job.fid,
+            FeatureLayerExport.encoding == job.encoding,
+            FeatureLayerExport.zipped == job.zipped,
+            FeatureLayerExport.revision != job.revision,
+            FeatureLayerExport.status == 'done',
+        ).all())
+
+    expired = datetime.utcnow() - timedelta(
+        seconds=env.feature_layer.settings['export.ttl'])
+    stale.extend(query.filter(
+        db.or_(
+            FeatureLayerExport.revision == None,  # NOQA: E711
+            FeatureLayerExport.status == 'failed'),
+        FeatureLayerExport.status.in_(('done', 'failed')),
+        FeatureLayerExport.finished < expired,
+    ).all())
+
+    for item in stale:
+        fileobj = item.fileobj
+        DBSession.delete(item)
+        if fileobj is None:
+            continue
+
+        filename = env.file_storage.filename(fileobj)
+        DBSession.delete(fileobj)
+
+        def remove(success, filename=filename):
+            if success and os.path.isfile(filename):
+                os.remove(filename)
+
+        transaction.get().addAfterCommitHook(remove)
+
+
+def export_job_schedule(job_id):
+    """ Start export job in a background thread after the current
+    transaction is committed. The number of concurrent jobs is limited by
+    ``export.workers`` setting. """
+
+    def run():
+        with env.feature_layer.export_semaphore:
+            try:
+                export_job_run(job_id)
+            finally:
+                DBSession.remove()
+
+    def start(success):
+        if success:
+            thread = threading.Thread(
+                target=run, name='export-job-%d' % job_id)
+            thread.daemon = True
+            thread.start()
+
+    transaction.get().addAfterCommitHook(start)
@@ -12,3 +12,10 @@ class FeatureExtension(object):
     @property
     def layer(self):
         return self._layer
+
+    def serialize_many(self, features):
+        """ Serialize extension data of several features at once, returns a
+        list of values in the same order as features. Extensions should
+        override it to fetch data of all features with a single query. """
+
+        return [self.serialize(feature) for feature in features]
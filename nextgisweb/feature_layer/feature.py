@@ -91,6 +91,12 @@ class FeatureSet(object):
         data = list(self.__iter__())
         return data[0]
 
+    def count(self, mode=None):
+        """ Feature count according to COUNT_MODE, implementations
+        which don't support estimated or cached counts return exact
+        count in any mode. """
+        return self.total_count
+
     @property
     def __geo_interface__(self):
         return dict(
@@ -3,6 +3,7 @@
 from pyramid.response import Response
 
 from .interface import IFeatureLayer
+from .pool import query_map
 from .. import geojson
 from ..geometry import geom_from_wkt
 from ..models import DBSession
@@ -66,6 +67,7 @@ def identify(request):
     # Number of features in all layers
     feature_count = 0
 
+    queried = []
     for layer in layer_list:
         if not setting_disable_check and not layer.has_permission(DataScope.read, request.user):
             result[layer.id] = dict(error="Forbidden")
@@ -74,36 +76,45 @@ def identify(request):
             result[layer.id] = dict(error="Not implemented")
 
         else:
-            query = layer.feature_query()
-            query.intersects(geom)
-
-            # Limit number of identifyable features by 10 per layer,
-            # otherwise the response might be too big.
-            query.limit(10)
-
-            features = [
-                dict(id=f.id, layerId=layer.id,
-                     label=f.label, fields=f.fields)
-                for f in query()
-            ]
-
-            # Add name of parent resource to identification results,
-            # if there is no way to get layer name by id on the client
-            if not setting_disable_check:
-                allow = layer.parent.has_permission(PR_R, request.user)
-            else:
-                allow = True
-
-            if allow:
-                for feature in features:
-                    feature['parent'] = layer.parent.display_name
-
-            result[layer.id] = dict(
-                features=features,
-                featureCount=len(features)
-            )
-
-            feature_count += len(features)
+            queried.append(layer)
+
+    def layer_features(layer_id):
+        layer = Resource.filter_by(id=layer_id).one()
+
+        query = layer.feature_query()
+        query.intersects(geom)
+
+        # Limit number of identifyable features by 10 per layer,
+        # otherwise the response might be too big.
+        query.limit(10)
+
+        return [
+            dict(id=f.id, layerId=layer.id,
+                 label=f.label, fields=f.fields)
+            for f in query()
+        ]
+
+    # Layers are queried concurrently, each one in a separate thread
+    layer_results = query_map(layer_features, [layer.id for layer in queried])
+
+    for layer, features in zip(queried, layer_results):
+        # Add name of parent resource to identification results,
+        # if there is no way to get layer name by id on the client
+        if not setting_disable_check:
+            allow = layer.parent.has_permission(PR_R, request.user)
+        else:
+            allow = True
+
+        if allow:
+            for feature in features:
+                feature['parent'] = layer.parent.display_name
+
+        result[layer.id] = dict(
+            features=features,
+            featureCount=len(features)
+        )
+
+        feature_count += len(features)
 
     result['featureCount'] = feature_count
 
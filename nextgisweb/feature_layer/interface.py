@@ -59,6 +59,14 @@ class FIELD_TYPE(object):
     enum = (INTEGER, BIGINT, REAL, STRING, DATE, TIME, DATETIME)
 
 
+class COUNT_MODE(object):
+    EXACT = 'exact'
+    ESTIMATE = 'estimate'
+    CACHED = 'cached'
+
+    enum = (EXACT, ESTIMATE, CACHED)
+
+
 class IFeatureLayer(IResourceBase):
 
     geometry_type = Attribute(""" Layer geometry type GEOM_TYPE """)
@@ -96,6 +104,31 @@ class IWritableFeatureLayer(IFeatureLayer):
     def feature_put(self, feature):
         """ Save feature in a layer """
 
+    def feature_create_many(self, features):
+        """ Create new features with a single query
+
+        :param features: list of feature descriptions
+
+        :return:        list of IDs of new features in the same order
+        """
+
+    def feature_put_many(self, features):
+        """ Save many features in a layer with a minimal number of
+        queries, only fields set in features are updated """
+
+    def feature_delete_many(self, feature_ids):
+        """ Remove features with ids
+
+        :param feature_ids: list of feature ids
+        """
+
+
+class IFeatureLayerRevision(IFeatureLayer):
+
+    data_revision = Attribute(
+        """ Value which changes each time layer data is changed, results
+        derived from layer data can be cached with it as a key """)
+
 
 class IFeatureQuery(Interface):
 
@@ -136,6 +169,14 @@ class IFeatureQueryOrderBy(IFeatureQuery):
         """ Set sort order """
 
 
+class IFeatureQueryKeyset(IFeatureQuery):
+
+    def after(self, id, values=None):
+        """ Set query to return features following the feature with given id
+        (keyset pagination). If sort order is set, values of sort fields of
+        that feature should be passed in the same order. """
+
+
 class IFeatureQueryLike(IFeatureQuery):
 
     def like(self, value):
@@ -158,3 +199,39 @@ class IFeatureQuerySimplify(IFeatureQuery):
 
     def simplify(self, tolerance):
         """ Simplify geometry by the given tolerance """
+
+
+class IFeatureQueryTotalCount(IFeatureQuery):
+
+    def with_total_count(self):
+        """ Select total number of features matching the query with
+        features of the page, so ``total_count`` of the feature set doesn't
+        run a separate query after the feature set is iterated. It's as
+        expensive as exact count, as all matching features are counted. """
+
+
+class IFeatureQueryMVT(IFeatureQuery):
+
+    def mvt(self, bounds, extent, buffer, name):
+        """ Render features to a Mapbox vector tile layer on the database
+        side and return its content as byte string. Features are not
+        filtered by bounds, so intersects should be set.
+
+        :param bounds: Tile bounds ``(minx, miny, maxx, maxy)`` in EPSG:3857.
+        :param extent: Tile extent in screen units.
+        :param buffer: Buffer around the tile in screen units.
+        :param name: Name of the tile layer.
+        :return: Tile layer content or None if the database doesn't support
+            ST_AsMVT, then features should be read and encoded another way.
+        """
+
+
+class IFeatureQueryTiles(IFeatureQuery):
+
+    def tiles(self, zoom, buffer=0):
+        """ Tiles of the query SRS tile grid at the zoom level, which
+        intersect geometries of features, as a list of ``(x, y)`` tuples.
+        It's used to skip empty tiles, for example while seeding tile cache.
+
+        :param zoom: Zoom level of the tile grid.
+        :param buffer: Buffer around tiles as a fraction of tile size. """
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from collections import OrderedDict
+from datetime import datetime
 
 from osgeo import ogr, osr
 from sqlalchemy.ext.declarative import declared_attr
@@ -13,6 +14,7 @@ from ..resource import (
     Serializer,
     SerializedProperty as SP)
 from ..resource.exception import ValidationError
+from ..file_storage import FileObj
 
 from .interface import (
     FIELD_TYPE,
@@ -24,6 +26,8 @@ Base = declarative_base()
 
 _FIELD_TYPE_2_ENUM_REVERSED = dict(zip(FIELD_TYPE.enum, FIELD_TYPE_OGR))
 
+EXPORT_STATUS_ENUM = ('pending', 'running', 'done', 'failed')
+
 
 class LayerField(Base):
     __tablename__ = 'layer_field'
@@ -177,3 +181,68 @@ class FeatureLayerSerializer(Serializer):
     resclass = LayerFieldsMixin
 
     fields = _fields_attr(read=P_DSS_READ, write=P_DSS_WRITE)
+
+
+class FeatureLayerExport(Base):
+    """ Asynchronous export job, finished jobs of layers which provide data
+    revision are reused as a cache while layer data isn't changed """
+
+    __tablename__ = 'feature_layer_export'
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.ForeignKey(
+        Resource.id, ondelete='CASCADE'), nullable=False)
+    format = db.Column(db.Unicode, nullable=False)
+    srs_id = db.Column(db.Integer, nullable=False)
+    encoding = db.Column(db.Unicode)
+    fid = db.Column(db.Unicode)
+    zipped = db.Column(db.Boolean, nullable=False)
+    revision = db.Column(db.Unicode)
+    status = db.Column(
+        db.Enum(*EXPORT_STATUS_ENUM), nullable=False, default='pending')
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished = db.Column(db.DateTime)
+    error = db.Column(db.Unicode)
+    filename = db.Column(db.Unicode)
+    content_type = db.Column(db.Unicode)
+    fileobj_id = db.Column(db.ForeignKey(FileObj.id))
+
+    resource = db.relationship(Resource)
+    fileobj = db.relationship(FileObj)
+
+    def to_dict(self):
+        return OrderedDict((
+            ('id', self.id),
+            ('status', self.status),
+            ('format', self.format),
+            ('srs', self.srs_id),
+            ('encoding', self.encoding),
+            ('fid', self.fid),
+            ('zipped', self.zipped),
+            ('created', self.created.isoformat()),
+            ('finished', self.finished.isoformat()
+             if self.finished is not None else None),
+            ('error', self.error),
+        ))
+
+
+class FeatureLayerMVTCache(Base):
+    """ Index of cached MVT tiles, content of non-empty tiles is stored in
+    SQLite databases, see :py:class:`nextgisweb.feature_layer.mvt.MVTCache` """
+
+    __tablename__ = 'feature_layer_mvt_cache'
+
+    key = db.Column(db.Unicode, primary_key=True)
+    z = db.Column(db.SmallInteger, primary_key=True)
+    x = db.Column(db.Integer, primary_key=True)
+    y = db.Column(db.Integer, primary_key=True)
+    resources = db.Column(db.ARRAY(db.Integer), nullable=False)
+    empty = db.Column(db.Boolean, nullable=False)
+    # Same as in the raster tile cache, seconds since epoch
+    tstamp = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index(
+            'feature_layer_mvt_cache_resources_idx', resources,
+            postgresql_using='gin'),
+    )
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+""" Mapbox vector tiles of feature layers and the server-side cache of them,
+which is invalidated when data of layers is changed. """
+from __future__ import unicode_literals
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+from errno import EEXIST
+
+from osgeo import ogr, gdal
+from zope.sqlalchemy import mark_changed
+
+from .. import db
+from ..env import env
+from ..geometry import box
+from ..models import DBSession
+from ..resource import Resource
+from ..spatial_ref_sys import SRS
+
+from .event import on_data_change
+from .export import _ogr_layer_from_features
+from .interface import (
+    IFeatureQueryClipByBox,
+    IFeatureQuerySimplify,
+    IFeatureQueryMVT)
+from .pool import query_map
+
+TIMESTAMP_EPOCH = datetime(year=1970, month=1, day=1)
+
+
+def _ogr_ds(driver, options):
+    return ogr.GetDriverByName(driver).CreateDataSource(
+        "/vsimem/%s" % uuid.uuid4(), options=options
+    )
+
+
+def mvt_tile(resids, tile, extent, simplification, padding):
+    """ Encode features of resources intersecting the tile in EPSG:3857
+    tile grid, each resource becomes a tile layer named ``ngw:{id}``.
+    Resources are queried concurrently, see :py:func:`.pool.query_map`.
+
+    :return: Tile content, empty byte string if there are no features. """
+
+    z, x, y = tile
+
+    # web mercator
+    merc = SRS.filter_by(id=3857).one()
+    minx, miny, maxx, maxy = merc.tile_extent((z, x, y))
+
+    bbox = (
+        minx - (maxx - minx) * padding,
+        miny - (maxy - miny) * padding,
+        maxx + (maxx - minx) * padding,
+        maxy + (maxy - miny) * padding,
+    )
+    bbox = box(*bbox, srid=merc.id)
+
+    def layer_content(resid):
+        obj = Resource.filter_by(id=resid).one()
+
+        query = obj.feature_query()
+        query.intersects(bbox)
+
+        if IFeatureQuerySimplify.providedBy(query):
+            tolerance = ((obj.srs.maxx - obj.srs.minx) / (1 << z)) / extent
+            query.simplify(tolerance * simplification)
+
+        # Tiles are encoded in the database with ST_AsMVT where it's
+        # possible, other layers are written with OGR MVT driver.
+        if IFeatureQueryMVT.providedBy(query):
+            content = query.mvt(
+                (minx, miny, maxx, maxy), extent, int(extent * padding),
+                "ngw:%d" % obj.id)
+            if content is not None:
+                return content
+
+        query.geom()
+
+        if IFeatureQueryClipByBox.providedBy(query):
+            query.clip_by_box(bbox)
+
+        ds = _ogr_ds(b"MVT", [
+            "FORMAT=DIRECTORY",
+            "TILE_EXTENSION=pbf",
+            "MINZOOM=%d" % z,
+            "MAXZOOM=%d" % z,
+            "EXTENT=%d" % extent,
+            "COMPRESS=NO",
+        ])
+
+        _ogr_layer_from_features(
+            obj, query(), name=b"ngw:%d" % obj.id, ds=ds)
+
+        vsibuf = ds.GetName()
+
+        # flush changes
+        ds = None
+
+        filepath = os.path.join(
+            "%s" % vsibuf, "%d" % z, "%d" % x, "%d.pbf" % y
+        )
+
+        try:
+            f = gdal.VSIFOpenL(b"%s" % (filepath,), b"rb")
+
+            if f is None:
+                return b""
+
+            # SEEK_END = 2
+            gdal.VSIFSeekL(f, 0, 2)
+            size = gdal.VSIFTellL(f)
+
+            # SEEK_SET = 0
+            gdal.VSIFSeekL(f, 0, 0)
+            content = gdal.VSIFReadL(1, size, f)
+            gdal.VSIFCloseL(f)
+
+            return content
+
+        finally:
+            gdal.Unlink(b"%s" % (vsibuf,))
+
+    # Tile is a sequence of layers in protobuf encoding, so tiles of
+    # separate layers can be just concatenated.
+    return b"".join(query_map(layer_content, resids))
+
+
+class MVTCache(object):
+    """ Cache of tiles with the same set of resources and encoding
+    parameters. Like in the raster tile cache, tile index is stored in
+    PostgreSQL table and content of non-empty tiles in SQLite database. """
+
+    _local = threading.local()
+
+    def __init__(self, resids, extent, simplification, padding):
+        self.resids = list(resids)
+        self.key = hashlib.md5((
+            ','.join(map(unicode, self.resids))
+            + ':%d:%r:%r' % (extent, simplification, padding)
+        ).encode('utf-8')).hexdigest()
+
+    @property
+    def tilestor(self):
+        # SQLite connections can't be shared between threads
+        conns = getattr(self._local, 'tilestor', None)
+        if conns is None:
+            conns = self._local.tilestor = dict()
+
+        conn = conns.get(self.key)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.tilestor_path(create=True), isolation_level=None)
+            conn.text_factory = bytes
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tile (
+                    z INTEGER, x INTEGER, y INTEGER,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (z, x, y)
+                )
+            """)
+            conns[self.key] = conn
+
+        return conn
+
+    def tilestor_path(self, create=False):
+        tcpath = env.feature_layer.mvt_cache_path
+        d = os.path.join(tcpath, self.key[0:2], self.key[2:4])
+        if create and not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError as exc:
+                # Ignore 'File exists' error in concurency conditions
+                if exc.errno != EEXIST:
+                    raise
+
+        return os.path.join(d, self.key)
+
+    def get_tile(self, tile):
+        """ Cached tile content or None if the tile isn't cached """
+
+        z, x, y = tile
+
+        trow = DBSession.connection().execute(db.sql.text(
+            'SELECT empty, tstamp FROM feature_layer_mvt_cache '
+            'WHERE key = :key AND z = :z AND x = :x AND y = :y'
+        ), key=self.key, z=z, x=x, y=y).fetchone()
+
+        if trow is None:
+            return None
+
+        empty, tstamp = trow
+
+        ttl = env.feature_layer.settings['mvt_cache.ttl']
+        if ttl is not None:
+            expdt = TIMESTAMP_EPOCH + timedelta(seconds=tstamp + ttl)
+            if expdt <= datetime.utcnow():
+                return None
+
+        if empty:
+            return b''
+
+        srow = self.tilestor.execute(
+            'SELECT data FROM tile WHERE z = ? AND x = ? AND y = ?',
+            (z, x, y)).fetchone()
+
+        return srow[0] if srow is not None else None
+
+    def put_tile(self, tile, content):
+        z, x, y = tile
+        tstamp = int((datetime.utcnow() - TIMESTAMP_EPOCH).total_seconds())
+
+        empty = len(content) == 0
+        if not empty:
+            # Content of the invalidated tile may be still there
+            self.tilestor.execute(
+                'INSERT OR REPLACE INTO tile VALUES (?, ?, ?, ?)',
+                (z, x, y, sqlite3.Binary(content)))
+
+        DBSession.connection().execute(db.sql.text(
+            'INSERT INTO feature_layer_mvt_cache '
+            '(key, z, x, y, resources, empty, tstamp) '
+            'VALUES (:key, :z, :x, :y, :resources, :empty, :tstamp) '
+            'ON CONFLICT (key, z, x, y) DO UPDATE '
+            'SET empty = EXCLUDED.empty, tstamp = EXCLUDED.tstamp'
+        ), key=self.key, z=z, x=x, y=y, resources=self.resids,
+            empty=empty, tstamp=tstamp)
+
+        # Force zope session management to commit changes
+        mark_changed(DBSession())
+
+
+def mvt_cache_invalidate(resource, geom=None):
+    """ Remove cached tiles which contain the resource and intersect the
+    geometry bounds or all tiles of the resource if geometry isn't set """
+
+    conn = DBSession.connection()
+
+    if geom is None:
+        conn.execute(db.sql.text(
+            'DELETE FROM feature_layer_mvt_cache '
+            'WHERE resources @> ARRAY[:rid]'
+        ), rid=resource.id)
+
+    elif not geom.is_empty:
+        merc = SRS.filter_by(id=3857).one()
+
+        # Bounds are transformed to EPSG:3857 through EPSG:4326 clipped by
+        # the valid area of web mercator, which isn't defined at poles.
+        envelope = 'ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, :srid)'
+        if resource.srs_id != 3857:
+            envelope = (
+                'ST_Transform(ST_Intersection(ST_Transform({}, 4326), '
+                'ST_MakeEnvelope(-180, -85.0511, 180, 85.0511, 4326)), 3857)'
+            ).format(envelope)
+
+        # Tiles next to the bounds are removed too as they contain features
+        # within the padding area.
+        conn.execute(db.sql.text(
+            'DELETE FROM feature_layer_mvt_cache c '
+            'USING (SELECT ST_XMin(e) AS minx, ST_YMin(e) AS miny, '
+            '    ST_XMax(e) AS maxx, ST_YMax(e) AS maxy '
+            '    FROM (SELECT {} AS e) s) b '
+            'WHERE c.resources @> ARRAY[:rid] '
+            '    AND c.x BETWEEN floor((b.minx - :x0) / :size * 2 ^ c.z) - 1 '
+            '        AND floor((b.maxx - :x0) / :size * 2 ^ c.z) + 1 '
+            '    AND c.y BETWEEN floor((:y0 - b.maxy) / :size * 2 ^ c.z) - 1 '
+            '        AND floor((:y0 - b.miny) / :size * 2 ^ c.z) + 1'
+            .format(envelope)
+        ), rid=resource.id, srid=resource.srs_id,
+            x0=merc.minx, y0=merc.maxy, size=merc.maxx - merc.minx,
+            **dict(zip(('minx', 'miny', 'maxx', 'maxy'), geom.bounds)))
+
+    mark_changed(DBSession())
+
+
+@on_data_change.connect
+def on_data_change_handler(resource, geom):
+    if env.feature_layer.settings['mvt_cache.enabled']:
+        mvt_cache_invalidate(resource, geom)
+
+
+@db.event.listens_for(Resource, 'after_delete', propagate=True)
+def _mvt_cache_resource_delete(mapper, connection, target):
+    # Tiles of deleted resource can't be requested anymore
+    connection.execute(db.sql.text(
+        'DELETE FROM feature_layer_mvt_cache '
+        'WHERE resources @> ARRAY[:rid]'
+    ), rid=target.id)
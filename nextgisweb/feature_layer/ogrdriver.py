@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import collections
 
+from osgeo import ogr
+
 
 EXPORT_FORMAT_OGR = {}
 
@@ -26,6 +28,15 @@ EXPORT_FORMAT_OGR["GEOJSON"] = OGRDriver(
     mime="application/json",
 )
 
+EXPORT_FORMAT_OGR["GEOJSONS"] = OGRDriver(
+    "GeoJSONSeq",
+    "geojsons",
+    single_file=True,
+    fid_support=True,
+    options=None,
+    mime="application/geo+json-seq",
+)
+
 EXPORT_FORMAT_OGR["CSV"] = OGRDriver(
     "CSV",
     "csv",
@@ -67,6 +78,26 @@ EXPORT_FORMAT_OGR["SHP"] = OGRDriver(
     mime=None,
 )
 
+EXPORT_FORMAT_OGR["GPKG"] = OGRDriver(
+    "GPKG",
+    "gpkg",
+    single_file=True,
+    fid_support=True,
+    options=None,
+    mime="application/geopackage+sqlite3",
+)
+
+# FlatGeobuf driver is available since GDAL 3.1
+if ogr.GetDriverByName("FlatGeobuf") is not None:
+    EXPORT_FORMAT_OGR["FGB"] = OGRDriver(
+        "FlatGeobuf",
+        "fgb",
+        single_file=True,
+        fid_support=False,
+        options=("SPATIAL_INDEX=YES", ),
+        mime="application/flatgeobuf",
+    )
+
 OGR_DRIVER_NAME_2_EXPORT_FORMATS = [
     {
         "name": format.name,
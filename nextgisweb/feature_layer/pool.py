@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Thread pool for concurrent per-resource queries, so requests for several
+resources cost about the slowest one instead of the sum of them. """
+from __future__ import unicode_literals
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import transaction
+
+from ..env import env
+from ..models import DBSession
+
+_logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool_workers():
+    """ Number of pool threads. Each running task holds a database
+    connection in addition to the connection of the request thread, so
+    threads are limited by the size of SQLAlchemy connection pool and its
+    overflow is left for request threads. Otherwise bursts of multi-layer
+    requests would wait for connections and fail with QueuePool timeout. """
+
+    workers = env.feature_layer.settings['query.workers']
+
+    size = getattr(env.core.engine.pool, 'size', None)
+    if size is not None and workers > size():
+        _logger.warning(
+            "Query workers are limited by connection pool size %d", size())
+        workers = size()
+
+    return workers
+
+
+def _get_pool():
+    global _pool
+    # Pool is created on demand, so it belongs to the worker process in
+    # case of pre-forking servers.
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(pool_workers())
+        return _pool
+
+
+def _isolated(func):
+    def wrapped(item):
+        # DBSession is thread-local, so a separate session and connection
+        # are used in a read-only transaction, which is always aborted.
+        transaction.begin()
+        try:
+            return func(item)
+        finally:
+            transaction.abort()
+            DBSession.remove()
+
+    return wrapped
+
+
+def query_map(func, items):
+    """ Apply func to each of items concurrently in the thread pool and
+    return a list of results in the same order.
+
+    Functions are executed outside of the request transaction, so they
+    should load objects by their IDs and shouldn't return ORM objects.
+    Exceptions are raised in the calling thread. If there is only one item
+    or the pool is disabled with ``query.workers = 1``, functions are
+    executed in the calling thread. """
+
+    items = list(items)
+    if len(items) <= 1 or env.feature_layer.settings['query.workers'] <= 1:
+        return map(func, items)
+
+    return _get_pool().map(_isolated(func), items, chunksize=1)
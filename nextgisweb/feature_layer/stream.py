@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+""" Streaming export of features, where the response body is produced while
+features are read from the database, so memory usage doesn't depend on
+the number of features. """
+from __future__ import unicode_literals
+import csv
+import json
+import os.path
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, time as dtime, datetime
+from io import BytesIO
+
+from osgeo import ogr, osr
+from shapely import wkt
+from shapely.geometry import mapping, shape
+
+from ..geojson import round_geometry
+from .interface import (
+    gdal_gt_22,
+    FIELD_TYPE,
+    FIELD_TYPE_OGR,
+    GEOM_TYPE,
+    GEOM_TYPE_OGR)
+
+# Approximate size of response body chunks
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _chunked(parts, size=STREAM_CHUNK_SIZE):
+    """ Join small byte strings into chunks of about size bytes """
+
+    buf, buflen = [], 0
+    for part in parts:
+        buf.append(part)
+        buflen += len(part)
+        if buflen >= size:
+            yield b''.join(buf)
+            buf, buflen = [], 0
+
+    if buflen > 0:
+        yield b''.join(buf)
+
+
+def _json_value(value):
+    if isinstance(value, (date, dtime, datetime)):
+        return value.isoformat()
+    return value
+
+
+class StreamWriter(object):
+    """ Base class for streaming writers, a writer produces one or more
+    files, each file is an iterable of byte strings.
+
+    :param layer: Feature layer resource.
+    :param srs: Output SRS, features should be already in it.
+    :param fid: Name of the field to write feature IDs to. If it's not set,
+        feature IDs are written as feature identifiers if the format
+        supports them.
+    :param precision: Number of decimal digits of coordinates,
+        coordinates aren't rounded if it's not set. """
+
+    def __init__(self, layer, srs, fid=None, encoding=None, precision=None):
+        self.layer = layer
+        self.srs = srs
+        self.fid = fid
+        self.encoding = encoding
+        self.precision = precision
+
+        # Fields are copied, so the layer isn't accessed while streaming
+        self.fields = [(f.keyname, f.datatype) for f in layer.fields]
+
+    def files(self, features, name):
+        """ List of ``(filename, iterable)`` tuples, the first one is the
+        main file which is sent without zip compression. """
+        raise NotImplementedError()
+
+
+class GeoJSONWriter(StreamWriter):
+
+    def _feature(self, feature):
+        result = OrderedDict(type='Feature')
+        if self.fid is None:
+            result['id'] = feature.id
+
+        properties = OrderedDict()
+        for keyname, datatype in self.fields:
+            properties[keyname] = _json_value(feature.fields[keyname])
+        if self.fid is not None:
+            properties[self.fid] = feature.id
+
+        result['properties'] = properties
+        if feature.geom is not None:
+            geometry = mapping(feature.geom)
+            if self.precision is not None:
+                geometry = round_geometry(geometry, self.precision)
+            result['geometry'] = geometry
+        else:
+            result['geometry'] = None
+
+        return result
+
+    def _collection(self, features, name):
+        header = OrderedDict(type='FeatureCollection', name=name)
+        if self.srs.id != 4326:
+            header['crs'] = dict(type='name', properties=dict(
+                name='urn:ogc:def:crs:EPSG::%d' % self.srs.id))
+
+        yield json.dumps(header)[:-1] + b', "features": ['
+        for idx, feature in enumerate(features):
+            if idx > 0:
+                yield b',\n'
+            yield json.dumps(self._feature(feature))
+        yield b']}\n'
+
+    def files(self, features, name):
+        return [(name + '.geojson', _chunked(
+            self._collection(features, name))), ]
+
+
+class GeoJSONSeqWriter(GeoJSONWriter):
+
+    def _sequence(self, features):
+        for feature in features:
+            yield json.dumps(self._feature(feature)) + b'\n'
+
+    def files(self, features, name):
+        return [(name + '.geojsons', _chunked(self._sequence(features))), ]
+
+
+_CSVT_TYPES = {
+    FIELD_TYPE.INTEGER: 'Integer',
+    FIELD_TYPE.BIGINT: 'Integer64',
+    FIELD_TYPE.REAL: 'Real',
+    FIELD_TYPE.STRING: 'String',
+    FIELD_TYPE.DATE: 'Date',
+    FIELD_TYPE.TIME: 'Time',
+    FIELD_TYPE.DATETIME: 'DateTime',
+}
+
+
+class CSVWriter(StreamWriter):
+    """ CSV with geometry as WKT in GEOM column, same as OGR CSV driver
+    with ``GEOMETRY=AS_WKT`` and ``GEOMETRY_NAME=GEOM`` options """
+
+    def _encode(self, value):
+        if value is None:
+            return b''
+        elif isinstance(value, (date, dtime, datetime)):
+            value = value.isoformat()
+        elif not isinstance(value, basestring):
+            value = unicode(value)
+        return value.encode(self.encoding or 'utf-8', 'replace')
+
+    def _wkt(self, geom):
+        if geom is None:
+            return None
+        return wkt.dumps(geom, trim=True, rounding_precision=(
+            self.precision if self.precision is not None else -1))
+
+    def _header(self):
+        header = ['GEOM', ] + [keyname for keyname, datatype in self.fields]
+        if self.fid is not None:
+            header.append(self.fid)
+        return header
+
+    def _rows(self, features):
+        buf = BytesIO()
+        writer = csv.writer(buf)
+
+        def flush():
+            value = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return value
+
+        if (self.encoding or 'utf-8').lower().replace('-', '') == 'utf8':
+            yield b'\xef\xbb\xbf'
+
+        writer.writerow(map(self._encode, self._header()))
+        yield flush()
+
+        for feature in features:
+            row = [self._wkt(feature.geom), ] + [
+                feature.fields[keyname] for keyname, datatype in self.fields]
+            if self.fid is not None:
+                row.append(feature.id)
+
+            writer.writerow(map(self._encode, row))
+            yield flush()
+
+    def _csvt(self):
+        types = ['WKT', ] + [
+            _CSVT_TYPES[datatype] for keyname, datatype in self.fields]
+        if self.fid is not None:
+            types.append('Integer')
+        yield (','.join(['"%s"' % t for t in types]) + '\n').encode('utf-8')
+
+    def files(self, features, name):
+        return [
+            (name + '.csv', _chunked(self._rows(features))),
+            (name + '.csvt', self._csvt()),
+        ]
+
+
+class OGRFileWriter(StreamWriter):
+    """ Writer for formats which can't be written sequentially, like
+    GeoPackage, which is SQLite database, or FlatGeobuf with the spatial
+    index preceding features. Features are written to a temporary file with
+    OGR driver while they are read from the query, then the file is sent.
+    Unlike the export through OGR memory datasource, features aren't kept
+    in memory. """
+
+    driver = None
+    extension = None
+    options = ()
+
+    # Number of features written in one transaction
+    transaction_size = 10000
+
+    def __init__(self, layer, srs, fid=None, encoding=None, precision=None):
+        super(OGRFileWriter, self).__init__(
+            layer, srs, fid=fid, encoding=encoding, precision=precision)
+        self.geometry_type = GEOM_TYPE_OGR[
+            GEOM_TYPE.enum.index(layer.geometry_type)]
+
+    def _set_field(self, ogr_feature, idx, datatype, value):
+        if value is None:
+            if gdal_gt_22:
+                ogr_feature.SetFieldNull(idx)
+            else:
+                ogr_feature.UnsetField(idx)
+        elif datatype == FIELD_TYPE.DATE:
+            ogr_feature.SetField(
+                idx, value.year, value.month, value.day, 0, 0, 0, 0)
+        elif datatype == FIELD_TYPE.TIME:
+            ogr_feature.SetField(
+                idx, 0, 0, 0, value.hour, value.minute, value.second, 0)
+        elif datatype == FIELD_TYPE.DATETIME:
+            ogr_feature.SetField(
+                idx, value.year, value.month, value.day,
+                value.hour, value.minute, value.second, 0)
+        elif isinstance(value, unicode):
+            ogr_feature.SetField(idx, value.encode('utf-8'))
+        else:
+            ogr_feature.SetField(idx, value)
+
+    def _write(self, features, filename, name):
+        ds = ogr.GetDriverByName(self.driver.encode('utf-8')) \
+            .CreateDataSource(filename.encode('utf-8'))
+
+        osr_srs = osr.SpatialReference()
+        osr_srs.ImportFromWkt(self.srs.wkt.encode('utf-8'))
+
+        ogr_layer = ds.CreateLayer(
+            name.encode('utf-8'), srs=osr_srs, geom_type=self.geometry_type,
+            options=list(self.options))
+
+        for keyname, datatype in self.fields:
+            ogr_layer.CreateField(ogr.FieldDefn(
+                keyname.encode('utf-8'),
+                FIELD_TYPE_OGR[FIELD_TYPE.enum.index(datatype)]))
+        if self.fid is not None:
+            ogr_layer.CreateField(ogr.FieldDefn(
+                self.fid.encode('utf-8'), ogr.OFTInteger))
+
+        layer_defn = ogr_layer.GetLayerDefn()
+
+        # GeoPackage is much faster with batches of inserts in transactions
+        transactions = ogr_layer.TestCapability(ogr.OLCTransactions)
+        if transactions:
+            ogr_layer.StartTransaction()
+
+        for idx, feature in enumerate(features, start=1):
+            ogr_feature = ogr.Feature(layer_defn)
+
+            if self.fid is None:
+                ogr_feature.SetFID(feature.id)
+            else:
+                ogr_feature.SetField(self.fid.encode('utf-8'), feature.id)
+
+            if feature.geom is not None:
+                geom = feature.geom
+                if self.precision is not None:
+                    geom = shape(round_geometry(mapping(geom), self.precision))
+                ogr_feature.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+
+            for fidx, (keyname, datatype) in enumerate(self.fields):
+                self._set_field(
+                    ogr_feature, fidx, datatype, feature.fields[keyname])
+
+            ogr_layer.CreateFeature(ogr_feature)
+
+            if transactions and idx % self.transaction_size == 0:
+                ogr_layer.CommitTransaction()
+                ogr_layer.StartTransaction()
+
+        if transactions:
+            ogr_layer.CommitTransaction()
+
+        # Flush and close datasource
+        ogr_layer = ds = None
+
+    def _file(self, features, name):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, name + '.' + self.extension)
+            self._write(features, filename, name)
+
+            with open(filename, 'rb') as fd:
+                while True:
+                    chunk = fd.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def files(self, features, name):
+        return [(name + '.' + self.extension, self._file(features, name)), ]
+
+
+class GPKGWriter(OGRFileWriter):
+    driver = 'GPKG'
+    extension = 'gpkg'
+
+
+class FlatGeobufWriter(OGRFileWriter):
+    """ FlatGeobuf with packed Hilbert R-tree, which allows clients to read
+    features of the area with HTTP range requests """
+
+    driver = 'FlatGeobuf'
+    extension = 'fgb'
+    options = ('SPATIAL_INDEX=YES', )
+
+
+STREAM_WRITERS = dict(
+    GEOJSON=GeoJSONWriter,
+    GEOJSONS=GeoJSONSeqWriter,
+    CSV=CSVWriter,
+    GPKG=GPKGWriter,
+    FGB=FlatGeobufWriter,
+)
+
+
+def zip_stream(files, level=zlib.Z_DEFAULT_COMPRESSION):
+    """ Write ZIP archive to a stream without seeking, so it can be sent in
+    a response body while files are produced. Sizes and CRC of each member
+    are written after its data in a data descriptor. ZIP64 isn't supported,
+    so members and the archive are limited to 4 GB.
+
+    :param files: Iterable of ``(filename, iterable)`` tuples, where the
+        second item yields byte strings of the file content. """
+
+    ltime = time.localtime()
+    dosdate = (ltime[0] - 1980) << 9 | ltime[1] << 5 | ltime[2]
+    dostime = ltime[3] << 11 | ltime[4] << 5 | (ltime[5] // 2)
+
+    # Data descriptor is used and filenames are UTF-8 encoded
+    flags = 0x08 | 0x800
+
+    offset = 0
+    central = []
+
+    for filename, content in files:
+        filename = filename.encode('utf-8')
+
+        header = struct.pack(
+            b'<4s2B4HL2L2H', b'PK\003\004', 20, 0, flags,
+            8, dostime, dosdate, 0, 0, 0, len(filename), 0) + filename
+        yield header
+
+        crc, csize, usize = 0, 0, 0
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+        for chunk in content:
+            crc = zlib.crc32(chunk, crc)
+            usize += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                csize += len(data)
+                yield data
+
+        data = compressor.flush()
+        csize += len(data)
+        crc &= 0xffffffff
+
+        yield data + struct.pack(b'<4s3L', b'PK\007\010', crc, csize, usize)
+
+        central.append(struct.pack(
+            b'<4s4B4HL2L5H2L', b'PK\001\002', 20, 3, 20, 0, flags, 8,
+            dostime, dosdate, crc, csize, usize, len(filename), 0, 0, 0, 0,
+            0o644 << 16, offset) + filename)
+
+        offset += len(header) + csize + 16
+
+    cdir = b''.join(central)
+    yield cdir + struct.pack(
+        b'<4s4H2LH', b'PK\005\006', 0, 0, len(central), len(central),
+        len(cdir), offset, 0)
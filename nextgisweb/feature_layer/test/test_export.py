@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import json
+import os.path
+from datetime import datetime, timedelta
+from time import sleep
+from uuid import uuid4
+
+import pytest
+import transaction
+
+from nextgisweb.auth import User
+from nextgisweb.env import env
+from nextgisweb.feature_layer import FIELD_TYPE, Feature
+from nextgisweb.feature_layer import export
+from nextgisweb.feature_layer.export import (
+    apply_geom_options,
+    export_job_active,
+    export_job_cached,
+    export_job_run,
+    _export_job_evict)
+from nextgisweb.feature_layer.model import FeatureLayerExport
+from nextgisweb.file_storage import FileObj
+from nextgisweb.geometry import Point, box
+from nextgisweb.models import DBSession
+from nextgisweb.spatial_ref_sys import SRS
+from nextgisweb.vector_layer import VectorLayer
+
+PARAMS = dict(format='GEOJSON', fid=None, encoding=None, zipped=False)
+
+
+@pytest.fixture
+def layer(env):
+    with transaction.manager:
+        res = VectorLayer(
+            parent_id=0, display_name='export_job',
+            owner_user=User.by_keyname('administrator'),
+            geometry_type='POINT',
+            srs=SRS.filter_by(id=3857).one(),
+            tbl_uuid=unicode(uuid4().hex),
+        ).persist()
+
+        res.setup_from_fields([
+            dict(keyname='name', datatype=FIELD_TYPE.STRING), ])
+        DBSession.flush()
+
+        res.feature_create(Feature(
+            fields=dict(name='a'), geom=Point(0, 0, srid=3857)))
+        resid = res.id
+        tablename = res._tablename
+
+    yield resid
+
+    with transaction.manager:
+        DBSession.delete(VectorLayer.filter_by(id=resid).one())
+        DBSession.connection().execute(
+            'DROP TABLE IF EXISTS vector_layer."{}" CASCADE'.format(
+                tablename))
+
+
+def _job(resid, **kwargs):
+    values = dict(PARAMS, status='pending', srs_id=3857)
+    values.update(kwargs)
+
+    with transaction.manager:
+        job = FeatureLayerExport(resource_id=resid, **values).persist()
+        DBSession.flush()
+        return job.id
+
+
+def _status(job_id):
+    with transaction.manager:
+        job = FeatureLayerExport.filter_by(id=job_id).first()
+        return job.status if job is not None else None
+
+
+def _cached(resid):
+    res = VectorLayer.filter_by(id=resid).one()
+    return export_job_cached(
+        res, srs=SRS.filter_by(id=3857).one(), **PARAMS)
+
+
+def test_clip(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='export_clip',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    inside = res.feature_create(Feature(geom=Point(1, 1, srid=3857)))
+    res.feature_create(Feature(geom=Point(10, 10, srid=3857)))
+
+    query = res.feature_query()
+    query.geom()
+    apply_geom_options(query, clip=box(0, 0, 5, 5, srid=3857))
+
+    # Features outside the box are skipped, not returned without geometry
+    features = list(query())
+    assert [f.id for f in features] == [inside, ]
+    assert features[0].geom.coords[0] == (1, 1)
+
+
+def test_job_run(layer, monkeypatch):
+    job_id = _job(layer)
+    assert _status(job_id) == 'pending'
+
+    statuses = []
+    export_body = export.export_body
+
+    def export_body_status(*args, **kwargs):
+        statuses.append(
+            FeatureLayerExport.filter_by(id=job_id).one().status)
+        return export_body(*args, **kwargs)
+
+    monkeypatch.setattr(export, 'export_body', export_body_status)
+    export_job_run(job_id)
+    assert statuses == ['running', ]
+
+    with transaction.manager:
+        job = FeatureLayerExport.filter_by(id=job_id).one()
+        assert job.status == 'done'
+        assert job.finished is not None
+        assert job.revision is not None
+
+        with open(env.file_storage.filename(job.fileobj)) as fd:
+            data = json.load(fd)
+        assert data['features'][0]['properties']['name'] == 'a'
+
+
+def test_job_failed(layer, monkeypatch):
+    job_id = _job(layer)
+
+    def export_body_error(*args, **kwargs):
+        raise ValueError("Export error")
+
+    monkeypatch.setattr(export, 'export_body', export_body_error)
+    export_job_run(job_id)
+
+    with transaction.manager:
+        job = FeatureLayerExport.filter_by(id=job_id).one()
+        assert job.status == 'failed'
+        assert job.error == "Export error"
+        assert job.fileobj is None
+
+
+def test_job_cached(layer):
+    job_id = _job(layer)
+    export_job_run(job_id)
+
+    with transaction.manager:
+        assert _cached(layer).id == job_id
+
+        # Renamed field changes exported columns
+        res = VectorLayer.filter_by(id=layer).one()
+        res.fields[0].keyname = 'renamed'
+        DBSession.flush()
+        assert _cached(layer) is None
+
+        transaction.abort()
+
+    with transaction.manager:
+        assert _cached(layer).id == job_id
+
+        res = VectorLayer.filter_by(id=layer).one()
+        res.feature_create(Feature(
+            fields=dict(name='b'), geom=Point(1, 1, srid=3857)))
+        assert _cached(layer) is None
+
+        transaction.abort()
+
+
+def test_job_active(layer):
+    with transaction.manager:
+        res = VectorLayer.filter_by(id=layer).one()
+        srs = SRS.filter_by(id=3857).one()
+        assert export_job_active(res, srs=srs, **PARAMS) is None
+
+    # Running job started with other data revision isn't reused
+    _job(layer, status='running', revision='other')
+    with transaction.manager:
+        res = VectorLayer.filter_by(id=layer).one()
+        assert export_job_active(res, srs=srs, **PARAMS) is None
+
+    pending_id = _job(layer)
+    with transaction.manager:
+        res = VectorLayer.filter_by(id=layer).one()
+        assert export_job_active(res, srs=srs, **PARAMS).id == pending_id
+
+    # Job which wasn't finished in time is lost
+    with transaction.manager:
+        job = FeatureLayerExport.filter_by(id=pending_id).one()
+        job.created = datetime.utcnow() - timedelta(
+            seconds=env.feature_layer.settings['export.timeout'] + 1)
+
+    with transaction.manager:
+        res = VectorLayer.filter_by(id=layer).one()
+        assert export_job_active(res, srs=srs, **PARAMS) is None
+
+    assert _status(pending_id) == 'failed'
+
+
+def test_job_evict(layer):
+    old_id = _job(layer)
+    export_job_run(old_id)
+
+    with transaction.manager:
+        old_filename = env.file_storage.filename(
+            FeatureLayerExport.filter_by(id=old_id).one().fileobj)
+
+    # Job of other revision is removed when the new one is finished
+    with transaction.manager:
+        res = VectorLayer.filter_by(id=layer).one()
+        res.feature_create(Feature(
+            fields=dict(name='b'), geom=Point(1, 1, srid=3857)))
+
+    new_id = _job(layer)
+    export_job_run(new_id)
+
+    assert _status(old_id) is None
+    assert not os.path.exists(old_filename)
+    assert _status(new_id) == 'done'
+
+    # Results without revision are removed after their lifetime
+    expired = datetime.utcnow() - timedelta(
+        seconds=env.feature_layer.settings['export.ttl'] + 1)
+
+    with transaction.manager:
+        fileobj = FileObj(component='feature_layer').persist()
+        filename = env.file_storage.filename(fileobj, makedirs=True)
+        with open(filename, 'wb') as fd:
+            fd.write(b'content')
+
+        expired_id = FeatureLayerExport(
+            resource_id=layer, srs_id=3857, status='done', fileobj=fileobj,
+            finished=expired, **PARAMS).persist()
+        recent_id = FeatureLayerExport(
+            resource_id=layer, srs_id=3857, status='done',
+            finished=datetime.utcnow(), **PARAMS).persist()
+        failed_id = FeatureLayerExport(
+            resource_id=layer, srs_id=3857, status='failed', revision='old',
+            finished=expired, **PARAMS).persist()
+        DBSession.flush()
+
+        expired_id, recent_id, failed_id = \
+            expired_id.id, recent_id.id, failed_id.id
+
+    with transaction.manager:
+        _export_job_evict(FeatureLayerExport.filter_by(id=new_id).one())
+
+    assert _status(expired_id) is None
+    assert not os.path.exists(filename)
+    assert _status(failed_id) is None
+    assert _status(recent_id) == 'done'
+    assert _status(new_id) == 'done'
+
+
+def test_job_api(layer, webapp):
+    webapp.authorization = ('Basic', ('administrator', 'admin'))
+    url = '/api/resource/%d/export/job/' % layer
+
+    job = webapp.post_json(url, dict(format='geojson', zipped=False)).json
+    assert job['status'] in ('pending', 'running', 'done')
+
+    # Identical job isn't started twice
+    assert webapp.post_json(
+        url, dict(format='geojson', zipped=False)).json['id'] == job['id']
+
+    for i in range(100):
+        job = webapp.get(url + '%d' % job['id']).json
+        if job['status'] not in ('pending', 'running'):
+            break
+        sleep(0.1)
+
+    assert job['status'] == 'done'
+
+    # Finished job is reused as data isn't changed
+    assert webapp.post_json(
+        url, dict(format='geojson', zipped=False)).json['id'] == job['id']
+
+    resp = webapp.get(url + '%d/download' % job['id'])
+    assert resp.content_type == 'application/json'
+    assert 'attachment' in resp.headers['Content-Disposition']
+    assert resp.json['features'][0]['properties']['name'] == 'a'
+
+    webapp.get(url + '0', status=404)
+
+
+def test_job_api_lost(layer, webapp):
+    webapp.authorization = ('Basic', ('administrator', 'admin'))
+    url = '/api/resource/%d/export/job/' % layer
+
+    job_id = _job(layer, created=datetime.utcnow() - timedelta(
+        seconds=env.feature_layer.settings['export.timeout'] + 1))
+
+    # Unfinished job can't be downloaded
+    webapp.get(url + '%d/download' % job_id, status=422)
+
+    assert webapp.get(url + '%d' % job_id).json['status'] == 'failed'
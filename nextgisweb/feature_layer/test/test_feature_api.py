@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from uuid import uuid4
+
+import pytest
+import transaction
+
+from nextgisweb.auth import User
+from nextgisweb.feature_layer import FIELD_TYPE
+from nextgisweb.models import DBSession
+from nextgisweb.postgis import PostgisConnection, PostgisLayer
+from nextgisweb.spatial_ref_sys import SRS
+from nextgisweb.vector_layer import VectorLayer
+
+
+@pytest.fixture
+def vector_layer(env):
+    with transaction.manager:
+        res = VectorLayer(
+            parent_id=0, display_name='feature_api',
+            owner_user=User.by_keyname('administrator'),
+            geometry_type='POINT',
+            srs=SRS.filter_by(id=3857).one(),
+            tbl_uuid=unicode(uuid4().hex),
+        ).persist()
+
+        res.setup_from_fields([
+            dict(keyname='name', datatype=FIELD_TYPE.STRING), ])
+        DBSession.flush()
+
+        resid = res.id
+        tablename = res._tablename
+
+    yield resid
+
+    with transaction.manager:
+        DBSession.delete(VectorLayer.filter_by(id=resid).one())
+        DBSession.connection().execute(
+            'DROP TABLE IF EXISTS vector_layer."{}" CASCADE'.format(
+                tablename))
+
+
+@pytest.fixture
+def postgis_layer(env):
+    table = 'feature_api_%s' % uuid4().hex
+    settings = env.core.settings
+
+    with transaction.manager:
+        DBSession.connection().execute(
+            'CREATE TABLE public."{}" (id serial PRIMARY KEY, '
+            'name character varying, geom geometry(POINT, 3857))'
+            .format(table))
+
+        connection = PostgisConnection(
+            parent_id=0, display_name='feature_api_connection',
+            owner_user=User.by_keyname('administrator'),
+            hostname=settings.get('database.host', 'localhost'),
+            database=settings.get('database.name', 'nextgisweb'),
+            username=settings.get('database.user', 'nextgisweb'),
+            password=settings.get('database.password', ''),
+        ).persist()
+        DBSession.flush()
+
+        res = PostgisLayer(
+            parent_id=0, display_name='feature_api',
+            owner_user=User.by_keyname('administrator'),
+            connection=connection, srs=SRS.filter_by(id=3857).one(),
+            table=table, column_id='id', column_geom='geom',
+        ).persist()
+        res.setup()
+        DBSession.flush()
+
+        resid, connid = res.id, connection.id
+
+    yield resid
+
+    with transaction.manager:
+        DBSession.delete(PostgisLayer.filter_by(id=resid).one())
+        DBSession.flush()
+        DBSession.delete(PostgisConnection.filter_by(id=connid).one())
+        DBSession.connection().execute(
+            'DROP TABLE IF EXISTS public."{}"'.format(table))
+
+
+@pytest.fixture(params=['vector_layer', 'postgis_layer'])
+def layer(request):
+    return request.getfixturevalue(request.param)
+
+
+def _geom(webapp, url):
+    return webapp.get(url, dict(geom_format='geojson')).json['geom']
+
+
+def test_item_geom(vector_layer, webapp):
+    webapp.authorization = ('Basic', ('administrator', 'admin'))
+    url = '/api/resource/%d/feature/' % vector_layer
+
+    fid = webapp.post_json(url, dict(
+        geom='POINT (1 2)', fields=dict(name='a'))).json['id']
+    assert _geom(webapp, url + '%d' % fid)['coordinates'] == [1, 2]
+
+    webapp.put_json(url + '%d' % fid, dict(geom='POINT (3 4)'))
+    assert _geom(webapp, url + '%d' % fid)['coordinates'] == [3, 4]
+
+    # Feature without geometry
+    fid = webapp.post_json(url, dict(fields=dict(name='b'))).json['id']
+    assert _geom(webapp, url + '%d' % fid) is None
+
+    webapp.post_json(url, dict(geom='POINT (1'), status=422)
+
+    with transaction.manager:
+        extent = VectorLayer.filter_by(id=vector_layer).one().extent
+        assert extent['minLon'] is not None
+
+
+def test_cpatch(layer, webapp):
+    webapp.authorization = ('Basic', ('administrator', 'admin'))
+    url = '/api/resource/%d/feature/' % layer
+
+    fids = [r['id'] for r in webapp.patch_json(url, [
+        dict(geom='POINT (1 2)', fields=dict(name='a')),
+        dict(geom='POINT (1 1)', fields=dict(name='b')),
+    ]).json]
+
+    webapp.patch_json(url, [
+        dict(id=fids[0], geom='POINT (3 4)'),
+        dict(id=fids[1], geom='POINT (5 6)', fields=dict(name='c')),
+    ])
+
+    assert _geom(webapp, url + '%d' % fids[0])['coordinates'] == [3, 4]
+    assert _geom(webapp, url + '%d' % fids[1])['coordinates'] == [5, 6]
+
+    # Nothing is changed if some of features don't exist
+    webapp.patch_json(url, [
+        dict(id=fids[0], geom='POINT (7 8)'),
+        dict(id=fids[1] + 100, geom='POINT (7 8)'),
+    ], status=422)
+    assert _geom(webapp, url + '%d' % fids[0])['coordinates'] == [3, 4]
+
+
+def test_cget_intersects(vector_layer, webapp):
+    webapp.authorization = ('Basic', ('administrator', 'admin'))
+    url = '/api/resource/%d/feature/' % vector_layer
+
+    webapp.patch_json(url, [
+        dict(geom='POINT (1 1)', fields=dict(name='a')),
+        dict(geom='POINT (10 10)', fields=dict(name='b')),
+    ])
+
+    intersects = 'POLYGON ((0 0, 0 5, 5 5, 5 0, 0 0))'
+    features = webapp.get(url, dict(intersects=intersects)).json
+    assert [f['fields']['name'] for f in features] == ['a', ]
+    assert 'geom' in features[0]
+
+    # Filter geometry doesn't turn geometry output on
+    features = webapp.get(url, dict(
+        intersects=intersects, geom='no')).json
+    assert [f['fields']['name'] for f in features] == ['a', ]
+    assert 'geom' not in features[0]
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from uuid import uuid4
+
+import pytest
+
+from nextgisweb.auth import User
+from nextgisweb.feature_layer import Feature
+from nextgisweb.feature_layer.mvt import MVTCache
+from nextgisweb.geometry import Point
+from nextgisweb.models import DBSession
+from nextgisweb.spatial_ref_sys import SRS
+from nextgisweb.vector_layer import VectorLayer
+
+
+@pytest.fixture
+def layer(env, txn, tmpdir, monkeypatch):
+    monkeypatch.setitem(env.feature_layer.settings, 'mvt_cache.enabled', True)
+    monkeypatch.setattr(env.feature_layer, 'mvt_cache_path', str(tmpdir))
+
+    result = VectorLayer(
+        parent_id=0, display_name='mvt_cache',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    ).persist()
+    result.setup_from_fields([])
+
+    DBSession.flush()
+    return result
+
+
+def test_put_get(layer):
+    cache = MVTCache([layer.id, ], 4096, 8.0, 0.05)
+    assert cache.get_tile((0, 0, 0)) is None
+
+    cache.put_tile((0, 0, 0), b'content')
+    cache.put_tile((1, 0, 0), b'')
+
+    assert cache.get_tile((0, 0, 0)) == b'content'
+    assert cache.get_tile((1, 0, 0)) == b''
+
+    other = MVTCache([layer.id, ], 512, 8.0, 0.05)
+    assert other.get_tile((0, 0, 0)) is None
+
+
+def test_invalidate(layer):
+    merc = layer.srs
+    tile_invalid = (4, 0, 0)
+    tile_valid = (4, 15, 15)
+
+    cache = MVTCache([layer.id, ], 4096, 8.0, 0.05)
+    cache.put_tile(tile_invalid, b'invalid')
+    cache.put_tile(tile_valid, b'valid')
+
+    layer.feature_create(Feature(geom=Point(
+        *merc.tile_center(tile_invalid), srid=merc.id)))
+
+    assert cache.get_tile(tile_invalid) is None
+    assert cache.get_tile(tile_valid) == b'valid'
+
+    layer.feature_delete_all()
+    assert cache.get_tile(tile_valid) is None
+
+
+@pytest.mark.parametrize('wkt', (False, True))
+@pytest.mark.parametrize('many', (False, True))
+def test_invalidate_move(layer, many, wkt):
+    merc = layer.srs
+    tile_old = (4, 0, 0)
+    tile_new = (4, 15, 15)
+
+    fid = layer.feature_create(Feature(geom=Point(
+        *merc.tile_center(tile_old), srid=merc.id)))
+
+    cache = MVTCache([layer.id, ], 4096, 8.0, 0.05)
+    cache.put_tile(tile_old, b'old')
+    cache.put_tile(tile_new, b'new')
+
+    geom = Point(*merc.tile_center(tile_new), srid=merc.id)
+    # Geometry is set as WKT by REST API
+    feature = Feature(id=fid, geom=geom.wkt if wkt else geom)
+    if many:
+        layer.feature_put_many([feature, ])
+    else:
+        layer.feature_put(feature)
+
+    assert cache.get_tile(tile_old) is None
+    assert cache.get_tile(tile_new) is None
+
+
+def test_invalidate_delete(layer):
+    cache = MVTCache([layer.id, ], 4096, 8.0, 0.05)
+    cache.put_tile((0, 0, 0), b'content')
+
+    DBSession.delete(layer)
+    DBSession.flush()
+
+    assert cache.get_tile((0, 0, 0)) is None
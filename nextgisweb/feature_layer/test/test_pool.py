@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+from time import sleep
+
+import pytest
+import transaction
+
+from nextgisweb.auth import User
+from nextgisweb.feature_layer.pool import query_map
+from nextgisweb.models import DBSession
+from nextgisweb.resource import ResourceGroup
+
+
+@pytest.fixture
+def workers(env, monkeypatch):
+    monkeypatch.setitem(env.feature_layer.settings, 'query.workers', 4)
+
+
+def test_order(workers):
+    def func(item):
+        # Later items are finished first
+        sleep(0.01 * (10 - item))
+        return item * 2
+
+    assert query_map(func, range(10)) == [i * 2 for i in range(10)]
+
+
+def test_exception(workers):
+    def func(item):
+        if item == 3:
+            raise ValueError("Item %d" % item)
+        return item
+
+    with pytest.raises(ValueError) as excinfo:
+        query_map(func, range(5))
+    assert str(excinfo.value) == "Item 3"
+
+
+def test_transaction(workers, txn):
+    group = ResourceGroup(
+        parent_id=0, display_name='pool_transaction',
+        owner_user=User.by_keyname('administrator')).persist()
+    DBSession.flush()
+
+    def func(item):
+        # Uncommitted changes of the request aren't visible
+        visible = ResourceGroup.filter_by(id=group_id).first() is not None
+
+        obj = ResourceGroup(
+            parent_id=0, display_name='pool_transaction_%d' % item,
+            owner_user=User.by_keyname('administrator')).persist()
+        DBSession.flush()
+
+        return visible, obj.id, transaction.get()
+
+    group_id = group.id
+    result = query_map(func, range(2))
+
+    assert [visible for visible, rid, t in result] == [False, False]
+    assert all(t is not transaction.get() for visible, rid, t in result)
+
+    # Changes of tasks are discarded, the request transaction is intact
+    for visible, rid, t in result:
+        assert ResourceGroup.filter_by(id=rid).first() is None
+    assert ResourceGroup.filter_by(id=group_id).one() is group
+
+
+def test_single_thread(env, monkeypatch):
+    def func(item):
+        return threading.current_thread()
+
+    current = threading.current_thread()
+
+    monkeypatch.setitem(env.feature_layer.settings, 'query.workers', 1)
+    assert query_map(func, range(3)) == [current, ] * 3
+
+    # Single item doesn't need the pool
+    monkeypatch.setitem(env.feature_layer.settings, 'query.workers', 4)
+    assert query_map(func, range(1)) == [current, ]
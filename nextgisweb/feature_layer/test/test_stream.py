@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import json
+import zipfile
+from datetime import date
+from io import BytesIO
+from uuid import uuid4
+
+from osgeo import gdal, ogr
+
+from nextgisweb.auth import User
+from nextgisweb.feature_layer import Feature
+from nextgisweb.feature_layer.stream import (
+    zip_stream, _chunked, GeoJSONWriter, GPKGWriter)
+from nextgisweb.geometry import Point
+from nextgisweb.models import DBSession
+from nextgisweb.spatial_ref_sys import SRS
+from nextgisweb.vector_layer import VectorLayer
+
+
+def test_zip_stream():
+    content = [b'line %d\n' % i for i in range(10000)]
+
+    data = b''.join(zip_stream([
+        ('data.csv', iter(content)),
+        ('data.csvt', [b'"WKT"\n', ]),
+        ('empty.txt', []),
+    ]))
+
+    archive = zipfile.ZipFile(BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['data.csv', 'data.csvt', 'empty.txt']
+    assert archive.read('data.csv') == b''.join(content)
+    assert archive.read('data.csvt') == b'"WKT"\n'
+    assert archive.read('empty.txt') == b''
+
+
+def test_chunked():
+    parts = [json.dumps(i) for i in range(1000)]
+    chunks = list(_chunked(parts, size=100))
+    assert b''.join(chunks) == b''.join(parts)
+    assert all(len(c) >= 100 for c in chunks[:-1])
+
+
+def test_gpkg_writer(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='gpkg_writer',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([
+        dict(keyname='name', datatype='STRING'),
+        dict(keyname='day', datatype='DATE')])
+    res.persist()
+
+    DBSession.flush()
+
+    fid = res.feature_create(Feature(
+        fields=dict(name='Точка', day=date(2019, 11, 11)),
+        geom=Point(1, 2, srid=3857)))
+    res.feature_create(Feature(fields=dict(name=None, day=None)))
+
+    query = res.feature_query()
+    query.geom()
+
+    writer = GPKGWriter(res, res.srs)
+    (filename, body), = writer.files(query(), 'test')
+    assert filename == 'test.gpkg'
+
+    vsifn = b'/vsimem/%s.gpkg' % uuid4().hex
+    gdal.FileFromMemBuffer(vsifn, b''.join(body))
+    try:
+        ds = ogr.Open(vsifn)
+        layer = ds.GetLayer(0)
+        assert layer.GetFeatureCount() == 2
+
+        feature = layer.GetFeature(fid)
+        assert feature.GetField(b'name').decode('utf-8') == 'Точка'
+        assert feature.GetField(b'day') == '2019/11/11'
+        assert feature.GetGeometryRef().GetX() == 1
+        ds = None
+    finally:
+        gdal.Unlink(vsifn)
+
+
+def test_geojson_precision(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='geojson_precision',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    res.feature_create(Feature(geom=Point(1.23456, 2.34567, srid=3857)))
+
+    query = res.feature_query()
+    query.geom()
+
+    writer = GeoJSONWriter(res, res.srs, precision=2)
+    (filename, body), = writer.files(query(), 'test')
+    data = json.loads(b''.join(body))
+    assert data['features'][0]['geometry']['coordinates'] == [1.23, 2.35]
+
+    writer = GeoJSONWriter(res, res.srs)
+    (filename, body), = writer.files(res.feature_query()(), 'test')
+    data = json.loads(b''.join(body))
+    assert data['features'][0]['geometry'] is None
+
+
+def test_gpkg_precision(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='gpkg_precision',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    fid = res.feature_create(Feature(
+        geom=Point(1.23456, 2.34567, srid=3857)))
+
+    query = res.feature_query()
+    query.geom()
+
+    writer = GPKGWriter(res, res.srs, precision=2)
+    (filename, body), = writer.files(query(), 'test')
+
+    vsifn = b'/vsimem/%s.gpkg' % uuid4().hex
+    gdal.FileFromMemBuffer(vsifn, b''.join(body))
+    try:
+        ds = ogr.Open(vsifn)
+        geom = ds.GetLayer(0).GetFeature(fid).GetGeometryRef()
+        assert (geom.GetX(), geom.GetY()) == (1.23, 2.35)
+        ds = None
+    finally:
+        gdal.Unlink(vsifn)
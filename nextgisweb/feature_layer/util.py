@@ -1,6 +1,309 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import re
+import json
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
 from ..i18n import trstring_factory
+from .. import db
+
+from .interface import FIELD_TYPE
 
 COMP_ID = 'feature_layer'
 _ = trstring_factory(COMP_ID)
+
+
+def keyset_clause(criteria, values):
+    """ Build SQL condition which selects rows following the given key in
+    keyset pagination. PostgreSQL puts NULLs last in ascending and first in
+    descending order, conditions take it into account.
+
+    :param criteria: List of ``(order, column)`` tuples, where order is
+        ``asc`` or ``desc``, the last one should be an unique column.
+    :param values: Key values for each of criteria columns. """
+
+    clauses = []
+    for idx, ((order, column), value) in enumerate(zip(criteria, values)):
+        if order == 'asc':
+            if value is None:
+                continue
+            follows = db.or_(column > value, column.is_(None))
+        else:
+            follows = column.isnot(None) if value is None \
+                else column < value
+
+        clauses.append(db.and_(*[
+            c.isnot_distinct_from(v) for (o, c), v
+            in zip(criteria[:idx], values[:idx])
+        ] + [follows, ]))
+
+    return db.or_(*clauses)
+
+
+class _Explain(Executable, ClauseElement):
+
+    def __init__(self, query):
+        self.query = query
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.query, **kw)
+
+
+def explain_rows(conn, query):
+    """ Get number of rows returned by query according to query planner
+    estimate, which is much faster than counting on large tables. The query
+    is compiled as a part of ``EXPLAIN`` statement, so bind parameters (like
+    geometries) are processed by their types. """
+
+    plan = conn.execute(_Explain(query)).scalar()
+
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def update_from_values(table, columns, rows):
+    """ Build ``UPDATE ... FROM (VALUES ...)`` statement, which updates many
+    rows identified by the first column with a single query.
+
+    :param table: Quoted table name.
+    :param columns: List of ``(column, expression)`` tuples, where column is
+        a quoted column name and expression is a format string for the bind
+        parameter with explicit type, like ``CAST({} AS integer)``.
+    :param rows: List of rows, each row is a sequence of column values. """
+
+    params = dict()
+    values = []
+    for ridx, row in enumerate(rows):
+        items = []
+        for cidx, ((column, expr), value) in enumerate(zip(columns, row)):
+            pname = 'p%d_%d' % (ridx, cidx)
+            params[pname] = value
+            items.append(expr.format(':' + pname))
+        values.append('(' + ', '.join(items) + ')')
+
+    key = columns[0][0]
+    return db.sql.text(
+        'UPDATE {0} SET {1} FROM (VALUES {2}) AS v ({3}) '
+        'WHERE {0}.{4} = v.{4}'.format(
+            table,
+            ', '.join('{0} = v.{0}'.format(c) for c, e in columns[1:]),
+            ', '.join(values),
+            ', '.join(c for c, e in columns),
+            key)
+    ).bindparams(**params)
+
+
+# Field types which text representation doesn't depend on session settings,
+# so they can be included into the search index expression.
+SEARCH_DATATYPES = (
+    FIELD_TYPE.INTEGER, FIELD_TYPE.BIGINT,
+    FIELD_TYPE.REAL, FIELD_TYPE.STRING)
+
+_SEARCH_TEMPORAL = re.compile(r'^[0-9\-+:. ]+$')
+
+
+def search_expression(columns):
+    """ Build text expression for the trigram search index, which
+    concatenates columns casted to text. Only immutable operations are used,
+    so the expression can be indexed. Columns are separated with a control
+    character, thus a pattern without it can't match across columns.
+
+    :param columns: Columns with types from :py:data:`SEARCH_DATATYPES`. """
+
+    sep = db.literal_column("E'\\x1f'", db.Unicode)
+    empty = db.literal_column("''", db.Unicode)
+
+    expr = None
+    for column in columns:
+        item = db.func.coalesce(db.sql.cast(column, db.Unicode), empty)
+        expr = item if expr is None else expr.op('||')(sep).op('||')(item)
+
+    return expr
+
+
+def search_index_ddl(conn, table, index, columns):
+    """ Build ``CREATE INDEX CONCURRENTLY`` statement for the trigram search
+    index, which is used by :py:func:`like_clause`.
+
+    :param table: Quoted table name.
+    :param index: Index name.
+    :param columns: Column names, see :py:func:`search_expression`. """
+
+    expr = search_expression(map(db.sql.column, columns)).compile(
+        dialect=conn.dialect, compile_kwargs=dict(literal_binds=True))
+
+    return 'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ' \
+        'USING gin (({}) gin_trgm_ops)'.format(
+            conn.dialect.identifier_preparer.quote(index), table, expr)
+
+
+def drop_invalid_index(conn, schema, index):
+    """ Drop the index left invalid by failed ``CREATE INDEX CONCURRENTLY``,
+    otherwise ``CREATE INDEX IF NOT EXISTS`` skips it and it's never used.
+
+    :return: True if the index was dropped. """
+
+    invalid = conn.execute(db.sql.text(
+        'SELECT NOT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE n.nspname = :schema AND c.relname = :index'
+    ), schema=schema, index=index).scalar()
+
+    if not invalid:
+        return False
+
+    preparer = conn.dialect.identifier_preparer
+    conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}.{}'.format(
+        preparer.quote_schema(schema), preparer.quote(index)))
+    return True
+
+
+def like_clause(value, indexed, other):
+    """ Build ``like`` condition which can use the trigram search index.
+
+    :param value: Substring to search for.
+    :param indexed: Columns included into the search index expression.
+    :param other: Other columns, which are searched only if value looks like
+        a part of date or time text representation. """
+
+    pattern = '%' + value + '%'
+
+    clause = []
+    if len(indexed) > 0:
+        clause.append(search_expression(indexed).ilike(pattern))
+
+    if _SEARCH_TEMPORAL.match(value):
+        for column in other:
+            clause.append(db.sql.cast(column, db.Unicode).ilike(pattern))
+
+    if len(clause) == 0:
+        return db.sql.false()
+
+    return db.or_(*clause)
+
+
+# Column labels used in ST_AsMVT source queries, they shouldn't clash with
+# field keynames which become tile attributes.
+MVT_GEOM = '__mvt_geom'
+MVT_ID = '__mvt_id'
+
+_mvt_version = dict()
+
+
+def mvt_version(engine):
+    """ PostGIS version tuple if ST_AsMVT can be used in the database of the
+    engine, otherwise None. ST_AsMVT writes feature IDs since PostGIS 3.0,
+    tiles of older versions would lack them unlike tiles written with OGR.
+    PostGIS can be built without protobuf support, so the function is
+    checked on a trivial tile. The result is cached for each database URL. """
+
+    key = unicode(engine.url)
+    if key not in _mvt_version:
+        conn = engine.connect()
+        try:
+            version = conn.execute('SELECT postgis_lib_version()').scalar()
+            version = tuple(map(int, re.findall(r'\d+', version)[:2]))
+            if version < (3, 0):
+                version = None
+            else:
+                conn.execute(
+                    'SELECT ST_AsMVT(t) FROM (SELECT ST_AsMVTGeom('
+                    'ST_MakePoint(0, 0), ST_MakeBox2D(ST_MakePoint(0, 0), '
+                    'ST_MakePoint(1, 1))) AS geom) t').scalar()
+        except DBAPIError:
+            version = None
+        finally:
+            conn.close()
+
+        _mvt_version[key] = version
+
+    return _mvt_version[key]
+
+
+def mvt_geom(geom, bounds, extent, buffer):
+    """ Build ST_AsMVTGeom expression for geometry, which is transformed to
+    EPSG:3857 and converted to tile coordinate space.
+
+    :param bounds: Tile bounds ``(minx, miny, maxx, maxy)`` in EPSG:3857. """
+
+    minx, miny, maxx, maxy = bounds
+    return db.func.st_asmvtgeom(
+        db.func.st_transform(geom, 3857),
+        db.func.st_makebox2d(
+            db.func.st_makepoint(minx, miny),
+            db.func.st_makepoint(maxx, maxy)),
+        extent, buffer, True)
+
+
+def mvt_query(query, name, extent):
+    """ Wrap source query into ST_AsMVT aggregate. The source query should
+    have the geometry column built with :py:func:`mvt_geom` labeled as
+    ``MVT_GEOM`` and feature ID column labeled as ``MVT_ID``. Other columns
+    become attributes of tile features. """
+
+    source = query.alias('mvt_source')
+
+    args = [db.literal_column(source.name), name, extent, MVT_GEOM, MVT_ID]
+
+    return db.select(
+        [db.func.st_asmvt(*args), ], from_obj=source,
+        whereclause=source.columns[MVT_GEOM].isnot(None))
+
+
+def tiles_query(query, srs, zoom, buffer=0):
+    """ Select distinct tiles ``(x, y)`` of the SRS tile grid at the zoom
+    level, which intersect geometries of the source query. The source query
+    should have the geometry column in the SRS labeled as ``g``.
+
+    Candidate tiles are generated from bounding boxes of geometries, then
+    they are checked against geometries, so empty tiles within the bounding
+    box of a line or polygon aren't selected.
+
+    :param buffer: Buffer around tiles as a fraction of tile size, so tiles
+        with symbols crossing their edges are selected too. """
+
+    step = float(srs.maxx - srs.minx) / (1 << zoom)
+    tilemax = (1 << zoom) - 1
+    bstep = step * buffer
+
+    source = query.alias('tiles_source')
+    geom = source.columns.g
+
+    def tidx(expr):
+        return db.func.least(db.func.greatest(
+            db.cast(db.func.floor(expr), db.Integer), 0), tilemax)
+
+    def coord(func):
+        return func(geom, type_=db.Float)
+
+    # Set-returning functions in FROM can reference preceding FROM items
+    # without LATERAL keyword.
+    tx = db.func.generate_series(
+        tidx((coord(db.func.st_xmin) - bstep - srs.minx) / step),
+        tidx((coord(db.func.st_xmax) + bstep - srs.minx) / step),
+    ).alias('tx')
+    ty = db.func.generate_series(
+        tidx((srs.maxy - coord(db.func.st_ymax) - bstep) / step),
+        tidx((srs.maxy - coord(db.func.st_ymin) + bstep) / step),
+    ).alias('ty')
+
+    x = db.literal_column('tx', type_=db.Integer)
+    y = db.literal_column('ty', type_=db.Integer)
+
+    envelope = db.func.st_makeenvelope(
+        srs.minx + x * step - bstep, srs.maxy - (y + 1) * step - bstep,
+        srs.minx + (x + 1) * step + bstep, srs.maxy - y * step + bstep,
+        srs.id)
+
+    return db.select(
+        [x, y], from_obj=[source, tx, ty],
+        whereclause=db.func.st_intersects(geom, envelope),
+    ).distinct()
@@ -26,3 +26,23 @@ class Encoder(GeoJSONEncoder):
 
 dumps = functools.partial(_dumps, cls=Encoder)
 loads = functools.partial(_loads, cls=Encoder)
+
+
+def _round_coordinates(coordinates, precision):
+    if len(coordinates) > 0 and isinstance(coordinates[0], (list, tuple)):
+        return [_round_coordinates(c, precision) for c in coordinates]
+    return [round(c, precision) for c in coordinates]
+
+
+def round_geometry(geometry, precision):
+    """ Round coordinates of GeoJSON geometry mapping, like the one returned
+    by shapely's mapping, to the given number of decimal digits """
+
+    result = dict(geometry)
+    if 'geometries' in result:
+        result['geometries'] = [
+            round_geometry(g, precision) for g in result['geometries']]
+    else:
+        result['coordinates'] = _round_coordinates(
+            result['coordinates'], precision)
+    return result
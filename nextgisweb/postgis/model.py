@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import geoalchemy2 as ga
 import re
-from sqlalchemy.exc import OperationalError
+from collections import OrderedDict
+from sqlalchemy.exc import OperationalError, DBAPIError
 from sqlalchemy.engine.url import (
     URL as EngineURL,
     make_url as make_engine_url)
 from zope.interface import implements
+import transaction
 
 from .. import db
 from ..models import declarative_base
@@ -24,7 +26,7 @@ from ..resource import (
     ResourceGroup)
 from ..env import env
 from ..geometry import geom_from_wkt, box
-from ..layer import SpatialLayerMixin
+from ..layer import SpatialLayerMixin, IBboxLayer
 from ..feature_layer import (
     Feature,
     FeatureSet,
@@ -32,6 +34,7 @@ from ..feature_layer import (
     LayerFieldsMixin,
     GEOM_TYPE,
     FIELD_TYPE,
+    COUNT_MODE,
     IFeatureLayer,
     IWritableFeatureLayer,
     IFeatureQuery,
@@ -39,7 +42,25 @@ from ..feature_layer import (
     IFeatureQueryFilterBy,
     IFeatureQueryLike,
     IFeatureQueryIntersects,
-    IFeatureQueryOrderBy)
+    IFeatureQueryOrderBy,
+    IFeatureQueryKeyset,
+    IFeatureQueryMVT,
+    IFeatureQueryTotalCount,
+    IFeatureQueryTiles)
+from ..feature_layer.util import (
+    keyset_clause,
+    explain_rows,
+    update_from_values,
+    SEARCH_DATATYPES,
+    search_index_ddl,
+    drop_invalid_index,
+    like_clause,
+    MVT_GEOM,
+    MVT_ID,
+    mvt_version,
+    mvt_geom,
+    mvt_query,
+    tiles_query)
 
 from .util import _
 
@@ -151,7 +172,7 @@ class PostgisLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
 
     __scope__ = DataScope
 
-    implements(IFeatureLayer, IWritableFeatureLayer)
+    implements(IFeatureLayer, IWritableFeatureLayer, IBboxLayer)
 
     connection_id = db.Column(db.ForeignKey(Resource.id), nullable=False)
     schema = db.Column(db.Unicode, default=u'public', nullable=False)
@@ -160,6 +181,7 @@ class PostgisLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
     column_geom = db.Column(db.Unicode, nullable=False)
     geometry_type = db.Column(db.Enum(*GEOM_TYPE.enum), nullable=False)
     geometry_srid = db.Column(db.Integer, nullable=False)
+    search_index = db.Column(db.Boolean, nullable=False, default=False)
 
     __field_class__ = PostgisLayerField
 
@@ -184,6 +206,49 @@ class PostgisLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         )
         return source_meta
 
+    def search_index_sync(self):
+        """ Create or drop trigram search index used by ``like`` queries
+        according to ``search_index`` flag. The index is created in the
+        layer's database after the current transaction is committed, errors
+        (like missing privileges or pg_trgm extension) are only logged, and
+        ``like`` queries work without the index. """
+
+        engine = self.connection.get_engine()
+        preparer = engine.dialect.identifier_preparer
+
+        tablename = preparer.quote_schema(self.schema) + '.' \
+            + preparer.quote(self.table)
+        idx_name = '%s_search_idx' % self.table
+        drop_sql = 'DROP INDEX CONCURRENTLY IF EXISTS {}.{}'.format(
+            preparer.quote_schema(self.schema), preparer.quote(idx_name))
+        columns = [f.column_name for f in self.fields
+                   if f.datatype in SEARCH_DATATYPES]
+        create = self.search_index and len(columns) > 0
+
+        def sync(success):
+            if not success:
+                return
+
+            conn = engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+
+            try:
+                if create:
+                    drop_invalid_index(conn, self.schema, idx_name)
+                    conn.execute(search_index_ddl(
+                        conn, tablename, idx_name, columns))
+                else:
+                    conn.execute(drop_sql)
+
+            except Exception:
+                env.postgis.logger.exception(
+                    "Failed to update search index of %s", tablename)
+
+            finally:
+                conn.close()
+
+        transaction.get().addAfterCommitHook(sync)
+
     def setup(self):
         fdata = dict()
         for f in self.fields:
@@ -455,6 +520,184 @@ class PostgisLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         finally:
             conn.close()
 
+    def _writable_table(self):
+        idcol = db.sql.column(self.column_id)
+        geomcol = db.sql.column(self.column_geom)
+
+        cols = map(db.sql.column, (f.keyname for f in self.fields))
+        cols.append(idcol)
+        cols.append(geomcol)
+
+        tab = db.sql.table(self.table, *cols)
+        tab.schema = self.schema
+
+        tab.quote = True
+        tab.quote_schema = True
+
+        return tab, idcol
+
+    def feature_create_many(self, features):
+        """Insert many objects to DB, features with the same set of fields
+        are inserted with a single INSERT statement
+
+        :param features: objects description
+        :type features:  list of Feature
+
+        :return:    list of inserted objects IDs in the same order
+        """
+        tab, idcol = self._writable_table()
+
+        groups = OrderedDict()
+        for idx, feature in enumerate(features):
+            values = self.makevals(feature)
+            groups.setdefault(tuple(sorted(values.keys())), []).append(
+                (idx, values))
+
+        result = [None] * len(features)
+
+        conn = self.connection.get_connection()
+        try:
+            for group in groups.itervalues():
+                stmt = db.insert(tab).values(
+                    [gvalues for gidx, gvalues in group]).returning(idcol)
+                ids = [row[0] for row in conn.execute(stmt)]
+                for (gidx, gvalues), fid in zip(group, ids):
+                    result[gidx] = fid
+        finally:
+            conn.close()
+
+        return result
+
+    def feature_put_many(self, features):
+        """Update many existing objects, features with the same set of fields
+        are updated with a single UPDATE ... FROM (VALUES ...) statement
+
+        :param features: objects description
+        :type features:  list of Feature
+        """
+        conn = self.connection.get_connection()
+        preparer = conn.dialect.identifier_preparer
+
+        tablename = preparer.quote_schema(self.schema) + '.' \
+            + preparer.quote(self.table)
+
+        try:
+            # Column types are taken from the catalog, because VALUES rows
+            # are typed by the first row and bind parameters are text.
+            coltypes = dict(conn.execute(db.sql.text(
+                "SELECT attname, format_type(atttypid, atttypmod) "
+                "FROM pg_attribute WHERE attrelid = CAST(:tab AS regclass) "
+                "AND attnum > 0 AND NOT attisdropped"), tab=tablename))
+
+            groups = OrderedDict()
+            for feature in features:
+                fields = tuple(
+                    f.keyname for f in self.fields
+                    if f.keyname in feature.fields)
+                groups.setdefault(
+                    (fields, feature.geom is not None), []).append(feature)
+
+            for (fields, with_geom), group in groups.iteritems():
+                columns = [(
+                    preparer.quote(self.column_id),
+                    'CAST({} AS %s)' % coltypes[self.column_id]), ]
+                for keyname in fields:
+                    columns.append((
+                        preparer.quote(keyname),
+                        'CAST({} AS %s)' % coltypes[keyname]))
+                if with_geom:
+                    columns.append((preparer.quote(self.column_geom), (
+                        'ST_Transform(ST_GeomFromText({}, %d), %d)' % (
+                            self.srs_id, self.geometry_srid))))
+
+                if len(columns) == 1:
+                    continue
+
+                rows = []
+                for feature in group:
+                    row = [feature.id, ] + [
+                        feature.fields[keyname] for keyname in fields]
+                    if with_geom:
+                        row.append(str(feature.geom))
+                    rows.append(row)
+
+                conn.execute(update_from_values(tablename, columns, rows))
+        finally:
+            conn.close()
+
+    def feature_delete_many(self, feature_ids):
+        """Remove records with ids using a single DELETE statement
+
+        :param feature_ids: record ids
+        :type feature_ids:  list of int or bigint
+        """
+        if len(feature_ids) == 0:
+            return
+
+        tab, idcol = self._writable_table()
+
+        stmt = db.delete(tab).where(idcol == db.func.any(list(feature_ids)))
+
+        conn = self.connection.get_connection()
+        try:
+            conn.execute(stmt)
+        finally:
+            conn.close()
+
+    # IBboxLayer implementation:
+    @property
+    def extent(self):
+        """Return layer's extent
+
+        Table statistics are used through ST_EstimatedExtent if they are
+        available, otherwise extent is calculated with ST_Extent.
+        """
+        tab = db.sql.table(self.table)
+        tab.schema = self.schema
+
+        tab.quote = True
+        tab.quote_schema = True
+
+        geomcol = db.sql.column(self.column_geom)
+
+        def query(bbox):
+            bbox = db.func.st_transform(db.func.st_setsrid(
+                db.sql.cast(bbox, ga.Geometry),
+                self.geometry_srid), 4326)
+
+            conn = self.connection.get_connection()
+
+            try:
+                return conn.execute(db.select([
+                    db.func.st_xmin(bbox), db.func.st_ymin(bbox),
+                    db.func.st_xmax(bbox), db.func.st_ymax(bbox),
+                ])).first()
+            finally:
+                conn.close()
+
+        try:
+            result = query(db.func.st_estimatedextent(
+                self.schema, self.table, self.column_geom))
+        except DBAPIError:
+            # Older PostGIS versions raise an error instead of returning
+            # NULL if there are no table statistics.
+            result = (None, ) * 4
+
+        if result[0] is None:
+            result = query(db.select(
+                [db.func.st_extent(geomcol), ], from_obj=tab).as_scalar())
+
+        minLon, minLat, maxLon, maxLat = result
+
+        extent = dict(
+            minLon=minLon,
+            maxLon=maxLon,
+            minLat=minLat,
+            maxLat=maxLat
+        )
+
+        return extent
+
 DataScope.read.require(
     ConnectionScope.connect,
     attr='connection', cls=PostgisLayer)
@@ -474,6 +717,13 @@ class _fields_action(SP):
             raise ResourceError()
 
 
+class _search_index_attr(SP):
+
+    def setter(self, srlzr, value):
+        srlzr.obj.search_index = bool(value)
+        srlzr.obj.search_index_sync()
+
+
 class PostgisLayerSerializer(Serializer):
     identity = PostgisLayer.identity
     resclass = PostgisLayer
@@ -495,6 +745,8 @@ class PostgisLayerSerializer(Serializer):
 
     fields = _fields_action(write=DataStructureScope.write)
 
+    search_index = _search_index_attr(**__defaults)
+
 
 class FeatureQueryBase(object):
     implements(
@@ -503,7 +755,11 @@ class FeatureQueryBase(object):
         IFeatureQueryFilterBy,
         IFeatureQueryLike,
         IFeatureQueryIntersects,
-        IFeatureQueryOrderBy)
+        IFeatureQueryOrderBy,
+        IFeatureQueryKeyset,
+        IFeatureQueryMVT,
+        IFeatureQueryTotalCount,
+        IFeatureQueryTiles)
 
     def __init__(self):
         self._srs = None
@@ -520,6 +776,9 @@ class FeatureQueryBase(object):
         self._intersects = None
 
         self._order_by = None
+        self._after = None
+
+        self._with_total_count = None
 
     def srs(self, srs):
         self._srs = srs
@@ -546,12 +805,27 @@ class FeatureQueryBase(object):
     def order_by(self, *args):
         self._order_by = args
 
+    def after(self, id, values=None):
+        self._after = (id, tuple(values or ()))
+
     def like(self, value):
         self._like = value
 
     def intersects(self, geom):
         self._intersects = geom
 
+    def with_total_count(self):
+        self._with_total_count = True
+
+    def mvt(self, bounds, extent, buffer, name):
+        if mvt_version(self.layer.connection.get_engine()) is None:
+            return None
+        return self()._mvt(bounds, extent, buffer, name)
+
+    def tiles(self, zoom, buffer=0):
+        srs = self.layer.srs if self._srs is None else self._srs
+        return self()._tiles(srs, zoom, buffer)
+
     def __call__(self):
         tab = db.sql.table(self.layer.table)
         tab.schema = self.layer.schema
@@ -592,17 +866,16 @@ class FeatureQueryBase(object):
         if self._filter:
             l = []
             for k, o, v in self._filter:
-                supported_operators = ('gt', 'lt', 'ge', 'le', 'eq', 'ne', 'like', 'ilike')
+                supported_operators = (
+                    'gt', 'lt', 'ge', 'le', 'eq', 'ne', 'like', 'ilike',
+                    'in', 'notin')
                 if o not in supported_operators:
                     raise ValueError(
                         "Invalid operator '%s'. Only %r are supported." % (
                             o, supported_operators))
 
-                if o == 'like':
-                    o = 'like_op'
-
-                if o == 'ilike':
-                    o = 'ilike_op'
+                if o in ('like', 'ilike', 'in', 'notin'):
+                    o += '_op'
 
                 op = getattr(db.sql.operators, o)
                 if k == 'id':
@@ -612,7 +885,17 @@ class FeatureQueryBase(object):
 
             select.append_whereclause(db.and_(*l))
 
-        if self._like:
+        if self._like and self.layer.search_index:
+            # Same expression as in the search index, see search_index_sync
+            select.append_whereclause(like_clause(self._like, [
+                db.sql.column(fld.column_name) for fld in self.layer.fields
+                if fld.datatype in SEARCH_DATATYPES
+            ], [
+                db.sql.column(fld.column_name) for fld in self.layer.fields
+                if fld.datatype not in SEARCH_DATATYPES
+            ]))
+
+        elif self._like:
             l = []
             for fld in self.layer.fields:
                 l.append(db.sql.cast(
@@ -639,11 +922,22 @@ class FeatureQueryBase(object):
         select.append_whereclause(db.func.geometrytype(db.sql.column(
             self.layer.column_geom)).in_((gt, )))
 
+        keyset_criteria = []
         if self._order_by:
             for order, colname in self._order_by:
                 select.append_order_by(dict(asc=db.asc, desc=db.desc)[order](
                     db.sql.column(colname)))
+                keyset_criteria.append((order, db.sql.column(colname)))
         select.append_order_by(idcol)
+        keyset_criteria.append(('asc', idcol))
+
+        # Keyset condition is applied only to the page of features, so
+        # counts don't depend on the cursor.
+        after = None
+        if self._after:
+            after_id, after_values = self._after
+            after = keyset_clause(
+                keyset_criteria, after_values + (after_id, ))
 
         class QueryFeatureSet(FeatureSet):
             layer = self.layer
@@ -653,17 +947,33 @@ class FeatureQueryBase(object):
             _fields = self._fields
             _limit = self._limit
             _offset = self._offset
+            # Window function would count only features after the cursor
+            _with_total_count = self._with_total_count and after is None
+
+            # Selected with features if with_total_count is set
+            _total_count = None
 
             def __iter__(self):
+                query = select if after is None else select.where(after)
                 if self._limit:
-                    query = select.limit(self._limit).offset(self._offset)
-                else:
-                    query = select
+                    query = query.limit(self._limit).offset(self._offset)
+
+                if self._with_total_count:
+                    query = query.column(
+                        db.func.count().over().label('total_count'))
 
                 conn = self.layer.connection.get_connection()
 
+                # Unlimited queries can return a lot of rows, so they are
+                # read in batches with a server-side cursor.
+                conn = conn.execution_options(
+                    stream_results=not self._limit)
+
                 try:
                     for row in conn.execute(query):
+                        if self._with_total_count:
+                            self._total_count = row['total_count']
+
                         fdict = dict((k, row[l]) for k, l in fieldmap)
 
                         if self._geom:
@@ -683,8 +993,45 @@ class FeatureQueryBase(object):
                 finally:
                     conn.close()
 
+            def _mvt(self, bounds, extent, buffer, name):
+                mvtcolumns = [mvt_geom(
+                    geomcol, bounds, extent, buffer).label(MVT_GEOM),
+                    idcol.label(MVT_ID)]
+                mvtcolumns.extend([
+                    db.sql.column(fld.column_name).label(fld.keyname)
+                    for fld in self.layer.fields
+                    if not self._fields or fld.keyname in self._fields])
+
+                query = mvt_query(
+                    select.with_only_columns(mvtcolumns).order_by(None),
+                    name, extent)
+
+                conn = self.layer.connection.get_connection()
+
+                try:
+                    content = conn.execute(query).scalar()
+                finally:
+                    conn.close()
+
+                return str(content) if content is not None else b''
+
+            def _tiles(self, srs, zoom, buffer):
+                query = tiles_query(
+                    select.with_only_columns([geomexpr.label('g'), ])
+                    .order_by(None), srs, zoom, buffer)
+
+                conn = self.layer.connection.get_connection()
+
+                try:
+                    return [tuple(row) for row in conn.execute(query)]
+                finally:
+                    conn.close()
+
             @property
             def total_count(self):
+                if self._total_count is not None:
+                    return self._total_count
+
                 conn = self.layer.connection.get_connection()
 
                 try:
@@ -696,4 +1043,23 @@ class FeatureQueryBase(object):
                 finally:
                     conn.close()
 
+            def count(self, mode=None):
+                if self._total_count is not None:
+                    return self._total_count
+
+                elif mode == COUNT_MODE.ESTIMATE:
+                    conn = self.layer.connection.get_connection()
+
+                    try:
+                        estimate = explain_rows(conn, select)
+                    finally:
+                        conn.close()
+
+                    threshold = env.feature_layer.settings[
+                        'count.estimate_threshold']
+                    if estimate >= threshold:
+                        return estimate
+
+                return self.total_count
+
         return QueryFeatureSet()
@@ -28,7 +28,7 @@ from .util import (
     RequestMethodPredicate,
     JsonPredicate)
 from .auth import AuthenticationPolicy
-from . import exception
+from . import exception, compression
 
 __all__ = ['viewargs', ]
 
@@ -113,6 +113,10 @@ class PyramidComponent(Component):
         config.registry.settings['error.exc_response'] = error_handler
         config.include(exception)
 
+        # Response compression, configured with compression.level and
+        # compression.min_size settings
+        config.include(compression)
+
         # Access to Env through request.env
         config.add_request_method(
             lambda (req): self._env, 'env',
@@ -254,4 +258,6 @@ class PyramidComponent(Component):
         dict(key='help_page', desc=u"HTML help"),
         dict(key='favicon', desc=u"Favicon"),
         dict(key='sentry_dsn', desc=u"Sentry DSN"),
+        dict(key='compression.level', desc=u"Response compression level from 1 to 9, 0 disables compression (default: 6)"),
+        dict(key='compression.min_size', desc=u"Minimum size of response body to compress in bytes (default: 1024)"),
     )
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Compression of response bodies with gzip or deflate content encoding
+negotiated with Accept-Encoding request header, so large JSON responses are
+compressed without a reverse proxy. """
+from __future__ import division, absolute_import, print_function, unicode_literals
+import re
+import zlib
+
+
+COMPRESSION_TFACTORY = 'nextgisweb.pyramid.compression.compression_tween_factory'
+
+# Content types which are worth compressing, images and archives are
+# already compressed.
+COMPRESSIBLE_TYPES = (
+    re.compile(r'^text/'),
+    re.compile(r'^application/(.+\+)?json$'),
+    re.compile(r'^application/(.+\+)?xml$'),
+    re.compile(r'^application/javascript$'),
+    re.compile(r'^application/x-protobuf$'),
+    re.compile(r'^application/vnd\.mapbox-vector-tile$'),
+    re.compile(r'^image/svg\+xml$'),
+)
+
+# Window bits for zlib compressobj: gzip container or zlib stream, which
+# is what deflate content encoding means in HTTP.
+WBITS = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 1024
+
+
+def includeme(config):
+    EXC_TFACTORY = 'nextgisweb.pyramid.exception.unhandled_exception_tween_factory'
+
+    # Error responses are compressed too
+    config.add_tween(COMPRESSION_TFACTORY, over=EXC_TFACTORY)
+
+
+def accepted_encoding(header):
+    """ The best of gzip and deflate encodings acceptable according to the
+    Accept-Encoding header value or None """
+
+    if header is None:
+        return None
+
+    qvalues = dict()
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+
+    wildcard = qvalues.get('*', 0.0)
+    candidates = [
+        (qvalues.get(c, wildcard), c)
+        for c in ('gzip', 'deflate')]
+
+    # Stable sort by q-value keeps gzip first if they are equal
+    q, coding = sorted(candidates, key=lambda c: -c[0])[0]
+    return coding if q > 0 else None
+
+
+def compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+
+    if response.content_encoding is not None:
+        return False
+
+    content_type = response.content_type
+    if content_type is None:
+        return False
+
+    return any(r.match(content_type) for r in COMPRESSIBLE_TYPES)
+
+
+def compress_iter(app_iter, coding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def compression_tween_factory(handler, registry):
+    settings = registry.settings
+    level = int(settings.get('compression.level', DEFAULT_LEVEL))
+    min_size = int(settings.get('compression.min_size', DEFAULT_MIN_SIZE))
+
+    if level == 0:
+        return handler
+
+    def compression_tween(request):
+        response = handler(request)
+
+        if request.method == 'HEAD' or not compressible(response):
+            return response
+
+        # Ranges of conditional responses are applied to the body later,
+        # they would be ranges of compressed content.
+        if request.range is not None:
+            return response
+
+        # Response depends on Accept-Encoding even if it isn't compressed
+        vary = response.vary or ()
+        if 'Accept-Encoding' not in vary:
+            response.vary = tuple(vary) + ('Accept-Encoding', )
+
+        coding = accepted_encoding(request.headers.get('Accept-Encoding'))
+        if coding is None:
+            return response
+
+        if isinstance(response.app_iter, (list, tuple)):
+            body = response.body
+            if len(body) < min_size:
+                return response
+
+            compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+            response.body = compressor.compress(body) + compressor.flush()
+
+        else:
+            # Streamed body is compressed while it's iterated, if its size
+            # is unknown it's expected to be large.
+            if (
+                response.content_length is not None
+                and response.content_length < min_size  # NOQA: W503
+            ):
+                return response
+
+            response.app_iter = compress_iter(
+                response.app_iter, coding, level)
+            response.content_length = None
+            response.accept_ranges = None
+
+        response.content_encoding = coding
+        return response
+
+    return compression_tween
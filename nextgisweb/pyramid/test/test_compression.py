@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, absolute_import, print_function, unicode_literals
+import gzip
+import zlib
+from io import BytesIO
+
+import pytest
+from pyramid.config import Configurator
+from pyramid.response import Response
+
+from nextgisweb.pyramid import exception, compression
+from nextgisweb.pyramid.compression import accepted_encoding
+
+
+BODY = b'{"data": "' + b'x' * 4096 + b'"}'
+
+
+@pytest.fixture(scope='module')
+def webapp():
+    from webtest import TestApp
+
+    settings = dict()
+    settings['error.err_response'] = exception.json_error_response
+    settings['error.exc_response'] = exception.json_error_response
+
+    config = Configurator(settings=settings)
+    config.include(exception)
+    config.include(compression)
+
+    def view_large(request):
+        return Response(BODY, content_type=b'application/json')
+
+    config.add_route('large', '/large')
+    config.add_view(view_large, route_name='large')
+
+    def view_small(request):
+        return Response(b'{}', content_type=b'application/json')
+
+    config.add_route('small', '/small')
+    config.add_view(view_small, route_name='small')
+
+    def view_stream(request):
+        return Response(
+            app_iter=iter([BODY, BODY]), content_type=b'application/json')
+
+    config.add_route('stream', '/stream')
+    config.add_view(view_stream, route_name='stream')
+
+    def view_image(request):
+        return Response(BODY, content_type=b'image/png')
+
+    config.add_route('image', '/image')
+    config.add_view(view_image, route_name='image')
+
+    yield TestApp(config.make_wsgi_app())
+
+
+@pytest.mark.parametrize('header, expected', (
+    (None, None),
+    ('gzip, deflate', 'gzip'),
+    ('deflate', 'deflate'),
+    ('gzip;q=0.5, deflate', 'deflate'),
+    ('*', 'gzip'),
+    ('gzip;q=0, identity', None),
+    ('br', None),
+))
+def test_accepted_encoding(header, expected):
+    assert accepted_encoding(header) == expected
+
+
+def test_gzip(webapp):
+    resp = webapp.get('/large', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert gzip.GzipFile(fileobj=BytesIO(resp.body)).read() == BODY
+
+
+def test_deflate_stream(webapp):
+    resp = webapp.get('/stream', headers={'Accept-Encoding': 'deflate'})
+    assert resp.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(resp.body) == BODY + BODY
+
+
+@pytest.mark.parametrize('url, headers', (
+    ('/large', {}),
+    ('/small', {'Accept-Encoding': 'gzip'}),
+    ('/image', {'Accept-Encoding': 'gzip'}),
+))
+def test_not_compressed(webapp, url, headers):
+    resp = webapp.get(url, headers=headers)
+    assert 'Content-Encoding' not in resp.headers
@@ -13,6 +13,7 @@ from .interface import (
     ILegendableStyle,
 )
 from .model import Base
+from .tilestor import TILE_STORES
 from .event import (
     on_style_change,
     on_data_change,
@@ -44,7 +45,16 @@ class RenderComponent(Component):
         self.tile_cache_track_changes = _sbool('tile_cache.track_changes')
         self.tile_cache_seed = _sbool('tile_cache.seed')
 
+        # Size of metatiles in tiles, 1 disables metatile rendering
+        self.tile_cache_metatile = int(settings.get('tile_cache.metatile', 1))
+
+        # Tile storage backend, see tilestor module
+        self.tile_cache_backend = settings.get('tile_cache.backend', 'postgresql')
+
     def initialize(self):
+        if self.tile_cache_backend not in TILE_STORES:
+            raise ValueError("Unknown tile cache backend '%s'!" % self.tile_cache_backend)
+
         self.tile_cache_path = os.path.join(self.env.core.gtsdir(self), 'tile_cache')
         if not os.path.isdir(self.tile_cache_path):
             os.makedirs(self.tile_cache_path)
@@ -59,3 +69,11 @@ class RenderComponent(Component):
             track_changes=self.tile_cache_track_changes,
             seed=self.tile_cache_seed
         ))
+
+    settings_info = (
+        dict(key='tile_cache.enabled', desc=u"Enable tile cache"),
+        dict(key='tile_cache.track_changes', desc=u"Invalidate tile cache on data and style changes"),
+        dict(key='tile_cache.seed', desc=u"Enable tile cache seeding"),
+        dict(key='tile_cache.backend', desc=u"Tile cache storage: postgresql (default), mbtiles or filesystem"),
+        dict(key='tile_cache.metatile', desc=u"Render cached tiles in metatiles of NxN tiles (default: 1)"),
+    )
@@ -10,8 +10,11 @@ from pyramid.httpexceptions import HTTPBadRequest
 
 from ..resource import Resource, DataScope, resource_factory
 
-from .interface import ILegendableStyle, IRenderableStyle
-from .util import af_transform
+from .interface import (
+    ILegendableStyle,
+    IRenderableStyle,
+    IExtentRenderRequest)
+from .util import af_transform, metatile, render_metatile, solid_png
 
 
 PD_READ = DataScope.read
@@ -55,7 +58,9 @@ def tile(request):
     p_cache = request.GET.get('cache', 'true').lower() in ('true', 'yes', '1') \
         and request.env.render.tile_cache_enabled
 
-    aimg = None
+    # Images of resources, each of them is a decoded image or an encoded
+    # PNG image returned by the tile cache.
+    layers = []
     for resid in p_resource:
         obj = Resource.filter_by(id=resid).one()
         if not setting_disable_check:
@@ -72,12 +77,35 @@ def tile(request):
         if cached:
             rimg = tcache.get_tile((z, x, y))
 
-        if not rimg:
+        if rimg is None:
             req = obj.render_request(obj.srs)
-            rimg = req.render_tile((z, x, y), 256)
 
-            if cached:
-                tcache.put_tile((z, x, y), rimg)
+            # Neighbour tiles of the metatile are rendered and cached too
+            msize = request.env.render.tile_cache_metatile
+            if cached and msize > 1 and IExtentRenderRequest.providedBy(req):
+                tiles = render_metatile(
+                    req, obj.srs, metatile((z, x, y), msize))
+                rimg = tcache.put_tiles(tiles)[(z, x, y)]
+
+            else:
+                rimg = req.render_tile((z, x, y), 256)
+
+                if cached:
+                    rimg = tcache.put_tile((z, x, y), rimg)
+
+        layers.append((obj, rimg))
+
+    # Single tile from the cache is returned as is without decoding, if
+    # there were no resources for rendering, return empty image.
+    if len(layers) == 0:
+        return Response(body=solid_png(0), content_type=b'image/png')
+    elif len(layers) == 1 and isinstance(layers[0][1], bytes):
+        return Response(body=layers[0][1], content_type=b'image/png')
+
+    aimg = None
+    for obj, rimg in layers:
+        if isinstance(rimg, bytes):
+            rimg = Image.open(StringIO(rimg))
 
         if aimg is None:
             aimg = rimg
@@ -89,10 +117,6 @@ def tile(request):
                     "Image (ID=%d) must have mode %s, but it is %s mode." %
                     (obj.id, aimg.mode, rimg.mode))
 
-    # If there were no resources for rendering, return empty image
-    if aimg is None:
-        aimg = Image.new('RGBA', (256, 256))
-
     buf = StringIO()
     aimg.save(buf, 'png')
     buf.seek(0)
@@ -182,11 +206,12 @@ def image(request):
             ty_range = tuple(range(min(tb[1], tb[3]), max(tb[1], tb[3])))
 
             for tx, ty in product(tx_range, ty_range):
-                timg = obj.tile_cache.get_tile((ztile, tx, ty))
-                if timg is None:
+                tdata = obj.tile_cache.get_tile((ztile, tx, ty))
+                if tdata is None:
                     rimg = None
                     break
                 else:
+                    timg = Image.open(StringIO(tdata))
                     if rimg is None:
                         rimg = Image.new('RGBA', p_size)
 
@@ -4,23 +4,246 @@ import logging
 from math import ceil, floor
 from itertools import product
 from datetime import datetime
+from multiprocessing import Pool
 
 from pyproj import Transformer
 import transaction
 
 from ..command import Command
+from ..env import env
+from ..feature_layer import IFeatureLayer, IFeatureQueryTiles
+from ..layer import IBboxLayer
 from ..models import DBSession
 
+from .interface import IExtentRenderRequest
 from .model import ResourceTileCache
-from .util import affine_bounds_to_tile
+from .util import affine_bounds_to_tile, metatile, render_metatile
 
 
 _logger = logging.getLogger(__name__)
 
 
-SEED_STEP = 16
+# Size of seeding job side in metatiles, each job is executed in a separate
+# transaction by one of workers
+SEED_JOB = 4
 SEED_INTERVAL = 30
 
+# Buffer around tiles as a fraction of tile size, tiles within the buffer of
+# features aren't empty due to symbols crossing tile edges.
+SEED_BUFFER = 0.125
+
+
+def _extent(data_res, srs):
+    """ Extent of the data resource in the SRS, None if the resource has no
+    features and SRS bounds if its extent is unknown """
+
+    bounds = (srs.minx, srs.miny, srs.maxx, srs.maxy)
+    if not IBboxLayer.providedBy(data_res):
+        return bounds
+
+    extent = data_res.extent
+    if extent['minLon'] is None:
+        return None
+
+    minlat, maxlat = extent['minLat'], extent['maxLat']
+    if srs.id == 3857:
+        # Web mercator isn't defined at poles
+        minlat, maxlat = max(minlat, -85.0511), min(maxlat, 85.0511)
+
+    srs_tr = Transformer.from_crs(4326, srs.wkt, always_xy=True)
+    xs, ys = srs_tr.transform(
+        [extent['minLon'], extent['minLon'], extent['maxLon'], extent['maxLon']],
+        [minlat, maxlat, minlat, maxlat])
+
+    return (
+        max(min(xs), bounds[0]), max(min(ys), bounds[1]),
+        min(max(xs), bounds[2]), min(max(ys), bounds[3]))
+
+
+def _tile_range(extent, srs, z):
+    """ Ranges of tile columns and rows covering the extent """
+
+    atf = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
+
+    t_lb = tuple(atf * extent[0:2])
+    t_rt = tuple(atf * extent[2:4])
+
+    tb = (
+        int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
+        int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
+        int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
+        int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
+    )
+
+    rx = (min(tb[0], tb[2]), max(tb[0], tb[2]))
+    ry = (min(tb[1], tb[3]), max(tb[1], tb[3]))
+    return rx, ry
+
+
+def _seed_jobs(tc_id, seed_z, msize, query=None, extent=None, srs=None):
+    """ Split tiles of zoom levels up to seed_z into seeding jobs. If the
+    query is set, only tiles returned by its tiles method are seeded,
+    otherwise all tiles of the extent in the SRS tile grid. Jobs are split
+    in the same order every time, so the progress is the number of tiles in
+    completed jobs.
+
+    :return: Tuple ``(jobs, counts)``, where counts are numbers of tiles
+        in jobs """
+
+    jobs = list()
+    counts = list()
+
+    step = msize * SEED_JOB
+
+    for z in range(1, seed_z + 1):
+        if query is not None:
+            # Non-empty tiles grouped by job cells
+            cells = dict()
+            for x, y in query.tiles(z, SEED_BUFFER):
+                cells.setdefault((x - x % step, y - y % step), set()) \
+                    .add((x, y))
+
+            for (jx, jy), tiles in sorted(cells.items()):
+                jobs.append((
+                    len(jobs), tc_id, z, (jx, jx + step), (jy, jy + step),
+                    frozenset(tiles), msize))
+                counts.append(len(tiles))
+
+            continue
+
+        rx, ry = _tile_range(extent, srs, z)
+
+        for jx, jy in product(
+            range(rx[0] - rx[0] % step, rx[1], step),
+            range(ry[0] - ry[0] % step, ry[1], step),
+        ):
+            jrx = (max(jx, rx[0]), min(jx + step, rx[1]))
+            jry = (max(jy, ry[0]), min(jy + step, ry[1]))
+            jobs.append((len(jobs), tc_id, z, jrx, jry, None, msize))
+            counts.append((jrx[1] - jrx[0]) * (jry[1] - jry[0]))
+
+    return jobs, counts
+
+
+def _seed_resume(counts, progress):
+    """ Jobs completed by the interrupted seeding with the saved progress
+
+    :return: Tuple ``(skip, saved)`` of the number of completed jobs and
+        the number of tiles in them """
+
+    skip = 0
+    saved = 0
+    while skip < len(counts) and saved + counts[skip] <= progress:
+        saved += counts[skip]
+        skip += 1
+
+    return skip, saved
+
+
+class _SeedProgress(object):
+    """ Saved progress covers only the sequence of completed jobs from the
+    beginning, as jobs are completed out of order """
+
+    def __init__(self, counts, skip=0, saved=0):
+        self.counts = counts
+        self.pending = skip
+        self.saved = saved
+        self._completed = set()
+
+    def complete(self, index):
+        """ Mark the job completed and return the saved progress """
+
+        self._completed.add(index)
+        while self.pending in self._completed:
+            self._completed.remove(self.pending)
+            self.saved += self.counts[self.pending]
+            self.pending += 1
+
+        return self.saved
+
+
+def _seed_job(job):
+    """ Render missing tiles of the job tile range, executed in a worker
+    process with its own database session and SQLite connection. If the job
+    has a set of tiles, other tiles of the range are skipped as empty.
+
+    :return: Tuple ``(index, processed, rendered)`` """
+
+    index, resid, z, rx, ry, tiles, msize = job
+
+    processed = 0
+    rendered = 0
+
+    with transaction.manager:
+        tc = ResourceTileCache.filter_by(resource_id=resid).one()
+        rend_res = tc.resource
+        srs = rend_res.srs
+
+        # Metatiles aligned to the tile grid, which cover the range.
+        # Without metatiles each of them consists of a single tile.
+        mrx = range(rx[0] - rx[0] % msize, rx[1], msize)
+        mry = range(ry[0] - ry[0] % msize, ry[1], msize)
+
+        for mx, my in product(mrx, mry):
+            block = list(product(
+                range(max(mx, rx[0]), min(mx + msize, rx[1])),
+                range(max(my, ry[0]), min(my + msize, ry[1]))))
+            if tiles is not None:
+                block = [(x, y) for x, y in block if (x, y) in tiles]
+
+            missing = [
+                (x, y) for x, y in block
+                if tc.get_tile((z, x, y)) is None]
+
+            if len(missing) > 0:
+                req = rend_res.render_request(srs)
+                if msize > 1 and IExtentRenderRequest.providedBy(req):
+                    rtiles = render_metatile(
+                        req, srs, metatile((z, mx, my), msize))
+                else:
+                    rtiles = [
+                        ((z, x, y), req.render_tile((z, x, y), 256))
+                        for x, y in missing]
+
+                tc.put_tiles(rtiles)
+                rendered += len(rtiles)
+
+            processed += len(block)
+
+    return index, processed, rendered
+
+
+def _seed_map(jobs, workers):
+    """ Execute seeding jobs and yield their results in order of completion,
+    jobs are distributed between worker processes if there are several """
+
+    if workers <= 1:
+        for job in jobs:
+            yield _seed_job(job)
+        return
+
+    # Forked workers shouldn't share database connections with the main
+    # process, so connections are closed before forking.
+    DBSession.remove()
+    env.core.engine.dispose()
+
+    pool = Pool(workers)
+    try:
+        for result in pool.imap_unordered(_seed_job, jobs):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _update_seed_status(resid, value, progress=None, total=None):
+    with transaction.manager:
+        tc = ResourceTileCache.filter_by(resource_id=resid).one()
+        tc.update_seed_status(value, progress=progress, total=total)
+
 
 @Command.registry.register
 class TileCacheSeedCommand():
@@ -28,98 +251,117 @@ class TileCacheSeedCommand():
 
     @classmethod
     def argparser_setup(cls, parser, env):
-        pass
+        parser.add_argument(
+            '--resource', default=None,
+            help="Comma separated style IDs, all styles with seeding "
+            "enabled by default")
+        parser.add_argument(
+            '--zoom', type=int, default=None,
+            help="Maximum zoom level, seed_z of the tile cache by default")
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Number of worker processes")
+        parser.add_argument(
+            '--resume', action='store_true', default=False,
+            help="Skip tiles processed by the interrupted or failed seeding "
+            "with the same parameters")
 
     @classmethod
     def execute(cls, args, env):
-        tc_ids = DBSession.query(ResourceTileCache.resource_id).filter(
-            ResourceTileCache.enabled,
-            ResourceTileCache.seed_z != None  # NOQA: E711
-        ).all()
+        query = DBSession.query(ResourceTileCache.resource_id).filter(
+            ResourceTileCache.enabled)
+
+        if args.resource is not None:
+            resids = map(int, filter(None, args.resource.split(',')))
+            query = query.filter(ResourceTileCache.resource_id.in_(resids))
 
-        # TODO: Add arbitrary SRS support
-        srs_tr = Transformer.from_crs(4326, 3857, always_xy=True)
+        if args.zoom is None:
+            query = query.filter(
+                ResourceTileCache.seed_z != None)  # NOQA: E711
+
+        tc_ids = [row.resource_id for row in query.all()]
+
+        msize = env.render.tile_cache_metatile
 
         for tc_id in tc_ids:
             tc = ResourceTileCache.filter_by(resource_id=tc_id).one()
 
+            # Tiles are seeded in the tile grid of the style SRS
             rend_res = tc.resource
             data_res = rend_res.parent
-            srs = data_res.srs
-
-            # TODO: Add arbitrary SRS support
-            extent_4326 = data_res.extent
-            extent = srs_tr.transform(extent_4326['minLon'], extent_4326['minLat']) + \
-                srs_tr.transform(extent_4326['maxLon'], extent_4326['maxLat'])
-
-            rlevel = list()
-            rcount = 0
-
-            for z in range(1, tc.seed_z + 1):
-                atf = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
-
-                t_lb = tuple(atf * extent[0:2])
-                t_rt = tuple(atf * extent[2:4])
-
-                tb = (
-                    int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
-                    int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
-                    int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
-                    int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
-                )
-
-                rx = (min(tb[0], tb[2]), max(tb[0], tb[2]))
-                ry = (min(tb[1], tb[3]), max(tb[1], tb[3]))
-
-                count = (rx[1] - rx[0]) * (ry[1] - ry[0])
-                rcount += count
-                rlevel.append((z, rx, ry, count))
-
-            tc.update_seed_status('started')
+            srs = rend_res.srs
 
-            # Reload expired session objects
+            # Tiles intersecting features are selected in the database if the
+            # data resource supports it, otherwise all tiles of its extent
+            # are seeded.
+            query = data_res.feature_query() \
+                if IFeatureLayer.providedBy(data_res) else None
+            if query is not None and IFeatureQueryTiles.providedBy(query):
+                query.srs(srs)
+                extent = None
+            else:
+                query = None
+                extent = _extent(data_res, srs)
+                if extent is None:
+                    _logger.info(
+                        "Resource %d has no features, nothing to seed",
+                        data_res.id)
+                    continue
+
+            seed_z = args.zoom if args.zoom is not None else tc.seed_z
+
+            jobs, counts = _seed_jobs(
+                tc_id, seed_z, msize, query=query, extent=extent, srs=srs)
+            rcount = sum(counts)
+
+            # Jobs completed by the interrupted or failed seeding with the
+            # same parameters are skipped.
+            skip, saved = 0, 0
+            if (
+                args.resume and tc.seed_status in ('started', 'progress', 'error')
+                and tc.seed_total == rcount and tc.seed_progress  # NOQA: W503
+            ):
+                skip, saved = _seed_resume(counts, tc.seed_progress)
+
+                _logger.info(
+                    "Resuming seeding tile cache for resource %d from %d tiles",
+                    tc.resource_id, saved)
+
+            tc.update_seed_status('started', progress=saved, total=rcount)
             transaction.commit()
-            tc = ResourceTileCache.filter_by(resource_id=tc.resource_id).one()
-            rend_res = tc.resource
-            srs = rend_res.srs
 
-            _logger.info("Seeding tile cache for resource %d with %d tiles", rend_res.id, rcount)
+            _logger.info(
+                "Seeding tile cache for resource %d with %d tiles in %d jobs",
+                tc_id, rcount, len(jobs) - skip)
 
-            progress = 0
+            progress = saved
             rendered = 0
 
+            seed_progress = _SeedProgress(counts, skip, saved)
+
             b_start = datetime.utcnow()
 
-            for z, rx, ry, count in rlevel:
-                # TODO: Add meta tile support
-                for x, y in product(range(*rx), range(*ry)):
-                    if tc.get_tile((z, x, y)) is None:
-                        req = rend_res.render_request(srs)
-                        rimg = req.render_tile((z, x, y), 256)
-                        tc.put_tile((z, x, y), rimg)
-                        rendered += 1
+            try:
+                for index, processed, jrendered in _seed_map(jobs[skip:], args.workers):
+                    progress += processed
+                    rendered += jrendered
 
-                    progress += 1
+                    saved = seed_progress.complete(index)
 
-                    if (progress % SEED_STEP) == 0 and (
-                        (datetime.utcnow() - b_start).total_seconds() > SEED_INTERVAL
-                    ):
+                    if (datetime.utcnow() - b_start).total_seconds() > SEED_INTERVAL:
                         b_start = datetime.utcnow()
-                        tc.update_seed_status('progress', progress=progress, total=rcount)
-
-                        # Reload expired session objects
-                        transaction.commit()
-                        tc = ResourceTileCache.filter_by(resource_id=tc.resource_id).one()
-                        rend_res = tc.resource
-                        srs = rend_res.srs
+                        _update_seed_status(tc_id, 'progress', progress=saved, total=rcount)
 
                         _logger.debug(
                             "%d tiles processed and %d rendered for resource %d (%.2f)",
-                            progress, rendered, rend_res.id, 100.0 * progress / rcount)
+                            progress, rendered, tc_id, 100.0 * progress / rcount)
 
-            tc.update_seed_status('completed', total=rcount)
-            transaction.commit()
+            except Exception:
+                _update_seed_status(tc_id, 'error', progress=saved, total=rcount)
+                raise
+
+            _update_seed_status(tc_id, 'completed', total=rcount)
 
             _logger.info(
                 "Completed seeding cache for resource %d (%d tiles processed, %d rendered)",
-                rend_res.id, progress, rendered)
+                tc_id, progress, rendered)
@@ -5,17 +5,15 @@ from uuid import uuid4
 from StringIO import StringIO
 from os import makedirs
 from errno import EEXIST
+import logging
 import struct
 import os.path
-import sqlite3
 
-from PIL import Image
-from sqlalchemy import MetaData, Table
-from zope.sqlalchemy import mark_changed
+import transaction
 
 from ..env import env
 from .. import db
-from ..models import declarative_base, DBSession
+from ..models import declarative_base
 from ..resource import (
     Resource,
     Serializer,
@@ -25,9 +23,12 @@ from ..resource import (
 
 from .interface import IRenderableStyle
 from .event import on_style_change, on_data_change
-from .util import imgcolor, affine_bounds_to_tile
+from .tilestor import TILE_STORES
+from .util import imgcolor, affine_bounds_to_tile, solid_png
 
 
+_logger = logging.getLogger(__name__)
+
 TIMESTAMP_EPOCH = datetime(year=1970, month=1, day=1)
 
 Base = declarative_base()
@@ -64,60 +65,17 @@ class ResourceTileCache(Base):
 
     @db.reconstructor
     def reconstructor(self):
-        self._sameta = None
-        self._tiletab = None
         self._tilestor = None
 
-    def init_metadata(self):
-        self._sameta = MetaData(schema='tile_cache')
-        self._tiletab = Table(
-            self.uuid.hex, self._sameta,
-            db.Column('z', db.SmallInteger, primary_key=True),
-            db.Column('x', db.Integer, primary_key=True),
-            db.Column('y', db.Integer, primary_key=True),
-            db.Column('color', db.Integer),
-            # We don't need subsecond resolution which TIMESTAMP provides, so
-            # use 4-byte INTEGER type. Say hello to 2038-year problem!
-            db.Column('tstamp', db.Integer, nullable=False),
-        )
-
-    @property
-    def sameta(self):
-        if self._sameta is None:
-            self.init_metadata()
-        return self._sameta
-
-    @property
-    def tiletab(self):
-        if self._tiletab is None:
-            self.init_metadata()
-        return self._tiletab
-
     @property
     def tilestor(self):
-        if self._tilestor is None:
-            try:
-                p = self.tilestor_path(create=False)
-                self._tilestor = sqlite3.connect(p, isolation_level=None)
-            except sqlite3.OperationalError:
-                # SQLite db not found, create it
-                p = self.tilestor_path(create=True)
-                self._tilestor = sqlite3.connect(p, isolation_level=None)
-
-            self._tilestor.text_factory = bytes
-            cur = self._tilestor.cursor()
-
-            # Set page size according to https://www.sqlite.org/intern-v-extern-blob.html
-            cur.execute("PRAGMA page_size = 8192")
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS tile (
-                    z INTEGER, x INTEGER, y INTEGER,
-                    tstamp INTEGER NOT NULL,
-                    data BLOB NOT NULL,
-                    PRIMARY KEY (z, x, y)
-                )
-            """)
+        """ Storage backend selected with ``tile_cache.backend`` setting,
+        see :py:mod:`.tilestor` """
 
+        if self._tilestor is None:
+            cls = TILE_STORES[env.render.tile_cache_backend]
+            self._tilestor = cls(
+                self.tilestor_path(create=True), self.uuid.hex)
         return self._tilestor
 
     def tilestor_path(self, create=False):
@@ -139,19 +97,15 @@ class ResourceTileCache(Base):
         return os.path.join(d, suuid)
 
     def get_tile(self, tile):
-        z, x, y = tile
+        """ Encoded PNG image of the cached tile or None if the tile isn't
+        cached. Solid color tiles are returned from pre-encoded templates,
+        so the image is never decoded or encoded. """
 
-        conn = DBSession.connection()
-        trow = conn.execute(db.sql.text(
-            'SELECT color, tstamp '
-            'FROM tile_cache."{}" '
-            'WHERE z = :z AND x = :x AND y = :y'.format(self.uuid.hex)
-        ), z=z, x=x, y=y).fetchone()
-
-        if trow is None:
+        row = self.tilestor.get(tile)
+        if row is None:
             return None
 
-        color, tstamp = trow
+        tstamp, color, data = row
 
         if self.ttl is not None:
             expdt = TIMESTAMP_EPOCH + timedelta(seconds=tstamp + self.ttl)
@@ -159,100 +113,117 @@ class ResourceTileCache(Base):
                 return None
 
         if color is not None:
-            colort = tuple(map(ord, struct.pack('!i', color)))
-            return Image.new('RGBA', (256, 256), colort)
-
-        else:
-            cur = self.tilestor.cursor()
-            srow = cur.execute(
-                'SELECT data FROM tile WHERE z = ? AND x = ? AND y = ?',
-                (z, x, y)).fetchone()
+            return solid_png(color)
 
-            if srow is None:
-                return None
-            return Image.open(StringIO(srow[0]))
+        return data
 
     def put_tile(self, tile, img):
-        z, x, y = tile
+        return self.put_tiles([(tile, img), ])[tile]
+
+    def put_tiles(self, tiles):
+        """ Put a batch of ``(tile, image)`` tuples, for example tiles of a
+        metatile, they are written to the storage at once
+
+        :return: Dict of encoded PNG images of tiles, same as returned by
+            :py:meth:`get_tile`. """
+
         tstamp = int((datetime.utcnow() - TIMESTAMP_EPOCH).total_seconds())
 
-        colortuple = imgcolor(img)
+        rows = []
+        result = dict()
+        for tile, img in tiles:
+            colortuple = imgcolor(img)
 
-        color = None
-        if colortuple is not None:
-            color = struct.unpack('!i', bytearray(colortuple))[0]
+            color = None
+            data = None
+            if colortuple is not None:
+                color = struct.unpack('!i', bytearray(colortuple))[0]
+                result[tile] = solid_png(color)
+            else:
+                buf = StringIO()
+                img.save(buf, format='PNG')
+                data = result[tile] = buf.getvalue()
 
-        if color is None:
-            buf = StringIO()
-            img.save(buf, format='PNG')
+            rows.append((tile, color, data))
 
-            try:
-                self.tilestor.execute("INSERT INTO tile VALUES (?, ?, ?, ?, ?)", (
-                    z, x, y, tstamp, buf.getvalue()))
-            except sqlite3.IntegrityError:
-                # Ignore if tile already exists: other process can add it
-                # TODO: ON CONFLICT DO NOTHING in SQLite >= 3.24.0
-                pass
-
-        conn = DBSession.connection()
-        conn.execute(db.sql.text(
-            'DELETE FROM tile_cache."{0}" WHERE z = :z AND x = :x AND y = :y; '
-            'INSERT INTO tile_cache."{0}" (z, x, y, color, tstamp) '
-            'VALUES (:z, :x, :y, :color, :tstamp)'.format(self.uuid.hex)
-        ), z=z, x=x, y=y, color=color, tstamp=tstamp)
-
-        # Force zope session management to commit changes
-        mark_changed(DBSession())
+        self.tilestor.put(rows, tstamp)
+        return result
 
     def initialize(self):
-        self.sameta.create_all(bind=DBSession.connection())
+        self.tilestor.initialize()
 
     def clear(self):
-        """ Clear tile cache and remove all tiles """
-        self._sameta = None
-        self._tiletab = None
+        """ Clear tile cache and remove all tiles, storage of removed tiles
+        is destroyed after the transaction is committed """
+
+        tilestor = self.tilestor
+
+        def destroy(success):
+            if not success:
+                return
+
+            try:
+                tilestor.destroy()
+            except Exception:
+                _logger.exception(
+                    "Failed to destroy tile cache storage %s", tilestor.path)
+
+        transaction.get().addAfterCommitHook(destroy)
+
         self._tilestor = None
         self.uuid = uuid4()
         self.initialize()
 
     def invalidate(self, geom):
+        """ Remove tiles intersecting geometry bounds or all tiles if
+        geometry is None. Storages other than PostgreSQL aren't
+        transactional, so tiles are removed from them after commit. Tiles
+        rendered from the changed data before commit aren't kept then, and
+        tiles aren't lost if the transaction is aborted. """
+
         srs = self.resource.srs
-        conn = DBSession.connection()
-
-        # TODO: This query uses sequnce scan and should be rewritten
-        query_z = db.sql.text(
-            'SELECT DISTINCT z FROM tile_cache."{}"'
-            .format(self.uuid.hex))
-
-        query_delete = db.sql.text(
-            'DELETE FROM tile_cache."{0}" '
-            'WHERE z = :z '
-            '   AND x BETWEEN :xmin AND :xmax '
-            '   AND y BETWEEN :ymin AND :ymax '
-            .format(self.uuid.hex))
-
-        zlist = map(lambda a: a[0], conn.execute(query_z).fetchall())
-        for z in zlist:
-            aft = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
-
-            xmin, ymax = map(lambda a: int(a), aft * geom.bounds[0:2])
-            xmax, ymin = map(lambda a: int(a), aft * geom.bounds[2:4])
-
-            xmin -= 1
-            ymin -= 1
-            xmax += 1
-            ymax += 1
-
-            env.render.logger.debug(
-                'Removing tiles for z=%d x=%d..%d y=%d..%d',
-                z, xmin, xmax, ymin, ymax)
-
-            conn.execute(
-                query_delete, z=z,
-                xmin=xmin, ymin=ymin,
-                xmax=xmax, ymax=ymax)
-
-        mark_changed(DBSession())
+        srs_bounds = (srs.minx, srs.miny, srs.maxx, srs.maxy)
+        bounds = geom.bounds if geom is not None else None
+        tilestor = self.tilestor
+
+        def delete():
+            for z in tilestor.zooms():
+                if bounds is None:
+                    xmin, ymin = 0, 0
+                    xmax = ymax = (1 << z) - 1
+                else:
+                    aft = affine_bounds_to_tile(srs_bounds, z)
+
+                    xmin, ymax = map(lambda a: int(a), aft * bounds[0:2])
+                    xmax, ymin = map(lambda a: int(a), aft * bounds[2:4])
+
+                    xmin -= 1
+                    ymin -= 1
+                    xmax += 1
+                    ymax += 1
+
+                env.render.logger.debug(
+                    'Removing tiles for z=%d x=%d..%d y=%d..%d',
+                    z, xmin, xmax, ymin, ymax)
+
+                tilestor.delete(z, (xmin, xmax), (ymin, ymax))
+
+        if tilestor.transactional:
+            delete()
+            return
+
+        def delete_hook(success):
+            if not success:
+                return
+
+            try:
+                delete()
+            except Exception:
+                _logger.exception(
+                    "Failed to remove tiles of tile cache storage %s",
+                    tilestor.path)
+
+        transaction.get().addAfterCommitHook(delete_hook)
 
     def update_seed_status(self, value, progress=None, total=None):
         self.seed_status = value
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import namedtuple
+
+from nextgisweb.render.command import (
+    _SeedProgress,
+    _seed_jobs,
+    _seed_resume)
+
+SRS = namedtuple('SRS', ('minx', 'miny', 'maxx', 'maxy'))
+WEB_MERCATOR = SRS(-20037508.34, -20037508.34, 20037508.34, 20037508.34)
+
+
+class TilesQuery(object):
+
+    def __init__(self, tiles):
+        self._tiles = tiles
+
+    def tiles(self, z, buffer):
+        return self._tiles.get(z, ())
+
+
+def test_jobs_extent():
+    # Slightly inside the bounds to avoid rounding at the grid edges
+    extent = (WEB_MERCATOR.minx + 1, WEB_MERCATOR.miny + 1,
+              WEB_MERCATOR.maxx - 1, WEB_MERCATOR.maxy - 1)
+    jobs, counts = _seed_jobs(1, 3, 1, extent=extent, srs=WEB_MERCATOR)
+
+    # Job side is 4 tiles: 1 job for zoom levels 1 and 2, 4 jobs for 3
+    assert [j[2] for j in jobs] == [1, 2, 3, 3, 3, 3]
+    assert counts == [4, 16, 16, 16, 16, 16]
+    assert [j[0] for j in jobs] == list(range(6))
+    assert jobs[0] == (0, 1, 1, (0, 2), (0, 2), None, 1)
+    assert jobs[3][3:5] == ((0, 4), (4, 8))
+
+    assert sum(counts) == sum(4 ** z for z in range(1, 4))
+    assert _seed_jobs(1, 3, 1, extent=extent, srs=WEB_MERCATOR) \
+        == (jobs, counts)
+
+
+def test_jobs_query():
+    query = TilesQuery({
+        2: [(0, 0), (3, 3)],
+        3: [(0, 0), (1, 1), (5, 0), (7, 7)],
+    })
+    jobs, counts = _seed_jobs(1, 3, 2, query=query)
+
+    # Job side is 8 tiles with 2 tiles metatiles
+    assert counts == [2, 4]
+    assert jobs[0] == (
+        0, 1, 2, (0, 8), (0, 8), frozenset([(0, 0), (3, 3)]), 2)
+    assert jobs[1][5] == frozenset([(0, 0), (1, 1), (5, 0), (7, 7)])
+
+    query = TilesQuery({3: [(0, 0), (1, 1), (5, 0)]})
+    jobs, counts = _seed_jobs(1, 3, 1, query=query)
+    assert counts == [2, 1]
+    assert [j[3:5] for j in jobs] == [((0, 4), (0, 4)), ((4, 8), (0, 4))]
+
+
+def test_resume():
+    counts = [4, 16, 16, 16]
+
+    assert _seed_resume(counts, 0) == (0, 0)
+    assert _seed_resume(counts, 3) == (0, 0)
+    assert _seed_resume(counts, 4) == (1, 4)
+    assert _seed_resume(counts, 30) == (2, 20)
+    assert _seed_resume(counts, 52) == (4, 52)
+    assert _seed_resume(counts, 100) == (4, 52)
+
+
+def test_progress():
+    counts = [4, 16, 16, 16]
+
+    progress = _SeedProgress(counts)
+    assert progress.complete(1) == 0
+    assert progress.complete(2) == 0
+    assert progress.complete(0) == 36
+    assert progress.complete(3) == 52
+
+    # Resumed progress starts from skipped jobs
+    skip, saved = _seed_resume(counts, 30)
+    progress = _SeedProgress(counts, skip, saved)
+    assert progress.complete(3) == 20
+    assert progress.complete(2) == 52
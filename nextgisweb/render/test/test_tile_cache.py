@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 from time import sleep
+from StringIO import StringIO
 from uuid import uuid4
 import logging
+import os.path
 
 import pytest
+import transaction
 from PIL import Image, ImageDraw
 
 from nextgisweb.geometry import Point
@@ -14,10 +17,14 @@ from nextgisweb.spatial_ref_sys import SRS
 from nextgisweb.auth import User
 
 from nextgisweb.render.model import ResourceTileCache
+from nextgisweb.render.tilestor import FilesystemTileStore, MBTilesTileStore
+from nextgisweb.render.util import metatile, render_metatile, solid_png
 
 
-@pytest.fixture
-def frtc(txn):
+@pytest.fixture(params=('postgresql', 'mbtiles', 'filesystem'))
+def frtc(request, env, txn, monkeypatch):
+    monkeypatch.setattr(env.render, 'tile_cache_backend', request.param)
+
     vector_layer = VectorLayer(
         parent_id=0, display_name='from_fields',
         owner_user=User.by_keyname('administrator'),
@@ -51,17 +58,24 @@ def img_fill():
     return result
 
 
+def _decode(data):
+    return Image.open(StringIO(data))
+
+
 def test_put_get_cross(frtc, img_cross, txn):
     tile = (0, 0, 0)
-    frtc.put_tile(tile, img_cross)
-    cimg = frtc.get_tile(tile)
+    data = frtc.put_tile(tile, img_cross)
+    assert frtc.get_tile(tile) == data
+    cimg = _decode(data)
     assert cimg.getextrema() == img_cross.getextrema()
 
 
 def test_put_get_fill(frtc, img_fill, txn):
     tile = (0, 0, 0)
     frtc.put_tile(tile, img_fill)
-    cimg = frtc.get_tile(tile)
+    data = frtc.get_tile(tile)
+    assert data == solid_png(0)
+    cimg = _decode(data)
     assert cimg.getextrema() == img_fill.getextrema()
 
 
@@ -85,6 +99,30 @@ def test_clear(frtc, img_cross, txn):
     assert frtc.get_tile(tile) is None
 
 
+STORE_SUFFIX = dict(postgresql='', mbtiles='.mbtiles', filesystem='.tiles')
+
+
+def test_clear_destroy(frtc, img_cross, txn):
+    tile = (0, 0, 0)
+    frtc.put_tile(tile, img_cross)
+
+    tilestor = frtc.tilestor
+    path = tilestor.path + STORE_SUFFIX[tilestor.identity]
+    assert os.path.exists(path)
+
+    frtc.clear()
+    assert os.path.exists(path)
+
+    # Storage is destroyed only after commit
+    hook, args, kwargs = list(transaction.get().getAfterCommitHooks())[-1]
+    hook(False, *args, **kwargs)
+    assert os.path.exists(path)
+
+    hook(True, *args, **kwargs)
+    assert not os.path.exists(path)
+    assert frtc.get_tile(tile) is None
+
+
 def test_invalidate(frtc, img_cross, txn, caplog):
     caplog.set_level(logging.DEBUG)
     tile_invalid = (4, 0, 0)
@@ -97,5 +135,95 @@ def test_invalidate(frtc, img_cross, txn, caplog):
         *frtc.resource.srs.tile_center(tile_invalid),
         srid=None))
 
+    if not frtc.tilestor.transactional:
+        # Tiles are removed after commit only
+        hook, args, kwargs = list(
+            transaction.get().getAfterCommitHooks())[-1]
+        hook(False, *args, **kwargs)
+        assert frtc.get_tile(tile_invalid) is not None
+
+        hook(True, *args, **kwargs)
+
     assert frtc.get_tile(tile_invalid) is None
-    assert frtc.get_tile(tile_valid).getextrema() == img_cross.getextrema()
+    assert _decode(frtc.get_tile(tile_valid)).getextrema() == img_cross.getextrema()
+
+
+def test_invalidate_all(frtc, img_cross, txn):
+    tiles = [(0, 0, 0), (4, 0, 0), (4, 15, 15)]
+    for tile in tiles:
+        frtc.put_tile(tile, img_cross)
+
+    frtc.invalidate(None)
+
+    if not frtc.tilestor.transactional:
+        hook, args, kwargs = list(
+            transaction.get().getAfterCommitHooks())[-1]
+        hook(True, *args, **kwargs)
+
+    assert all(frtc.get_tile(tile) is None for tile in tiles)
+
+
+def test_put_tiles(frtc, img_cross, img_fill, txn):
+    frtc.put_tiles([((1, 0, 0), img_cross), ((1, 1, 0), img_fill)])
+    assert _decode(frtc.get_tile((1, 0, 0))).getextrema() == img_cross.getextrema()
+    assert _decode(frtc.get_tile((1, 1, 0))).getextrema() == img_fill.getextrema()
+
+
+@pytest.mark.parametrize('tile, size, expected', (
+    ((0, 0, 0), 4, (0, 0, 0, 1, 1)),
+    ((1, 1, 0), 4, (1, 0, 0, 2, 2)),
+    ((4, 5, 14), 4, (4, 4, 12, 4, 4)),
+    ((4, 5, 14), 1, (4, 5, 14, 1, 1)),
+))
+def test_metatile(tile, size, expected):
+    assert metatile(tile, size) == expected
+
+
+def test_render_metatile(txn):
+    srs = SRS.filter_by(id=3857).one()
+
+    class RenderRequest(object):
+        def render_extent(self, extent, size):
+            self.extent = extent
+            self.size = size
+            return Image.new('RGBA', size)
+
+    req = RenderRequest()
+    tiles = render_metatile(req, srs, metatile((2, 3, 1), 2))
+
+    assert req.size == (512, 512)
+    assert req.extent == pytest.approx((0, 0, srs.maxx, srs.maxy))
+    assert sorted(t for t, img in tiles) == [
+        (2, 2, 0), (2, 2, 1), (2, 3, 0), (2, 3, 1)]
+    assert all(img.size == (256, 256) for t, img in tiles)
+
+
+def test_mbtiles_scheme(tmpdir):
+    store = MBTilesTileStore(str(tmpdir.join('test')), 'test')
+    store.put([((1, 0, 0), None, b'data')], 0)
+
+    # Rows are numbered from the bottom in TMS scheme
+    assert store.conn.execute('SELECT tile_row FROM tiles').fetchone()[0] == 1
+    assert store.get((1, 0, 0)) == (0, None, b'data')
+    assert store.zooms() == [1, ]
+
+    store.delete(1, (0, 0), (0, 0))
+    assert store.get((1, 0, 0)) is None
+
+
+def test_mbtiles_destroy(tmpdir):
+    store = MBTilesTileStore(str(tmpdir.join('test')), 'test')
+    store.put([((1, 0, 0), None, b'data')], 0)
+    store.destroy()
+    assert tmpdir.listdir() == []
+
+    # Connection to removed database is reopened
+    assert store.get((1, 0, 0)) is None
+
+
+def test_filesystem_destroy(tmpdir):
+    store = FilesystemTileStore(str(tmpdir.join('test')), 'test')
+    store.put([((1, 0, 0), None, b'data')], 0)
+    store.destroy()
+    assert tmpdir.listdir() == []
+    assert store.zooms() == []
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+""" Storage backends of the tile cache. Each backend keeps tile content with
+its timestamp and color of solid color tiles, which is used instead of
+content if it's set. The backend is selected with ``tile_cache.backend``
+setting:
+
+* ``postgresql`` - tile index in a PostgreSQL table and content of non-solid
+  tiles in a SQLite database, which is the original layout.
+* ``mbtiles`` - single MBTiles-compatible SQLite database per tile cache.
+* ``filesystem`` - PNG files in ``z/x/y.png`` directory structure with file
+  modification time as tile timestamp.
+
+Backends other than ``postgresql`` don't access PostgreSQL, so reading a
+cached tile doesn't take a database round-trip. """
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+import uuid
+from errno import ENOENT
+
+from sqlalchemy import MetaData, Table
+from zope.sqlalchemy import mark_changed
+
+from .. import db
+from ..env import env
+from ..models import DBSession
+
+from .util import solid_png
+
+
+TILE_STORES = dict()
+
+_local = threading.local()
+
+
+def _register(cls):
+    TILE_STORES[cls.identity] = cls
+    return cls
+
+
+def _sqlite_connection(path, setup):
+    """ Connection to SQLite database which is reused within the thread,
+    SQLite connections can't be shared between threads and processes """
+
+    conns = getattr(_local, 'sqlite', None)
+    if conns is None:
+        conns = _local.sqlite = dict()
+
+    # Forked processes inherit thread-local data of the parent
+    key = (os.getpid(), path)
+
+    conn = conns.get(key)
+    if conn is None:
+        # Connections to databases removed by other threads can't be
+        # closed by them, so they are closed on opening a new one.
+        for k in [k for k in conns if not os.path.exists(k[1])]:
+            conns.pop(k).close()
+
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.text_factory = bytes
+        setup(conn)
+        conns[key] = conn
+
+    return conn
+
+
+def _sqlite_remove(path):
+    """ Close the connection of the thread and remove SQLite database files,
+    including write-ahead log and shared memory files """
+
+    conns = getattr(_local, 'sqlite', None)
+    if conns is not None:
+        conn = conns.pop((os.getpid(), path), None)
+        if conn is not None:
+            conn.close()
+
+    for fn in (path, path + '-wal', path + '-shm', path + '-journal'):
+        try:
+            os.remove(fn)
+        except OSError as exc:
+            if exc.errno != ENOENT:
+                raise
+
+
+def _sqlite_batch(conn, sql, rows):
+    cur = conn.cursor()
+    cur.execute('BEGIN')
+    try:
+        cur.executemany(sql, rows)
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+
+
+class TileStore(object):
+    """ Base class of tile cache storage backends
+
+    :param path: Path to storage files without extension, it's unique for
+        each tile cache and changed when the tile cache is cleared.
+    :param name: Name of the tile cache. """
+
+    identity = None
+
+    # Changes are made within the database transaction
+    transactional = False
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+    def initialize(self):
+        """ Create storage for the new tile cache """
+        pass
+
+    def destroy(self):
+        """ Remove storage of the cleared tile cache, it's called after the
+        transaction is committed, so the storage isn't used anymore """
+        pass
+
+    def get(self, tile):
+        """ Tuple ``(tstamp, color, data)`` or None if the tile isn't stored,
+        data is None if color is set """
+        raise NotImplementedError()
+
+    def put(self, tiles, tstamp):
+        """ Store a batch of tiles, where tiles is a list of ``(tile, color,
+        data)`` tuples and data is None if color is set """
+        raise NotImplementedError()
+
+    def zooms(self):
+        """ Zoom levels of stored tiles """
+        raise NotImplementedError()
+
+    def delete(self, z, rx, ry):
+        """ Delete tiles of the zoom level in inclusive ranges of columns
+        rx and rows ry """
+        raise NotImplementedError()
+
+
+@_register
+class PostgreSQLTileStore(TileStore):
+    identity = 'postgresql'
+    transactional = True
+
+    def __init__(self, path, name):
+        super(PostgreSQLTileStore, self).__init__(path, name)
+
+        self.sameta = MetaData(schema='tile_cache')
+        self.tiletab = Table(
+            name, self.sameta,
+            db.Column('z', db.SmallInteger, primary_key=True),
+            db.Column('x', db.Integer, primary_key=True),
+            db.Column('y', db.Integer, primary_key=True),
+            db.Column('color', db.Integer),
+            # We don't need subsecond resolution which TIMESTAMP provides, so
+            # use 4-byte INTEGER type. Say hello to 2038-year problem!
+            db.Column('tstamp', db.Integer, nullable=False),
+        )
+
+    @property
+    def tilestor(self):
+        def setup(conn):
+            cur = conn.cursor()
+
+            # Set page size according to https://www.sqlite.org/intern-v-extern-blob.html
+            cur.execute("PRAGMA page_size = 8192")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS tile (
+                    z INTEGER, x INTEGER, y INTEGER,
+                    tstamp INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (z, x, y)
+                )
+            """)
+
+        return _sqlite_connection(self.path, setup)
+
+    def initialize(self):
+        self.sameta.create_all(bind=DBSession.connection())
+
+    def destroy(self):
+        conn = env.core.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+        try:
+            conn.execute(
+                'DROP TABLE IF EXISTS tile_cache."{}"'.format(self.name))
+        finally:
+            conn.close()
+
+        _sqlite_remove(self.path)
+
+    def get(self, tile):
+        z, x, y = tile
+
+        conn = DBSession.connection()
+        trow = conn.execute(db.sql.text(
+            'SELECT color, tstamp '
+            'FROM tile_cache."{}" '
+            'WHERE z = :z AND x = :x AND y = :y'.format(self.name)
+        ), z=z, x=x, y=y).fetchone()
+
+        if trow is None:
+            return None
+
+        color, tstamp = trow
+        if color is not None:
+            return tstamp, color, None
+
+        srow = self.tilestor.execute(
+            'SELECT data FROM tile WHERE z = ? AND x = ? AND y = ?',
+            (z, x, y)).fetchone()
+
+        if srow is None:
+            return None
+        return tstamp, None, srow[0]
+
+    def put(self, tiles, tstamp):
+        blobs = [
+            (z, x, y, tstamp, sqlite3.Binary(data))
+            for (z, x, y), color, data in tiles if data is not None]
+
+        if len(blobs) > 0:
+            # Tile may be already added by other process or left after
+            # invalidation, which removes only PostgreSQL records
+            _sqlite_batch(
+                self.tilestor,
+                'INSERT OR REPLACE INTO tile VALUES (?, ?, ?, ?, ?)',
+                blobs)
+
+        conn = DBSession.connection()
+        conn.execute(db.sql.text(
+            'DELETE FROM tile_cache."{0}" WHERE z = :z AND x = :x AND y = :y; '
+            'INSERT INTO tile_cache."{0}" (z, x, y, color, tstamp) '
+            'VALUES (:z, :x, :y, :color, :tstamp)'.format(self.name)
+        ), [
+            dict(z=z, x=x, y=y, color=color, tstamp=tstamp)
+            for (z, x, y), color, data in tiles])
+
+        # Force zope session management to commit changes
+        mark_changed(DBSession())
+
+    def zooms(self):
+        # TODO: This query uses sequnce scan and should be rewritten
+        return [row[0] for row in DBSession.connection().execute(db.sql.text(
+            'SELECT DISTINCT z FROM tile_cache."{}"'.format(self.name)))]
+
+    def delete(self, z, rx, ry):
+        DBSession.connection().execute(db.sql.text(
+            'DELETE FROM tile_cache."{0}" '
+            'WHERE z = :z '
+            '   AND x BETWEEN :xmin AND :xmax '
+            '   AND y BETWEEN :ymin AND :ymax '
+            .format(self.name)
+        ), z=z, xmin=rx[0], xmax=rx[1], ymin=ry[0], ymax=ry[1])
+
+        mark_changed(DBSession())
+
+
+@_register
+class MBTilesTileStore(TileStore):
+    """ MBTiles database with additional tstamp and color columns in tiles
+    table. Rows of tiles table are in TMS scheme, where rows are numbered
+    from the bottom. Solid color tiles are stored as PNG images too, so the
+    database can be read by other MBTiles clients. """
+
+    identity = 'mbtiles'
+
+    @property
+    def conn(self):
+        name = self.name
+
+        def setup(conn):
+            cur = conn.cursor()
+
+            # Concurrent readers aren't blocked by a writer in WAL mode
+            cur.execute("PRAGMA journal_mode = WAL")
+            cur.execute("PRAGMA synchronous = NORMAL")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_data BLOB NOT NULL,
+                    tstamp INTEGER NOT NULL,
+                    color INTEGER,
+                    PRIMARY KEY (zoom_level, tile_column, tile_row)
+                )
+            """)
+            cur.executemany(
+                "INSERT OR IGNORE INTO metadata VALUES (?, ?)",
+                (('name', name), ('format', 'png')))
+
+        return _sqlite_connection(self.path + '.mbtiles', setup)
+
+    def destroy(self):
+        _sqlite_remove(self.path + '.mbtiles')
+
+    def get(self, tile):
+        z, x, y = tile
+
+        row = self.conn.execute(
+            'SELECT tstamp, color, tile_data FROM tiles '
+            'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, (1 << z) - 1 - y)).fetchone()
+
+        if row is None:
+            return None
+
+        tstamp, color, data = row
+        return tstamp, color, data if color is None else None
+
+    def put(self, tiles, tstamp):
+        _sqlite_batch(
+            self.conn,
+            'INSERT OR REPLACE INTO tiles '
+            '(zoom_level, tile_column, tile_row, tile_data, tstamp, color) '
+            'VALUES (?, ?, ?, ?, ?, ?)', [
+                (z, x, (1 << z) - 1 - y, sqlite3.Binary(
+                    data if color is None else solid_png(color)),
+                    tstamp, color)
+                for (z, x, y), color, data in tiles])
+
+    def zooms(self):
+        return [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT zoom_level FROM tiles')]
+
+    def delete(self, z, rx, ry):
+        tmax = (1 << z) - 1
+        self.conn.execute(
+            'DELETE FROM tiles WHERE zoom_level = ? '
+            '   AND tile_column BETWEEN ? AND ? '
+            '   AND tile_row BETWEEN ? AND ?',
+            (z, rx[0], rx[1], tmax - ry[1], tmax - ry[0]))
+
+
+@_register
+class FilesystemTileStore(TileStore):
+    """ PNG files in ``z/x/y.png`` directory structure, which can be served
+    directly by a web server. Solid color tiles are stored as PNG images and
+    read as regular tiles. """
+
+    identity = 'filesystem'
+
+    def _dir(self):
+        return self.path + '.tiles'
+
+    def _filename(self, tile):
+        z, x, y = tile
+        return os.path.join(self._dir(), '%d' % z, '%d' % x, '%d.png' % y)
+
+    def destroy(self):
+        shutil.rmtree(self._dir(), ignore_errors=True)
+
+    def get(self, tile):
+        filename = self._filename(tile)
+        try:
+            with open(filename, 'rb') as fd:
+                tstamp = int(os.fstat(fd.fileno()).st_mtime)
+                return tstamp, None, fd.read()
+        except IOError as exc:
+            if exc.errno == ENOENT:
+                return None
+            raise
+
+    def put(self, tiles, tstamp):
+        for tile, color, data in tiles:
+            filename = self._filename(tile)
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Ignore if created concurrently by other process
+                    if not os.path.isdir(dirname):
+                        raise
+
+            # Readers shouldn't see partially written files
+            tmp = '%s.%s' % (filename, uuid.uuid4().hex)
+            with open(tmp, 'wb') as fd:
+                fd.write(data if color is None else solid_png(color))
+            os.utime(tmp, (tstamp, tstamp))
+            os.rename(tmp, filename)
+
+    def _ints(self, path):
+        if not os.path.isdir(path):
+            return []
+        return [int(n) for n in os.listdir(path) if n.isdigit()]
+
+    def zooms(self):
+        return self._ints(self._dir())
+
+    def delete(self, z, rx, ry):
+        zdir = os.path.join(self._dir(), '%d' % z)
+        for x in self._ints(zdir):
+            if not rx[0] <= x <= rx[1]:
+                continue
+
+            xdir = os.path.join(zdir, '%d' % x)
+            for fn in os.listdir(xdir):
+                y, ext = os.path.splitext(fn)
+                if ext == '.png' and y.isdigit() and ry[0] <= int(y) <= ry[1]:
+                    try:
+                        os.remove(os.path.join(xdir, fn))
+                    except OSError as exc:
+                        if exc.errno != ENOENT:
+                            raise
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import struct
+from itertools import product
+from StringIO import StringIO
 
+import PIL.Image
 import PIL.ImageStat
 from affine import Affine
+from backports.functools_lru_cache import lru_cache
 
 from ..i18n import trstring_factory
 
@@ -30,6 +35,17 @@ def imgcolor(img):
     return map(lambda c: c[0], extrema)
 
 
+@lru_cache(maxsize=256)
+def solid_png(color, size=256):
+    """ Encoded PNG image of the solid color tile, where color is RGBA packed
+    into signed integer like in the tile cache. Images are encoded once. """
+
+    colort = tuple(map(ord, struct.pack('!i', color)))
+    buf = StringIO()
+    PIL.Image.new('RGBA', (size, size), colort).save(buf, format='PNG')
+    return buf.getvalue()
+
+
 def af_transform(a, b):
     """ Crate affine transform from coordinate system A to B """
     return ~(
@@ -54,3 +70,43 @@ def affine_bounds_to_tile(bounds, zoom):
     tilemax = 2 ** zoom
     return affine_from_bounds(
         bounds, (0, tilemax, tilemax, 0))
+
+
+def metatile(tile, size):
+    """ Metatile of size x size tiles containing the tile, metatiles are
+    aligned to the tile grid of the zoom level and clipped by it.
+
+    :return: Tuple ``(z, x, y, width, height)``, where x and y are
+        coordinates of the top left tile and width and height are in tiles. """
+
+    z, x, y = tile
+    tilemax = 2 ** z
+    mx = x - x % size
+    my = y - y % size
+    return (z, mx, my, min(size, tilemax - mx), min(size, tilemax - my))
+
+
+def render_metatile(req, srs, meta, tile_size=256):
+    """ Render metatile with a single ``render_extent`` call of the render
+    request and slice it into tiles, so per-call overhead of the renderer
+    is paid once per metatile and labels aren't clipped at inner edges.
+
+    :return: List of ``(tile, image)`` tuples. """
+
+    z, mx, my, width, height = meta
+
+    # Bottom left and top right tiles of the metatile
+    lb = srs.tile_extent((z, mx, my + height - 1))
+    rt = srs.tile_extent((z, mx + width - 1, my))
+
+    img = req.render_extent(
+        (lb[0], lb[1], rt[2], rt[3]),
+        (width * tile_size, height * tile_size))
+
+    result = []
+    for dx, dy in product(range(width), range(height)):
+        offset = (dx * tile_size, dy * tile_size)
+        result.append(((z, mx + dx, my + dy), img.crop(
+            offset + (offset[0] + tile_size, offset[1] + tile_size))))
+
+    return result
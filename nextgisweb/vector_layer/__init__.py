@@ -5,6 +5,7 @@ from ..component import Component, require
 from ..core import BackupBase, TableBackup, SequenceBackup
 
 from .model import Base, TableInfo, VectorLayer
+from . import command  # NOQA
 
 
 @BackupBase.registry.register
@@ -39,6 +40,9 @@ class VectorLayerComponent(Component):
         for l in VectorLayer.query():
             yield VectorLayerBackup(self, l.id)
             yield TableBackup(self, 'vector_layer.' + l._tablename)
+            if l.generalized:
+                yield TableBackup(
+                    self, 'vector_layer.' + l._tablename + '_gen')
 
             for col in l.__table__.columns:
                 if col.primary_key:
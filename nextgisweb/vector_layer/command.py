@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+
+import transaction
+
+from ..command import Command
+
+from .model import VectorLayer
+
+
+_logger = logging.getLogger(__name__)
+
+
+@Command.registry.register
+class GeneralizeCommand():
+    identity = 'vector_layer.generalize'
+
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        parser.add_argument(
+            '--force', action='store_true', default=False,
+            help="Rebuild generalized geometries of all layers")
+
+    @classmethod
+    def execute(cls, args, env):
+        query = VectorLayer.query()
+        if not args.force:
+            query = query.filter_by(generalized=False)
+
+        for resource_id, in query.with_entities(VectorLayer.id).all():
+            with transaction.manager:
+                resource = VectorLayer.filter_by(id=resource_id).one()
+                if resource.generalize():
+                    _logger.info(
+                        "Vector layer ID=%d generalized", resource_id)
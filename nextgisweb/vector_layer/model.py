@@ -8,10 +8,18 @@ import zipfile
 import tempfile
 import shutil
 import ctypes
+import struct
+import binascii
+import logging
+from StringIO import StringIO
 
 from backports.functools_lru_cache import lru_cache
+from collections import OrderedDict
 from datetime import datetime, time, date
+from threading import Lock
 from zope.interface import implements
+from zope.sqlalchemy import mark_changed
+import transaction
 from osgeo import ogr, osr
 
 from sqlalchemy.sql import ColumnElement
@@ -37,7 +45,7 @@ from ..resource import (
     ResourceGroup)
 from ..resource.exception import ValidationError, ResourceError
 from ..env import env
-from ..geometry import geom_from_wkb, box
+from ..geometry import geom_from_wkb, geom_from_wkt, box
 from ..models import declarative_base, DBSession
 from ..layer import SpatialLayerMixin, IBboxLayer
 
@@ -53,17 +61,37 @@ from ..feature_layer import (
     GEOM_TYPE_OGR,
     FIELD_TYPE,
     FIELD_TYPE_OGR,
+    COUNT_MODE,
     IFeatureLayer,
     IWritableFeatureLayer,
+    IFeatureLayerRevision,
     IFeatureQuery,
     IFeatureQueryFilter,
     IFeatureQueryFilterBy,
     IFeatureQueryLike,
     IFeatureQueryIntersects,
     IFeatureQueryOrderBy,
+    IFeatureQueryKeyset,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
+    IFeatureQueryMVT,
+    IFeatureQueryTotalCount,
+    IFeatureQueryTiles,
     on_data_change)
+from ..feature_layer.util import (
+    keyset_clause,
+    explain_rows,
+    update_from_values,
+    SEARCH_DATATYPES,
+    search_index_ddl,
+    drop_invalid_index,
+    like_clause,
+    MVT_GEOM,
+    MVT_ID,
+    mvt_version,
+    mvt_geom,
+    mvt_query,
+    tiles_query)
 
 from .util import _
 
@@ -87,11 +115,77 @@ _GEOM_OGR_2_TYPE = dict(zip(GEOM_TYPE_OGR, GEOM_TYPE.enum * 2))
 _GEOM_TYPE_2_DB = dict(zip(GEOM_TYPE.enum, GEOM_TYPE_DB))
 
 _FIELD_TYPE_2_ENUM = dict(zip(FIELD_TYPE_OGR, FIELD_TYPE.enum))
+
+_GEOM_OGR_MULTI = {
+    ogr.wkbPoint: ogr.wkbMultiPoint,
+    ogr.wkbLineString: ogr.wkbMultiLineString,
+    ogr.wkbPolygon: ogr.wkbMultiPolygon}
 _FIELD_TYPE_2_DB = dict(zip(FIELD_TYPE.enum, FIELD_TYPE_DB))
 
+# Number of features sent to PostgreSQL with a single COPY statement
+COPY_BATCH_SIZE = 10000
+
+# Zoom levels for which generalized geometries are stored. Tolerance of a
+# level is the width of SRS divided by GENERALIZE_PIXELS * 2 ^ level, what
+# matches the default MVT simplification at this zoom level.
+GENERALIZE_LEVELS = (2, 4, 6, 8)
+GENERALIZE_PIXELS = 512
+
+# Point geometries can't be simplified, so they aren't generalized
+_GENERALIZE_GEOM_TYPES = (
+    GEOM_TYPE.LINESTRING, GEOM_TYPE.POLYGON,
+    GEOM_TYPE.MULTILINESTRING, GEOM_TYPE.MULTIPOLYGON)
+
+_logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
+def _ewkb_hex(geom, srid):
+    """ Convert OGR geometry to hex-encoded EWKB with SRID """
+    wkb = bytes(geom.ExportToWkb(ogr.wkbNDR))
+    gtype, = struct.unpack(b'<I', wkb[1:5])
+    return binascii.hexlify(
+        wkb[0:1] + struct.pack(b'<II', gtype | 0x20000000, srid) + wkb[5:])
+
+
+def _osr_postgis_srid(conn, osr_srs):
+    """ SRID of OSR spatial reference in PostGIS spatial_ref_sys table if it
+    can be identified by EPSG code, otherwise None """
+
+    osr_srs = osr_srs.Clone()
+    if osr_srs.GetAuthorityName(None) != 'EPSG':
+        osr_srs.AutoIdentifyEPSG()
+    if osr_srs.GetAuthorityName(None) != 'EPSG':
+        return None
+
+    srid = int(osr_srs.GetAuthorityCode(None))
+    if conn.execute(db.sql.text(
+        'SELECT 1 FROM spatial_ref_sys WHERE srid = :srid'
+    ), srid=srid).scalar() is None:
+        return None
+
+    return srid
+
+
+def _copy_value(value):
+    """ Format value for PostgreSQL COPY text format """
+    if value is None:
+        return b'\\N'
+    elif isinstance(value, (date, time)):
+        value = value.isoformat()
+    elif isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, basestring):
+        value = str(value)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return value.replace(b'\\', b'\\\\').replace(b'\t', b'\\t') \
+        .replace(b'\n', b'\\n').replace(b'\r', b'\\r')
+
+
 class FieldDef(object):
 
     def __init__(self, key, keyname, datatype, uuid, display_name=None):
@@ -106,8 +200,10 @@ class TableInfo(object):
 
     def __init__(self, srs_id):
         self.srs_id = srs_id
+        self.generalized = False
         self.metadata = None
         self.table = None
+        self.gtable = None
         self.model = None
 
     @classmethod
@@ -118,21 +214,28 @@ class TableInfo(object):
         self.geometry_type = _GEOM_OGR_2_TYPE[ltype]
         self.accepted_gtype = [ltype, ]
 
-        if ltype in (ogr.wkbPoint, ogr.wkbLineString, ogr.wkbPolygon):
-            for feature in ogrlayer:
+        # Only the first chunk of features is checked for multi-geometries,
+        # if they are found later, the table is upgraded while loading, see
+        # load_from_ogr.
+        if ltype in _GEOM_OGR_MULTI:
+            for idx, feature in enumerate(ogrlayer):
+                if idx >= COPY_BATCH_SIZE:
+                    break
+
                 geom = feature.GetGeometryRef()
+                if geom is None:
+                    continue
+
                 gtype = geom.GetGeometryType() & (~ogr.wkb25DBit)
-                if ltype != gtype and (
-                    (ltype == ogr.wkbPoint and gtype == ogr.wkbMultiPoint) or
-                    (ltype == ogr.wkbLineString and gtype == ogr.wkbMultiLineString) or
-                    (ltype == ogr.wkbPolygon and gtype == ogr.wkbMultiPolygon)
-                ):
+                if gtype == _GEOM_OGR_MULTI[ltype]:
                     self.geometry_type = _GEOM_OGR_2_TYPE[gtype]
                     self.accepted_gtype.append(gtype)
                     break
 
             ogrlayer.ResetReading()
 
+        self.generalized = self.geometry_type in _GENERALIZE_GEOM_TYPES
+
         self.fields = []
 
         defn = ogrlayer.GetLayerDefn()
@@ -174,6 +277,7 @@ class TableInfo(object):
     def from_fields(cls, fields, srs_id, geometry_type):
         self = cls(srs_id)
         self.geometry_type = geometry_type
+        self.generalized = geometry_type in _GENERALIZE_GEOM_TYPES
         self.fields = []
 
         for fld in fields:
@@ -193,6 +297,7 @@ class TableInfo(object):
         self = cls(layer.srs_id)
 
         self.geometry_type = layer.geometry_type
+        self.generalized = layer.generalized
 
         self.fields = []
         for f in layer.fields:
@@ -212,6 +317,7 @@ class TableInfo(object):
 
     def setup_layer(self, layer):
         layer.geometry_type = self.geometry_type
+        layer.generalized = self.generalized
 
         layer.fields = []
         for f in self.fields:
@@ -234,52 +340,213 @@ class TableInfo(object):
                 for k, v in kwargs.iteritems():
                     setattr(self, k, v)
 
+        if tablename is None:
+            tablename = 'lvd_' + str(uuid.uuid4().hex)
+
         table = db.Table(
-            tablename if tablename else ('lvd_' + str(uuid.uuid4().hex)),
-            metadata, db.Column('id', db.Integer, primary_key=True),
+            tablename, metadata,
+            db.Column('id', db.Integer, primary_key=True),
             db.Column('geom', ga.Geometry(
                 dimension=2, srid=self.srs_id,
-                geometry_type=geom_fldtype)),
+                geometry_type=geom_fldtype,
+                spatial_index=False)),
             *map(lambda (fld): db.Column(fld.key, _FIELD_TYPE_2_DB[
                 fld.datatype]), self.fields)
         )
 
+        # Index name is the same as GeoAlchemy's implicit spatial index
+        # name, which was used for previously created layers.
+        db.Index(
+            'idx_%s_geom' % tablename, table.columns.geom,
+            postgresql_using='gist')
+
+        if self.generalized:
+            # Generalized geometries of features, one row per feature and
+            # level, see GENERALIZE_LEVELS.
+            gtable = db.Table(
+                tablename + '_gen', metadata,
+                db.Column('id', db.Integer, db.ForeignKey(
+                    table.columns.id, ondelete='CASCADE'), primary_key=True),
+                db.Column('level', db.SmallInteger, primary_key=True),
+                db.Column('geom', ga.Geometry(
+                    dimension=2, srid=self.srs_id,
+                    geometry_type=geom_fldtype,
+                    spatial_index=False)))
+        else:
+            gtable = None
+
         db.mapper(model, table)
 
         self.metadata = metadata
         self.table = table
+        self.gtable = gtable
         self.model = model
 
-    def load_from_ogr(self, ogrlayer, strdecode):
+    def generalize(self, tolerances, ids=None):
+        """ Fill the table of generalized geometries created by
+        :py:meth:`setup_metadata` with simplified geometries.
+
+        :param tolerances: Sequence of ``(level, tolerance)`` tuples.
+        :param ids: Features to update, all features if None. """
+
+        table, gtable = self.table, self.gtable
+        conn = DBSession.connection()
+
+        if ids is not None:
+            ids = list(ids)
+            if len(ids) == 0:
+                return
+            conn.execute(gtable.delete().where(
+                gtable.columns.id == db.func.any(ids)))
+        else:
+            conn.execute(gtable.delete())
+
+        for level, tolerance in tolerances:
+            query = sql.select([
+                table.columns.id, sql.literal(level),
+                db.func.st_simplifypreservetopology(
+                    table.columns.geom, tolerance)])
+            if ids is not None:
+                query = query.where(table.columns.id == db.func.any(ids))
+
+            conn.execute(gtable.insert().from_select(
+                ['id', 'level', 'geom'], query))
+
+        if ids is None:
+            conn.execute('ANALYZE {}'.format(
+                conn.dialect.identifier_preparer.format_table(gtable)))
+
+        mark_changed(DBSession())
+
+    def _geometry_upgrade(self, conn, cursor):
+        """ Change geometry type of the table to multi-geometry, used when
+        a multi-geometry is found after the first chunk while loading. """
+
+        ltype = self.accepted_gtype[0]
+        mtype = _GEOM_OGR_MULTI[ltype]
+        self.geometry_type = _GEOM_OGR_2_TYPE[mtype]
+        self.accepted_gtype.append(mtype)
+
+        preparer = conn.dialect.identifier_preparer
+        for table in (self.table, self.gtable):
+            if table is None:
+                continue
+            cursor.execute(
+                'ALTER TABLE {} ALTER COLUMN geom TYPE geometry({}, {}) '
+                'USING ST_Multi(geom)'.format(
+                    preparer.format_table(table),
+                    _GEOM_TYPE_2_DB[self.geometry_type], self.srs_id))
+
+    def load_from_ogr(self, ogrlayer, strdecode, progress=None):
+        """ Load features from OGR layer into the table created by
+        :py:meth:`setup_metadata` reading the layer only once. Features are
+        validated while loading and rows are sent to PostgreSQL with ``COPY
+        ... FROM STDIN`` in batches of :py:data:`COPY_BATCH_SIZE` features,
+        so memory usage doesn't depend on the number of features.
+
+        If the source SRS is known to PostGIS, rows are copied into a
+        temporary table and each batch is reprojected with a single
+        ``INSERT ... SELECT ST_Transform(...)`` statement, otherwise
+        geometries are reprojected one by one with OGR.
+
+        :param progress: Optional callable which receives the number of
+            features loaded so far after each batch. """
+
+        conn = DBSession.connection()
+        preparer = conn.dialect.identifier_preparer
+        cursor = conn.connection.cursor()
+
         source_osr = ogrlayer.GetSpatialRef()
         target_osr = osr.SpatialReference()
         target_osr.ImportFromEPSG(self.srs_id)
 
         ltype = ogrlayer.GetGeomType() & (~ogr.wkb25DBit)
-        transform = osr.CoordinateTransformation(source_osr, target_osr)
+
+        if source_osr.IsSame(target_osr):
+            transform = None
+            srid = self.srs_id
+        else:
+            srid = _osr_postgis_srid(conn, source_osr)
+            transform = osr.CoordinateTransformation(
+                source_osr, target_osr) if srid is None else None
+
+        defn = ogrlayer.GetLayerDefn()
+        fld_keys = [
+            self[strdecode(defn.GetFieldDefn(i).GetNameRef())].key
+            for i in range(defn.GetFieldCount())]
+
+        tablename = preparer.format_table(self.table)
+        columns = ', '.join(map(preparer.quote, ['geom', ] + fld_keys))
+
+        if srid == self.srs_id:
+            copy_sql = 'COPY {} ({}) FROM STDIN'.format(tablename, columns)
+            stage_insert = None
+        else:
+            stagename = preparer.quote('stage_' + self.table.name)
+            cursor.execute(
+                'CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} '
+                'WITH NO DATA'.format(stagename, ', '.join(
+                    ['CAST(geom AS geometry) AS geom', ] + map(
+                        preparer.quote, fld_keys)), tablename))
+            copy_sql = 'COPY {} ({}) FROM STDIN'.format(stagename, columns)
+
+            def stage_insert():
+                geom = 'ST_Transform(geom, {})'.format(self.srs_id)
+                if len(self.accepted_gtype) > 1:
+                    geom = 'ST_Multi({})'.format(geom)
+                return (
+                    'INSERT INTO {0} ({1}) SELECT {2} FROM {3}; '
+                    'TRUNCATE {3}'.format(
+                        tablename, columns, ', '.join([geom, ] + map(
+                            preparer.quote, fld_keys)), stagename))
+
+        buf = StringIO()
+        count = 0
+
+        def flush():
+            buf.seek(0)
+            cursor.copy_expert(copy_sql, buf)
+            buf.seek(0)
+            buf.truncate()
+
+            if stage_insert is not None:
+                cursor.execute(stage_insert())
+
+            _logger.debug("%d features loaded into %s", count, self.table.name)
+            if progress is not None:
+                progress(count)
 
         for fid, feature in enumerate(ogrlayer):
             geom = feature.GetGeometryRef()
+            if geom is None:
+                raise VE(_("Feature #%d doesn't contains geometry.") % (
+                    feature.GetFID(), ))
 
             # Bring 25D geometries to 2D
             if geom.GetGeometryType() & ogr.wkb25DBit:
                 geom.FlattenTo2D()
 
             gtype = geom.GetGeometryType()
+            if (
+                gtype not in self.accepted_gtype and len(
+                    self.accepted_gtype) == 1 and ltype in _GEOM_OGR_MULTI
+                and gtype == _GEOM_OGR_MULTI[ltype]
+            ):
+                # Rows in the buffer are loaded as single geometries and
+                # converted with the table.
+                flush()
+                self._geometry_upgrade(conn, cursor)
+
             if gtype not in self.accepted_gtype:
                 raise ValidationError(_(
                     "Geometry type (%s) does not match column type (%s).") % (
                     GEOM_TYPE_DISPLAY[gtype - 1],
                     GEOM_TYPE_DISPLAY[ltype - 1]))
 
-            geom.Transform(transform)
+            if transform is not None:
+                geom.Transform(transform)
 
-            if (
-                self.geometry_type in (
-                    GEOM_TYPE.MULTIPOINT,
-                    GEOM_TYPE.MULTILINESTRING,
-                    GEOM_TYPE.MULTIPOLYGON)
-            ):
+            if stage_insert is None and len(self.accepted_gtype) > 1:
                 if gtype == ogr.wkbPoint:
                     geom = ogr.ForceToMultiPoint(geom)
                 elif gtype == ogr.wkbLineString:
@@ -287,7 +554,7 @@ class TableInfo(object):
                 elif gtype == ogr.wkbPolygon:
                     geom = ogr.ForceToMultiPolygon(geom)
 
-            fld_values = dict()
+            row = [_ewkb_hex(geom, srid), ]
             for i in range(feature.GetFieldCount()):
                 fld_type = feature.GetFieldDefnRef(i).GetType()
 
@@ -331,13 +598,77 @@ class TableInfo(object):
                             "Try declaring different encoding.") % dict(
                             feat=fid, attr=i))
 
-                fld_name = strdecode(feature.GetFieldDefnRef(i).GetNameRef())
-                fld_values[self[fld_name].key] = fld_value
+                row.append(fld_value)
+
+            buf.write(b'\t'.join(map(_copy_value, row)) + b'\n')
+            count += 1
+
+            if count % COPY_BATCH_SIZE == 0:
+                flush()
+
+        if count % COPY_BATCH_SIZE != 0:
+            flush()
+
+        # Update planner statistics for freshly loaded data
+        cursor.execute('ANALYZE {}'.format(tablename))
+
+        # Rows were written bypassing ORM, so force zope session
+        # management to commit changes
+        mark_changed(DBSession())
+
+        return count
+
+
+class TableInfoCache(object):
+    """ Process-wide cache of :py:class:`TableInfo` objects with already
+    set up SQLAlchemy metadata. Items are keyed by layer table UUID and
+    validated against fields revision, so layers with changed fields are
+    set up again and replace the stale item. """
+
+    def __init__(self):
+        self._data = dict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def revision(layer):
+        return (layer.srs_id, layer.geometry_type, layer.generalized) + tuple(
+            (f.fld_uuid, f.keyname, f.datatype) for f in layer.fields)
+
+    def get(self, layer):
+        revision = self.revision(layer)
 
-            obj = self.model(fid=fid, geom=ga.elements.WKTElement(
-                str(geom), srid=self.srs_id), **fld_values)
+        with self._lock:
+            item = self._data.get(layer.tbl_uuid)
+            if item is not None and item[0] == revision:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
 
-            DBSession.add(obj)
+        tableinfo = TableInfo.from_layer(layer)
+        tableinfo.setup_metadata(tablename=layer._tablename)
+
+        with self._lock:
+            self._data[layer.tbl_uuid] = (revision, tableinfo)
+
+        return tableinfo
+
+    def invalidate(self, tbl_uuid):
+        with self._lock:
+            self._data.pop(tbl_uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stat(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses)
+
+
+tableinfo_cache = TableInfoCache()
 
 
 class VectorLayerField(Base, LayerField):
@@ -348,6 +679,11 @@ class VectorLayerField(Base, LayerField):
 
     id = db.Column(db.ForeignKey(LayerField.id), primary_key=True)
     fld_uuid = db.Column(db.Unicode(32), nullable=False)
+    indexed = db.Column(db.Boolean, nullable=False, default=False)
+
+    @property
+    def _index_name(self):
+        return 'fld_%s_idx' % self.fld_uuid
 
 
 class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
@@ -356,10 +692,22 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
 
     __scope__ = DataScope
 
-    implements(IFeatureLayer, IWritableFeatureLayer, IBboxLayer)
+    implements(
+        IFeatureLayer, IWritableFeatureLayer, IFeatureLayerRevision,
+        IBboxLayer)
 
     tbl_uuid = db.Column(db.Unicode(32), nullable=False)
     geometry_type = db.Column(db.Enum(*GEOM_TYPE.enum), nullable=False)
+    feature_count = db.Column(db.Integer)
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+    generalized = db.Column(db.Boolean, nullable=False, default=False)
+    search_index = db.Column(db.Boolean, nullable=False, default=False)
+
+    # Extent in EPSG:4326, NULL if unknown
+    extent_minlon = db.Column(db.Float)
+    extent_minlat = db.Column(db.Float)
+    extent_maxlon = db.Column(db.Float)
+    extent_maxlat = db.Column(db.Float)
 
     __field_class__ = VectorLayerField
 
@@ -392,6 +740,11 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         tableinfo.metadata.create_all(bind=DBSession.connection())
 
         self.tableinfo = tableinfo
+        self.extent_minlon = self.extent_minlat = None
+        self.extent_maxlon = self.extent_maxlat = None
+
+        if self.search_index:
+            self.search_index_sync()
 
     def setup_from_fields(self, fields):
         tableinfo = TableInfo.from_fields(
@@ -402,15 +755,177 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         tableinfo.metadata.create_all(bind=DBSession.connection())
 
         self.tableinfo = tableinfo
+        self.extent_minlon = self.extent_minlat = None
+        self.extent_maxlon = self.extent_maxlat = None
+
+        if self.search_index:
+            self.search_index_sync()
+        self.feature_count = 0
 
     def load_from_ogr(self, ogrlayer, strdecode):
-        self.tableinfo.load_from_ogr(ogrlayer, strdecode)
+        self.feature_count = self.tableinfo.load_from_ogr(
+            ogrlayer, strdecode)
+
+        # Multi-geometries may be found after the first chunk
+        self.geometry_type = self.tableinfo.geometry_type
+        if self.generalized:
+            self.tableinfo.generalize(self._generalize_tolerances())
+
+        # Layer may be not flushed yet, so the extent is selected and
+        # assigned instead of updated in place
+        self.extent_minlon, self.extent_minlat, \
+            self.extent_maxlon, self.extent_maxlat = \
+            DBSession.connection().execute(db.sql.text(
+                'SELECT ST_XMin(b), ST_YMin(b), ST_XMax(b), ST_YMax(b) '
+                'FROM (SELECT ST_Extent(ST_Transform(geom, 4326)) AS b '
+                'FROM vector_layer."{}") e'.format(self._tablename)
+            )).first()
+
+    def _generalize_tolerances(self):
+        width = self.srs.maxx - self.srs.minx
+        return [
+            (level, width / (GENERALIZE_PIXELS * (1 << level)))
+            for level in GENERALIZE_LEVELS]
+
+    def _generalize_level(self, tolerance):
+        """ Coarsest level which tolerance doesn't exceed the given one or
+        None if there is no such level """
+
+        for level, ltol in self._generalize_tolerances():
+            if ltol <= tolerance:
+                return level
+
+    def _generalize_update(self, ids):
+        if self.generalized:
+            tableinfo_cache.get(self).generalize(
+                self._generalize_tolerances(), ids)
+
+    def generalize(self):
+        """ Create and fill the table of generalized geometries, used for
+        layers created before generalization was introduced """
+
+        if self.geometry_type not in _GENERALIZE_GEOM_TYPES:
+            return False
+
+        self.generalized = True
+
+        tableinfo = tableinfo_cache.get(self)
+        tableinfo.gtable.create(bind=DBSession.connection(), checkfirst=True)
+        tableinfo.generalize(self._generalize_tolerances())
+
+        return True
+
+    def _data_update(self, count=None):
+        """ Increment data version and update cached feature count if
+        ``count`` function is given with SQL expressions, so concurrent
+        transactions don't overwrite each other's changes """
+
+        table = VectorLayer.__table__
+        values = dict(data_version=table.c.data_version + 1)
+        if count is not None:
+            values['feature_count'] = count(table.c.feature_count)
+
+        DBSession.connection().execute(
+            table.update().where(table.c.id == self.id).values(**values))
+
+        DBSession.expire(self, values.keys())
+        mark_changed(DBSession())
+
+    @property
+    def data_revision(self):
+        return '%s.%d' % (self.tbl_uuid, self.data_version)
+
+    def field_indexes_sync(self):
+        """ Create or drop B-tree indexes on fields according to their
+        ``indexed`` flag. Indexes are built with ``CREATE INDEX
+        CONCURRENTLY`` which can't be executed inside a transaction block,
+        so it's done in a separate connection after the current transaction
+        is committed. """
+
+        tablename = self._tablename
+        create = [(f._index_name, 'fld_%s' % f.fld_uuid)
+                  for f in self.fields if f.indexed]
+        drop = [f._index_name for f in self.fields if not f.indexed]
+
+        def sync(success):
+            if not success:
+                return
+
+            conn = env.core.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+
+            try:
+                for idx_name in drop:
+                    conn.execute(
+                        'DROP INDEX CONCURRENTLY IF EXISTS '
+                        'vector_layer."{}"'.format(idx_name))
+
+                for idx_name, column in create:
+                    drop_invalid_index(conn, 'vector_layer', idx_name)
+                    conn.execute(
+                        'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{}" '
+                        'ON vector_layer."{}" ("{}")'.format(
+                            idx_name, tablename, column))
+
+                conn.execute('ANALYZE vector_layer."{}"'.format(tablename))
+
+            except Exception:
+                _logger.exception(
+                    "Failed to update field indexes of %s", tablename)
+
+            finally:
+                conn.close()
+
+        transaction.get().addAfterCommitHook(sync)
+
+    @property
+    def _search_index_name(self):
+        return '%s_search_idx' % self._tablename
+
+    def search_index_sync(self):
+        """ Create or drop trigram search index used by ``like`` queries
+        according to ``search_index`` flag, see :py:meth:`field_indexes_sync`
+        about building indexes. The index is built on an expression, so
+        PostgreSQL keeps it up to date on writes. """
+
+        tablename = 'vector_layer.' + self._tablename
+        idx_name = self._search_index_name
+        columns = ['fld_%s' % f.fld_uuid for f in self.fields
+                   if f.datatype in SEARCH_DATATYPES]
+        create = self.search_index and len(columns) > 0
+
+        def sync(success):
+            if not success:
+                return
+
+            conn = env.core.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+
+            try:
+                if create:
+                    drop_invalid_index(conn, 'vector_layer', idx_name)
+                    conn.execute(search_index_ddl(
+                        conn, tablename, idx_name, columns))
+                else:
+                    conn.execute(
+                        'DROP INDEX CONCURRENTLY IF EXISTS '
+                        'vector_layer."{}"'.format(idx_name))
+
+            except Exception:
+                _logger.exception(
+                    "Failed to update search index of %s", tablename)
+
+            finally:
+                conn.close()
+
+        transaction.get().addAfterCommitHook(sync)
 
     def get_info(self):
         return super(VectorLayer, self).get_info() + (
             (_("Geometry type"), dict(zip(GEOM_TYPE.enum, GEOM_TYPE_DISPLAY))[
                 self.geometry_type]),
-            (_("Feature count"), self.feature_query()().total_count),
+            (_("Feature count"), self.feature_query()().count(
+                COUNT_MODE.CACHED)),
         )
 
     # IFeatureLayer
@@ -435,8 +950,10 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
     def feature_put(self, feature):
         self.before_feature_update.fire(resource=self, feature=feature)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(tablename=self._tablename)
+        # Feature may be moved, caches at the old location are invalid too
+        old_bounds = self._stored_bounds([feature.id, ])
+
+        tableinfo = tableinfo_cache.get(self)
 
         obj = tableinfo.model(id=feature.id)
         for f in tableinfo.fields:
@@ -452,10 +969,15 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
 
         DBSession.merge(obj)
 
+        self._data_update()
+        if feature.geom is not None:
+            self._extent_update(feature.geom)
+            self._generalize_update([feature.id, ])
+
         self.after_feature_update.fire(resource=self, feature=feature)
 
-        on_data_change.fire(self, feature.geom)
-        # TODO: Old geom version
+        on_data_change.fire(self, self._bounds_union(
+            old_bounds, self._geometry(feature.geom)))
 
     def feature_create(self, feature):
         """Insert new object to DB which is described in feature
@@ -467,24 +989,30 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         """
         self.before_feature_create.fire(resource=self, feature=feature)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(tablename=self._tablename)
+        tableinfo = tableinfo_cache.get(self)
 
         obj = tableinfo.model()
         for f in tableinfo.fields:
             if f.keyname in feature.fields.keys():
                 setattr(obj, f.key, feature.fields[f.keyname])
 
-        obj.geom = ga.elements.WKTElement(
-            str(feature.geom), srid=self.srs_id)
+        if feature.geom is not None:
+            obj.geom = ga.elements.WKTElement(
+                str(feature.geom), srid=self.srs_id)
 
         DBSession.add(obj)
         DBSession.flush()
         DBSession.refresh(obj)
 
+        self._data_update(lambda c: c + 1)
+        if feature.geom is not None:
+            self._extent_update(feature.geom)
+            self._generalize_update([obj.id, ])
+
         self.after_feature_create.fire(resource=self, feature_id=obj.id)
 
-        on_data_change.fire(self, feature.geom)
+        if feature.geom is not None:
+            on_data_change.fire(self, self._geometry(feature.geom))
 
         return obj.id
 
@@ -496,35 +1024,257 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         """
         self.before_feature_delete.fire(resource=self, feature_id=feature_id)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(tablename=self._tablename)
+        tableinfo = tableinfo_cache.get(self)
 
         obj = DBSession.query(tableinfo.model).filter_by(id=feature_id).one()
 
+        bounds = None
+        if obj.geom is not None:
+            bounds = box(*geom_from_wkb(
+                str(obj.geom.data)).bounds, srid=self.srs_id)
+
         DBSession.delete(obj)
 
+        self._data_update(lambda c: c - 1)
+        self._extent_update(None)
+
         self.after_feature_delete.fire(resource=self, feature_id=feature_id)
 
-        # TODO: Implement on_data_change
+        if bounds is not None:
+            on_data_change.fire(self, bounds)
 
     def feature_delete_all(self):
         """Remove all records from a layer"""
         self.before_all_feature_delete.fire(resource=self)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(tablename=self._tablename)
+        tableinfo = tableinfo_cache.get(self)
 
         DBSession.query(tableinfo.model).delete()
 
+        self._data_update(lambda c: 0)
+        self._extent_update(None)
+
         self.after_all_feature_delete.fire(resource=self)
 
-        # TODO: Implement on_data_change
+        # Without geometry the whole layer is considered changed
+        on_data_change.fire(self, None)
+
+    def _geometry(self, geom):
+        """ Geometry object from feature geometry, which can be WKT string
+        as it's written to the database with str() """
+        if isinstance(geom, basestring):
+            return geom_from_wkt(geom, srid=self.srs_id)
+        return geom
+
+    def _features_bounds(self, features):
+        """ Box covering geometries of features or None if there are no
+        geometries, used to fire single on_data_change for a batch """
+        return self._bounds_union(*[
+            self._geometry(f.geom) for f in features])
+
+    def _bounds_union(self, *geoms):
+        """ Box covering geometries which aren't None or None """
+        bounds = [g.bounds for g in geoms if g is not None]
+        if len(bounds) == 0:
+            return None
+
+        minx, miny, maxx, maxy = zip(*bounds)
+        return box(min(minx), min(miny), max(maxx), max(maxy),
+                   srid=self.srs_id)
+
+    def _stored_bounds(self, ids):
+        """ Box covering stored geometries of features or None, it's read
+        before update to invalidate caches at the old location """
+
+        table = tableinfo_cache.get(self).table
+        extent = func.st_extent(table.columns.geom)
+
+        minx, miny, maxx, maxy = DBSession.connection().execute(sql.select([
+            func.st_xmin(extent), func.st_ymin(extent),
+            func.st_xmax(extent), func.st_ymax(extent),
+        ], whereclause=table.columns.id.in_(ids))).first()
+
+        if minx is None:
+            return None
+        return box(minx, miny, maxx, maxy, srid=self.srs_id)
+
+    def feature_create_many(self, features):
+        """Insert many objects to DB with a single INSERT statement
+
+        :param features: objects description
+        :type features:  list of Feature
+
+        :return:    list of inserted objects IDs in the same order
+        """
+        if len(features) == 0:
+            return []
+
+        for feature in features:
+            self.before_feature_create.fire(resource=self, feature=feature)
+
+        tableinfo = tableinfo_cache.get(self)
+        table = tableinfo.table
+
+        values = []
+        for feature in features:
+            row = dict(geom=None if feature.geom is None else (
+                ga.elements.WKTElement(str(feature.geom), srid=self.srs_id)))
+            for f in tableinfo.fields:
+                row[f.key] = feature.fields.get(f.keyname)
+            values.append(row)
+
+        result = DBSession.connection().execute(
+            table.insert().values(values).returning(table.columns.id))
+        fids = [r[0] for r in result]
+        mark_changed(DBSession())
+
+        bounds = self._features_bounds(features)
+
+        self._data_update(lambda c: c + len(fids))
+        if bounds is not None:
+            self._extent_update(bounds)
+        self._generalize_update(fids)
+
+        for fid in fids:
+            self.after_feature_create.fire(resource=self, feature_id=fid)
+
+        # Features without geometry don't change tiles
+        if bounds is not None:
+            on_data_change.fire(self, bounds)
+
+        return fids
+
+    def feature_put_many(self, features):
+        """Update many existing objects with UPDATE ... FROM (VALUES ...)
+        statements, one per distinct set of updated fields
+
+        :param features: objects description
+        :type features:  list of Feature
+        """
+        if len(features) == 0:
+            return
+
+        for feature in features:
+            self.before_feature_update.fire(resource=self, feature=feature)
+
+        old_bounds = self._stored_bounds([f.id for f in features])
+
+        tableinfo = tableinfo_cache.get(self)
+
+        conn = DBSession.connection()
+        preparer = conn.dialect.identifier_preparer
+        tablename = preparer.format_table(tableinfo.table)
+
+        groups = OrderedDict()
+        for feature in features:
+            fields = tuple(
+                f for f in tableinfo.fields
+                if f.keyname in feature.fields)
+            groups.setdefault((fields, feature.geom is not None), []) \
+                .append(feature)
+
+        for (fields, with_geom), group in groups.iteritems():
+            columns = [(preparer.quote('id'), 'CAST({} AS integer)'), ]
+            for f in fields:
+                columns.append((preparer.quote(f.key), 'CAST({} AS %s)' % (
+                    tableinfo.table.columns[f.key].type.compile(
+                        dialect=conn.dialect), )))
+            if with_geom:
+                columns.append((preparer.quote('geom'), (
+                    'ST_GeomFromText({}, %d)' % self.srs_id)))
+
+            if len(columns) == 1:
+                continue
+
+            rows = []
+            for feature in group:
+                row = [feature.id, ] + [
+                    feature.fields[f.keyname] for f in fields]
+                if with_geom:
+                    row.append(str(feature.geom))
+                rows.append(row)
+
+            conn.execute(update_from_values(tablename, columns, rows))
+
+        self._data_update()
+
+        bounds = self._features_bounds(features)
+
+        if bounds is not None:
+            self._extent_update(bounds)
+            self._generalize_update([
+                f.id for f in features if f.geom is not None])
+
+        for feature in features:
+            self.after_feature_update.fire(resource=self, feature=feature)
+
+        # Features updated without geometry remain at the old location
+        on_data_change.fire(self, self._bounds_union(old_bounds, bounds))
+
+    def feature_delete_many(self, feature_ids):
+        """Remove records with ids using a single DELETE statement
+
+        :param feature_ids: record ids
+        :type feature_ids:  list of int or bigint
+        """
+        if len(feature_ids) == 0:
+            return
+
+        for feature_id in feature_ids:
+            self.before_feature_delete.fire(
+                resource=self, feature_id=feature_id)
+
+        tableinfo = tableinfo_cache.get(self)
+
+        conn = DBSession.connection()
+        preparer = conn.dialect.identifier_preparer
+
+        count, minx, miny, maxx, maxy = conn.execute(db.sql.text(
+            'WITH d AS (DELETE FROM {} WHERE id = ANY(:ids) RETURNING geom) '
+            'SELECT n, ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) '
+            'FROM (SELECT count(*) AS n, ST_Extent(geom) AS e FROM d) s'
+            .format(preparer.format_table(tableinfo.table))
+        ), ids=list(feature_ids)).first()
+        mark_changed(DBSession())
+
+        self._data_update(lambda c: c - count)
+        self._extent_update(None)
+
+        for feature_id in feature_ids:
+            self.after_feature_delete.fire(
+                resource=self, feature_id=feature_id)
+
+        if minx is not None:
+            on_data_change.fire(self, box(
+                minx, miny, maxx, maxy, srid=self.srs_id))
 
     # IBboxLayer implementation:
     @property
     def extent(self):
         """Return layer's extent
+
+        Extent is stored in the layer by data loading and changes, see
+        :py:meth:`_extent_update`. It's calculated with ST_Extent only if
+        it's unknown, i.e. for layers without features. The calculated
+        extent isn't stored.
         """
+        if self.extent_minlon is None:
+            minlon, minlat, maxlon, maxlat = self._extent_calculate()
+        else:
+            minlon, minlat, maxlon, maxlat = (
+                self.extent_minlon, self.extent_minlat,
+                self.extent_maxlon, self.extent_maxlat)
+
+        extent = dict(
+            minLon=minlon,
+            maxLon=maxlon,
+            minLat=minlat,
+            maxLat=maxlat
+        )
+
+        return extent
+
+    def _extent_calculate(self):
         st_transform = func.st_transform
         st_extent = func.st_extent
         st_setsrid = func.st_setsrid
@@ -533,8 +1283,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         st_ymax = func.st_ymax
         st_ymin = func.st_ymin
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(tablename=self._tablename)
+        tableinfo = tableinfo_cache.get(self)
 
         model = tableinfo.model
 
@@ -544,21 +1293,64 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         bbox = DBSession.query(*fields).label('bbox')
 
         fields = (
-            st_xmax(bbox),
             st_xmin(bbox),
-            st_ymax(bbox),
             st_ymin(bbox),
+            st_xmax(bbox),
+            st_ymax(bbox),
         )
-        maxLon, minLon, maxLat, minLat = DBSession.query(*fields).one()
-
-        extent = dict(
-            minLon=minLon,
-            maxLon=maxLon,
-            minLat=minLat,
-            maxLat=maxLat
-        )
+        return DBSession.query(*fields).one()
+
+    def _extent_update(self, geom):
+        """ Grow stored extent to include geometry or recalculate it if
+        geometry is None, i.e. after features deletion. UPDATE statements
+        don't depend on previously read values, so concurrent transactions
+        don't overwrite each other's changes. """
+
+        table = VectorLayer.__table__.name
+        conn = DBSession.connection()
+
+        recalculate = (
+            'UPDATE {0} SET '
+            'extent_minlon = ST_XMin(e.b), extent_minlat = ST_YMin(e.b), '
+            'extent_maxlon = ST_XMax(e.b), extent_maxlat = ST_YMax(e.b) '
+            'FROM (SELECT ST_Extent(ST_Transform(geom, 4326)) AS b '
+            'FROM vector_layer."{1}") e '
+            'WHERE {0}.id = :id'
+        ).format(table, self._tablename)
+
+        if geom is None:
+            # Row is locked before the extent is calculated, so the
+            # calculation includes features of transactions which changed
+            # the extent and were committed while waiting for the lock.
+            conn.execute(db.sql.text(
+                'SELECT id FROM {} WHERE id = :id FOR UPDATE'.format(table)
+            ), id=self.id)
+            conn.execute(db.sql.text(recalculate), id=self.id)
 
-        return extent
+        else:
+            # Unknown extent is calculated first, including features of
+            # this transaction. Concurrent transaction waits for the row
+            # lock and then only grows the extent with its geometry.
+            conn.execute(db.sql.text(
+                recalculate + ' AND {}.extent_minlon IS NULL'.format(table)
+            ), id=self.id)
+
+            conn.execute(db.sql.text(
+                'UPDATE {0} SET '
+                'extent_minlon = LEAST(extent_minlon, ST_XMin(e.b)), '
+                'extent_minlat = LEAST(extent_minlat, ST_YMin(e.b)), '
+                'extent_maxlon = GREATEST(extent_maxlon, ST_XMax(e.b)), '
+                'extent_maxlat = GREATEST(extent_maxlat, ST_YMax(e.b)) '
+                'FROM (SELECT Box2D(ST_Transform(ST_GeomFromText('
+                ':wkt, :srid), 4326)) AS b) e '
+                'WHERE {0}.id = :id AND {0}.extent_minlon IS NOT NULL'
+                .format(table)
+            ), wkt=str(geom), srid=self.srs_id, id=self.id)
+
+        DBSession.expire(self, [
+            'extent_minlon', 'extent_minlat',
+            'extent_maxlon', 'extent_maxlat'])
+        mark_changed(DBSession())
 
 
 def _vector_layer_listeners(table):
@@ -575,6 +1367,18 @@ def _vector_layer_listeners(table):
 _vector_layer_listeners(VectorLayer.__table__)
 
 
+@db.event.listens_for(VectorLayer, 'after_update')
+def _tableinfo_cache_update(mapper, connection, target):
+    # Table UUID is replaced on data upload, old table isn't used anymore
+    for tbl_uuid in db.inspect(target).attrs.tbl_uuid.history.deleted:
+        tableinfo_cache.invalidate(tbl_uuid)
+
+
+@db.event.listens_for(VectorLayer, 'after_delete')
+def _tableinfo_cache_delete(mapper, connection, target):
+    tableinfo_cache.invalidate(target.tbl_uuid)
+
+
 # DB initialization uses table.tometadata(), however
 # SA doesn't copy event subscriptions in this case.
 
@@ -693,19 +1497,17 @@ class _source_attr(SP):
         if ogrlayer.GetSpatialRef() is None:
             raise VE(_("Layer doesn't contain coordinate system information."))
 
-        for feat in ogrlayer:
-            geom = feat.GetGeometryRef()
-            if geom is None:
-                raise VE(_("Feature #%d doesn't contains geometry.") % feat.GetFID())
-
-        ogrlayer.ResetReading()
-
+        # Features are validated while loading
         obj.tbl_uuid = uuid.uuid4().hex
 
         with DBSession.no_autoflush:
             obj.setup_from_ogr(ogrlayer, recode)
             obj.load_from_ogr(ogrlayer, recode)
 
+        # Data is replaced with a new table
+        if obj.id is not None:
+            on_data_change.fire(obj, None)
+
     def setter(self, srlzr, value):
         datafile, metafile = env.file_upload.get_filename(value['id'])
         encoding = value.get('encoding', 'utf-8')
@@ -752,6 +1554,33 @@ class _fields_attr(SP):
         with DBSession.no_autoflush:
             srlzr.obj.setup_from_fields(value)
 
+        if srlzr.obj.id is not None:
+            on_data_change.fire(srlzr.obj, None)
+
+
+class _indexed_fields_attr(SP):
+
+    def getter(self, srlzr):
+        return [f.keyname for f in srlzr.obj.fields if f.indexed]
+
+    def setter(self, srlzr, value):
+        keynames = set(f.keyname for f in srlzr.obj.fields)
+        for keyname in value:
+            if keyname not in keynames:
+                raise VE(_("Field '%s' not found.") % keyname)
+
+        for f in srlzr.obj.fields:
+            f.indexed = f.keyname in value
+
+        srlzr.obj.field_indexes_sync()
+
+
+class _search_index_attr(SP):
+
+    def setter(self, srlzr, value):
+        srlzr.obj.search_index = bool(value)
+        srlzr.obj.search_index_sync()
+
 
 class _geometry_type_attr(SP):
 
@@ -782,6 +1611,9 @@ class VectorLayerSerializer(Serializer):
     source = _source_attr(read=None, write=P_DS_WRITE)
     fields = _fields_attr(read=None, write=P_DS_WRITE)
 
+    indexed_fields = _indexed_fields_attr(read=P_DSS_READ, write=P_DSS_WRITE)
+    search_index = _search_index_attr(read=P_DSS_READ, write=P_DSS_WRITE)
+
 
 @lru_cache()
 def _clipbybox2d_exists():
@@ -800,8 +1632,12 @@ class FeatureQueryBase(object):
         IFeatureQueryLike,
         IFeatureQueryIntersects,
         IFeatureQueryOrderBy,
+        IFeatureQueryKeyset,
         IFeatureQueryClipByBox,
-        IFeatureQuerySimplify)
+        IFeatureQuerySimplify,
+        IFeatureQueryMVT,
+        IFeatureQueryTotalCount,
+        IFeatureQueryTiles)
 
     def __init__(self):
         self._srs = None
@@ -824,6 +1660,9 @@ class FeatureQueryBase(object):
         self._intersects = None
 
         self._order_by = None
+        self._after = None
+
+        self._with_total_count = None
 
     def srs(self, srs):
         self._srs = srs
@@ -866,15 +1705,29 @@ class FeatureQueryBase(object):
     def order_by(self, *args):
         self._order_by = args
 
+    def after(self, id, values=None):
+        self._after = (id, tuple(values or ()))
+
     def like(self, value):
         self._like = value
 
     def intersects(self, geom):
         self._intersects = geom
 
+    def with_total_count(self):
+        self._with_total_count = True
+
+    def mvt(self, bounds, extent, buffer, name):
+        if mvt_version(env.core.engine) is None:
+            return None
+        return self()._mvt(bounds, extent, buffer, name)
+
+    def tiles(self, zoom, buffer=0):
+        srs = self.layer.srs if self._srs is None else self._srs
+        return self()._tiles(srs, zoom, buffer)
+
     def __call__(self):
-        tableinfo = TableInfo.from_layer(self.layer)
-        tableinfo.setup_metadata(tablename=self.layer._tablename)
+        tableinfo = tableinfo_cache.get(self.layer)
         table = tableinfo.table
 
         columns = [table.columns.id, ]
@@ -883,7 +1736,25 @@ class FeatureQueryBase(object):
         srsid = self.layer.srs_id if self._srs is None else self._srs.id
 
         geomcol = table.columns.geom
-        geomexpr = db.func.st_transform(geomcol, srsid)
+        geomsrc = geomcol
+        fromobj = table
+
+        # Use precomputed generalized geometries when the tolerance is given
+        # in units of layer's SRS. Geometry of the level is still simplified
+        # with the requested tolerance, but it's much cheaper.
+        if (
+            self._simplify is not None and tableinfo.gtable is not None
+            and srsid == self.layer.srs_id
+        ):
+            level = self.layer._generalize_level(self._simplify)
+            if level is not None:
+                gtable = tableinfo.gtable
+                fromobj = table.outerjoin(gtable, db.and_(
+                    gtable.columns.id == table.columns.id,
+                    gtable.columns.level == level))
+                geomsrc = db.func.coalesce(gtable.columns.geom, geomcol)
+
+        geomexpr = db.func.st_transform(geomsrc, srsid)
 
         if self._clip_by_box is not None:
             if _clipbybox2d_exists():
@@ -934,6 +1805,11 @@ class FeatureQueryBase(object):
                 columns.append(table.columns[f.key].label(f.keyname))
                 selected_fields.append(f)
 
+        # Window function would count only features after the cursor
+        with_total_count = self._with_total_count and not self._after
+        if with_total_count:
+            columns.append(db.func.count().over().label('total_count'))
+
         if self._filter_by:
             for k, v in self._filter_by.iteritems():
                 if k == 'id':
@@ -995,7 +1871,17 @@ class FeatureQueryBase(object):
 
             where.append(db.and_(*l))
 
-        if self._like:
+        if self._like and self.layer.search_index:
+            # Same expression as in the search index, see search_index_sync
+            where.append(like_clause(self._like, [
+                table.columns[f.key] for f in tableinfo.fields
+                if f.datatype in SEARCH_DATATYPES
+            ], [
+                table.columns[f.key] for f in tableinfo.fields
+                if f.datatype not in SEARCH_DATATYPES
+            ]))
+
+        elif self._like:
             l = []
             for f in tableinfo.fields:
                 l.append(
@@ -1014,11 +1900,23 @@ class FeatureQueryBase(object):
                     intgeom, self.layer.srs_id)))
 
         order_criterion = []
+        keyset_criteria = []
         if self._order_by:
             for order, colname in self._order_by:
+                column = table.columns[tableinfo[colname].key]
                 order_criterion.append(dict(asc=db.asc, desc=db.desc)[order](
-                    table.columns[tableinfo[colname].key]))
+                    column))
+                keyset_criteria.append((order, column))
         order_criterion.append(table.columns.id)
+        keyset_criteria.append(('asc', table.columns.id))
+
+        # Keyset condition is applied only to the page of features, so
+        # counts don't depend on the cursor.
+        pagewhere = list(where)
+        if self._after:
+            after_id, after_values = self._after
+            pagewhere.append(keyset_clause(
+                keyset_criteria, after_values + (after_id, )))
 
         class QueryFeatureSet(FeatureSet):
             fields = selected_fields
@@ -1029,17 +1927,28 @@ class FeatureQueryBase(object):
             _box = self._box
             _limit = self._limit
             _offset = self._offset
+            _with_total_count = with_total_count
+
+            # Selected with features if with_total_count is set
+            _total_count = None
 
             def __iter__(self):
                 query = sql.select(
                     columns,
-                    whereclause=db.and_(*where),
+                    whereclause=db.and_(*pagewhere),
+                    from_obj=fromobj,
                     limit=self._limit,
                     offset=self._offset,
                     order_by=order_criterion,
                 )
-                rows = DBSession.connection().execute(query)
+                # Unlimited queries can return a lot of rows, so they are
+                # read in batches with a server-side cursor.
+                rows = DBSession.connection().execution_options(
+                    stream_results=self._limit is None).execute(query)
                 for row in rows:
+                    if self._with_total_count:
+                        self._total_count = row['total_count']
+
                     fdict = dict((f.keyname, row[f.keyname])
                                   for f in selected_fields)
                     if self._geom:
@@ -1061,8 +1970,39 @@ class FeatureQueryBase(object):
                         ) if self._box else None
                     )
 
+            def _mvt(self, bounds, extent, buffer, name):
+                mvtcolumns = [mvt_geom(
+                    geomexpr, bounds, extent, buffer).label(MVT_GEOM),
+                    table.columns.id.label(MVT_ID)]
+                mvtcolumns.extend([
+                    table.columns[f.key].label(f.keyname)
+                    for f in selected_fields])
+
+                query = mvt_query(sql.select(
+                    mvtcolumns,
+                    whereclause=db.and_(*where),
+                    from_obj=fromobj,
+                ), name, extent)
+
+                content = DBSession.connection().execute(query).scalar()
+                return str(content) if content is not None else b''
+
+            def _tiles(self, srs, zoom, buffer):
+                query = tiles_query(sql.select(
+                    [geomexpr.label('g'), ],
+                    whereclause=db.and_(*where),
+                    from_obj=fromobj,
+                ), srs, zoom, buffer)
+
+                return [
+                    tuple(row) for row
+                    in DBSession.connection().execute(query)]
+
             @property
             def total_count(self):
+                if self._total_count is not None:
+                    return self._total_count
+
                 query = sql.select(
                     [db.func.count(table.columns.id), ],
                     whereclause=db.and_(*where)
@@ -1071,4 +2011,27 @@ class FeatureQueryBase(object):
                 for row in res:
                     return row[0]
 
+            def count(self, mode=None):
+                if self._total_count is not None:
+                    return self._total_count
+
+                elif mode == COUNT_MODE.CACHED and not where:
+                    # Layers created before the count was cached are
+                    # counted, it's stored only by data changes.
+                    if self.layer.feature_count is not None:
+                        return self.layer.feature_count
+
+                elif mode == COUNT_MODE.ESTIMATE:
+                    estimate = explain_rows(
+                        DBSession.connection(), sql.select(
+                            [table.columns.id, ],
+                            whereclause=db.and_(*where)))
+
+                    threshold = env.feature_layer.settings[
+                        'count.estimate_threshold']
+                    if estimate >= threshold:
+                        return estimate
+
+                return self.total_count
+
         return QueryFeatureSet()
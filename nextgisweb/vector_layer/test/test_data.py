@@ -2,15 +2,25 @@
 from __future__ import absolute_import, print_function, unicode_literals
 import os.path
 from uuid import uuid4
+from datetime import date
 
 import pytest
-from osgeo import ogr
+import transaction
+from osgeo import ogr, osr
 
+from nextgisweb import db
 from nextgisweb.models import DBSession
 from nextgisweb.auth import User
 from nextgisweb.spatial_ref_sys import SRS
-from nextgisweb.feature_layer import FIELD_TYPE
+from nextgisweb.feature_layer import FIELD_TYPE, COUNT_MODE, Feature
+from nextgisweb.feature_layer.util import mvt_version
+from nextgisweb.geometry import Point, LineString, box
 from nextgisweb.vector_layer import VectorLayer
+from nextgisweb.vector_layer import model as vector_layer_model
+from nextgisweb.vector_layer.model import (
+    _copy_value,
+    tableinfo_cache,
+    GENERALIZE_LEVELS)
 
 
 DATA_PATH = os.path.join(os.path.dirname(
@@ -60,3 +70,475 @@ def test_from_ogr(txn, data):
     res.load_from_ogr(layer, lambda x: x)
 
     DBSession.flush()
+
+    query = res.feature_query()
+    assert query().total_count == layer.GetFeatureCount()
+    assert res.feature_count == layer.GetFeatureCount()
+
+    # Extent is stored on loading
+    assert res.extent_minlon is not None
+
+
+def test_from_ogr_multi_upgrade(txn, monkeypatch):
+    monkeypatch.setattr(vector_layer_model, 'COPY_BATCH_SIZE', 1)
+
+    dsource = ogr.GetDriverByName('Memory').CreateDataSource('')
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = dsource.CreateLayer('test', srs, ogr.wkbPoint)
+    for wkt in ('POINT (0 0)', 'POINT (1 1)', 'MULTIPOINT (2 2, 3 3)'):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+
+    res = VectorLayer(
+        parent_id=0, display_name='from_ogr_multi_upgrade',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.persist()
+
+    res.setup_from_ogr(layer, lambda x: x)
+    assert res.geometry_type == 'POINT'
+
+    res.load_from_ogr(layer, lambda x: x)
+    assert res.geometry_type == 'MULTIPOINT'
+
+    DBSession.flush()
+
+    assert res.feature_query()().total_count == 3
+
+
+def test_copy_value():
+    assert _copy_value(None) == b'\\N'
+    assert _copy_value(1) == b'1'
+    assert _copy_value(0.5) == b'0.5'
+    assert _copy_value(date(2001, 1, 1)) == b'2001-01-01'
+    assert _copy_value('a\tb\nc\\') == b'a\\tb\\nc\\\\'
+
+
+def test_tableinfo_cache(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='tableinfo_cache',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([
+        dict(keyname='integer', datatype=FIELD_TYPE.INTEGER), ])
+    res.persist()
+
+    DBSession.flush()
+
+    stat = tableinfo_cache.stat()
+    tableinfo = tableinfo_cache.get(res)
+    assert tableinfo_cache.get(res) is tableinfo
+    assert tableinfo_cache.hits == stat['hits'] + 1
+
+    res.fields[0].keyname = 'renamed'
+    assert tableinfo_cache.get(res) is not tableinfo
+    assert tableinfo_cache.get(res)['renamed'] is not None
+
+
+def test_extent(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='extent',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    assert res.extent['minLon'] is None
+
+    res.feature_create(Feature(geom=Point(0, 0, srid=3857)))
+    assert res.extent['minLon'] == pytest.approx(0)
+
+    fid = res.feature_create(Feature(
+        geom=Point(1000000, 1000000, srid=3857)))
+    extent = res.extent
+    assert extent['minLon'] == pytest.approx(0)
+    assert extent['maxLon'] == pytest.approx(8.983, abs=1e-3)
+
+    # Extent is recalculated and stored after deletion
+    res.feature_delete(fid)
+    assert res.extent_maxlon == pytest.approx(0)
+
+    # Features without geometry don't reset the extent
+    res.feature_create(Feature())
+    assert res.extent_minlon is not None
+
+    # Unknown extent is calculated on read, but not stored
+    res.feature_delete_all()
+    res.feature_create(Feature(geom=Point(0, 0, srid=3857)))
+    DBSession.connection().execute(
+        'UPDATE vector_layer SET extent_minlon = NULL WHERE id = %d' % res.id)
+    DBSession.expire(res)
+    assert res.extent['minLon'] == pytest.approx(0)
+    assert res.extent_minlon is None
+    assert not DBSession.is_modified(res)
+
+
+def test_feature_many(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='feature_many',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([dict(keyname='name', datatype='STRING')])
+    res.persist()
+
+    DBSession.flush()
+
+    fids = res.feature_create_many([
+        Feature(fields=dict(name='a'), geom=Point(0, 0, srid=3857)),
+        Feature(fields=dict(name='b'), geom=Point(1, 1, srid=3857)),
+        Feature(fields=dict(name='c'), geom=Point(2, 2, srid=3857)),
+    ])
+    assert len(fids) == 3
+    assert res.feature_count == 3
+
+    res.feature_put_many([
+        Feature(id=fids[0], fields=dict(name='x')),
+        Feature(id=fids[1], geom=Point(5, 5, srid=3857)),
+    ])
+
+    query = res.feature_query()
+    query.geom()
+    features = dict((f.id, f) for f in query())
+    assert features[fids[0]].fields['name'] == 'x'
+    assert features[fids[1]].fields['name'] == 'b'
+    assert features[fids[1]].geom.x == pytest.approx(5)
+
+    res.feature_delete_many(fids[:2])
+    assert res.feature_count == 1
+    assert [f.id for f in res.feature_query()()] == [fids[2], ]
+
+
+def test_feature_many_nogeom(txn, monkeypatch):
+    res = VectorLayer(
+        parent_id=0, display_name='feature_many_nogeom',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([dict(keyname='name', datatype='STRING')])
+    res.persist()
+
+    DBSession.flush()
+
+    fired = []
+
+    class OnDataChange(object):
+        def fire(self, resource, geom):
+            fired.append(geom)
+
+    monkeypatch.setattr(vector_layer_model, 'on_data_change', OnDataChange())
+
+    # Features without geometry don't invalidate tiles
+    fids = res.feature_create_many([
+        Feature(fields=dict(name='a')), Feature(fields=dict(name='b'))])
+    assert fired == []
+
+    query = res.feature_query()
+    query.geom()
+    assert [f.geom for f in query()] == [None, None]
+
+    res.feature_create_many([
+        Feature(fields=dict(name='c')),
+        Feature(fields=dict(name='d'), geom='POINT (1 2)')])
+    assert fired[0].bounds == (1, 2, 1, 2)
+    assert res.feature_count == len(fids) + 2
+
+
+def test_with_total_count(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='with_total_count',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    fids = res.feature_create_many([
+        Feature(geom=Point(i, i, srid=3857)) for i in range(5)])
+
+    query = res.feature_query()
+    query.with_total_count()
+    query.limit(2, 1)
+    features = query()
+    assert len(list(features)) == 2
+    assert features.total_count == 5
+    assert features.count() == 5
+
+    # Count doesn't depend on the cursor
+    query = res.feature_query()
+    query.with_total_count()
+    query.after(fids[1])
+    query.limit(2)
+    features = query()
+    assert [f.id for f in features] == fids[2:4]
+    assert features.count() == 5
+    assert features.total_count == 5
+
+    # Fallback to a separate query if the page is empty
+    query.limit(2, 10)
+    features = query()
+    assert len(list(features)) == 0
+    assert features.count() == 5
+
+
+@pytest.fixture
+def count_layer(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='count',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    res.feature_create_many([
+        Feature(geom=Point(i, i, srid=3857)) for i in range(5)])
+    return res
+
+
+def test_count_exact(count_layer):
+    query = count_layer.feature_query()
+    assert query().count(COUNT_MODE.EXACT) == 5
+
+    query.intersects(box(-0.5, -0.5, 1.5, 1.5, srid=3857))
+    assert query().count(COUNT_MODE.EXACT) == 2
+
+
+def test_count_estimate(count_layer, env, monkeypatch):
+    DBSession.connection().execute(
+        'ANALYZE vector_layer."{}"'.format(count_layer._tablename))
+
+    monkeypatch.setitem(
+        env.feature_layer.settings, 'count.estimate_threshold', 0)
+
+    query = count_layer.feature_query()
+    assert query().count(COUNT_MODE.ESTIMATE) == 5
+
+    # Geometry parameters are bound through their types
+    query.intersects(box(-0.5, -0.5, 1.5, 1.5, srid=3857))
+    assert query().count(COUNT_MODE.ESTIMATE) >= 0
+
+    # Exact count below the threshold
+    monkeypatch.setitem(
+        env.feature_layer.settings, 'count.estimate_threshold', 100)
+    assert query().count(COUNT_MODE.ESTIMATE) == 2
+
+
+def test_count_cached(count_layer):
+    query = count_layer.feature_query()
+    assert count_layer.feature_count == 5
+    assert query().count(COUNT_MODE.CACHED) == 5
+
+    fid = next(iter(query())).id
+    count_layer.feature_delete(fid)
+    assert count_layer.feature_count == 4
+    assert query().count(COUNT_MODE.CACHED) == 4
+
+    # Filtered queries aren't cached
+    query.intersects(box(-0.5, -0.5, 1.5, 1.5, srid=3857))
+    assert query().count(COUNT_MODE.CACHED) < 4
+
+    # Count of layers without cached value isn't stored on read
+    count_layer.feature_count = None
+    DBSession.flush()
+    assert count_layer.feature_query()().count(COUNT_MODE.CACHED) == 4
+    assert not DBSession.is_modified(count_layer)
+    assert count_layer.feature_count is None
+
+
+def test_generalize(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='generalize',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='LINESTRING',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    assert res.generalized
+
+    line = LineString([(0, 0), (1, 1), (2, 0), (3, 1), (1e6, 0)], srid=3857)
+    fid = res.feature_create(Feature(geom=line))
+
+    tolerance = res._generalize_tolerances()[0][1]
+    assert res._generalize_level(tolerance) == GENERALIZE_LEVELS[0]
+    assert res._generalize_level(0) is None
+
+    query = res.feature_query()
+    query.geom()
+    query.simplify(tolerance)
+    feature, = query()
+    assert feature.id == fid
+    assert len(feature.geom.coords) == 2
+
+
+def test_mvt(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='mvt',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([dict(keyname='name', datatype='STRING')])
+    res.persist()
+
+    DBSession.flush()
+
+    res.feature_create(Feature(
+        fields=dict(name='inside'), geom=Point(10, 10, srid=3857)))
+    res.feature_create(Feature(
+        fields=dict(name='outside'), geom=Point(-10, -10, srid=3857)))
+
+    bounds = (0, 0, 1000, 1000)
+    query = res.feature_query()
+    query.intersects(box(*bounds, srid=3857))
+    content = query.mvt(bounds, 4096, 0, 'ngw:test')
+
+    if mvt_version(DBSession.connection().engine) is None:
+        assert content is None
+    else:
+        assert b'ngw:test' in content
+        assert b'inside' in content
+        assert b'outside' not in content
+
+
+def test_tiles(txn):
+    res = VectorLayer(
+        parent_id=0, display_name='tiles',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='LINESTRING',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+    )
+
+    res.setup_from_fields([])
+    res.persist()
+
+    DBSession.flush()
+
+    # Bounding box of the line covers all tiles of zoom level 1, but the
+    # line doesn't cross the bottom left one.
+    res.feature_create(Feature(geom=LineString((
+        (-1.5e7, 1.5e7), (1.5e7, 1.5e7), (1.5e7, -1.5e7)), srid=3857)))
+
+    query = res.feature_query()
+    assert sorted(query.tiles(0)) == [(0, 0)]
+    assert sorted(query.tiles(1)) == [(0, 0), (1, 0), (1, 1)]
+
+
+@pytest.mark.parametrize('search_index', (False, True))
+def test_like(search_index, txn):
+    res = VectorLayer(
+        parent_id=0, display_name='like',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=unicode(uuid4().hex),
+        search_index=search_index,
+    )
+
+    res.setup_from_fields([
+        dict(keyname='name', datatype=FIELD_TYPE.STRING),
+        dict(keyname='num', datatype=FIELD_TYPE.INTEGER),
+        dict(keyname='day', datatype=FIELD_TYPE.DATE),
+    ])
+    res.persist()
+
+    DBSession.flush()
+
+    res.feature_create_many([
+        Feature(fields=dict(name='foo', num=1, day=date(2019, 10, 1)),
+                geom=Point(0, 0, srid=3857)),
+        Feature(fields=dict(name='bar', num=2, day=None),
+                geom=Point(0, 0, srid=3857)),
+    ])
+
+    def like(value):
+        query = res.feature_query()
+        query.like(value)
+        return sorted(f.fields['name'] for f in query())
+
+    assert like('oo') == ['foo', ]
+    assert like('2') == ['bar', 'foo']
+    assert like('2019-10') == ['foo', ]
+    assert like('oo1') == []
+
+
+def test_field_index(env):
+    with transaction.manager:
+        res = VectorLayer(
+            parent_id=0, display_name='field_index',
+            owner_user=User.by_keyname('administrator'),
+            geometry_type='POINT',
+            srs=SRS.filter_by(id=3857).one(),
+            tbl_uuid=unicode(uuid4().hex),
+        )
+
+        res.setup_from_fields([
+            dict(keyname='name', datatype=FIELD_TYPE.STRING), ])
+        res.persist()
+
+        res.fields[0].indexed = True
+        res.field_indexes_sync()
+
+        DBSession.flush()
+        resid = res.id
+        tablename = res._tablename
+        idx_name = res.fields[0]._index_name
+
+    try:
+        # Index is built after commit in a separate connection
+        with transaction.manager:
+            valid = DBSession.connection().execute(db.sql.text(
+                'SELECT i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                "WHERE n.nspname = 'vector_layer' AND c.relname = :index"
+            ), index=idx_name).scalar()
+
+        assert valid is True
+
+    finally:
+        with transaction.manager:
+            DBSession.delete(VectorLayer.filter_by(id=resid).one())
+            DBSession.connection().execute(
+                'DROP TABLE IF EXISTS vector_layer."{}" CASCADE'.format(
+                    tablename))